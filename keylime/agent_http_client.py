@@ -0,0 +1,160 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2019 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+import ConfigParser
+import os
+import threading
+import time
+
+import tornado.ioloop
+from tornado import httpclient
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+
+import common
+import keylime_logging
+
+logger = keylime_logging.init_logging('agent_http_client')
+
+# setup config
+config = ConfigParser.SafeConfigParser()
+config.read(common.CONFIG_FILE)
+
+try:
+    from tornado.curl_httpclient import CurlAsyncHTTPClient
+    import pycurl
+    has_curl = True
+except ImportError:
+    has_curl = False
+
+
+class AgentHTTPClient(object):
+    """The HTTP client the verifier uses to talk to cloud agents.
+
+    A plain AsyncHTTPClient() allows 10 requests in flight per IOLoop and queues the rest
+    inside the client, where the wait counts against the request timeout and is not
+    visible anywhere.  This one is sized from keylime.conf and records how long requests
+    wait for a free slot so verifiers can be sized for their fleet.
+    """
+
+    def __init__(self, max_clients, connect_timeout, request_timeout, use_curl=True, compression=True, io_loop=None):
+        self.max_clients = max_clients
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.compression = compression
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.current()
+        self.pid = os.getpid()
+
+        # libcurl keeps connections to agents alive between polls, the simple client doesn't
+        if use_curl and not has_curl:
+            logger.warning("pycurl is not available, using the simple HTTP client for agent requests")
+        self.use_curl = use_curl and has_curl
+        if self.use_curl:
+            self.client = CurlAsyncHTTPClient(io_loop=self.io_loop, force_instance=True, max_clients=max_clients)
+        else:
+            self.client = SimpleAsyncHTTPClient(io_loop=self.io_loop, force_instance=True, max_clients=max_clients)
+
+        # counters, only touched from the IOLoop thread
+        self.submitted = 0
+        self.completed = 0
+        self.errors = 0
+        self.max_in_flight = 0
+        self.total_queue_time = 0.0
+        self.max_queue_time = 0.0
+        self.last_queue_time = 0.0
+        self.total_request_time = 0.0
+
+    def in_flight(self):
+        return self.submitted - self.completed
+
+    def fetch(self, url, callback, **kwargs):
+        """Fetches url and calls callback(response) on the IOLoop.  Extra arguments are
+        passed to HTTPRequest."""
+        kwargs.setdefault('connect_timeout', self.connect_timeout)
+        kwargs.setdefault('request_timeout', self.request_timeout)
+        # curl accepts gzip and deflate, the simple client gzip
+        kwargs.setdefault('decompress_response', self.compression)
+        request = httpclient.HTTPRequest(url, **kwargs)
+        submitted_at = time.time()
+        self.submitted += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight())
+
+        def on_response(response):
+            self._record(response, submitted_at)
+            callback(response)
+        self.client.fetch(request, callback=on_response)
+
+    def _record(self, response, submitted_at):
+        self.completed += 1
+        if response.error:
+            self.errors += 1
+        total = time.time() - submitted_at
+        request_time = response.request_time if response.request_time is not None else total
+        # whatever part of the total the client did not spend on the request was queueing
+        queue_time = max(0.0, total - request_time)
+        self.total_queue_time += queue_time
+        self.total_request_time += request_time
+        self.last_queue_time = queue_time
+        self.max_queue_time = max(self.max_queue_time, queue_time)
+
+    def get_stats(self):
+        return {
+            'backend': 'curl' if self.use_curl else 'simple',
+            'max_clients': self.max_clients,
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'errors': self.errors,
+            'in_flight': self.in_flight(),
+            'max_in_flight': self.max_in_flight,
+            'last_queue_time': self.last_queue_time,
+            'max_queue_time': self.max_queue_time,
+            'avg_queue_time': self.total_queue_time/self.completed if self.completed > 0 else 0.0,
+            'avg_request_time': self.total_request_time/self.completed if self.completed > 0 else 0.0,
+            }
+
+    def close(self):
+        self.client.close()
+
+
+def retry_after(response, default):
+    """The seconds to wait before asking again from the Retry-After header of a 503
+    response from an agent whose TPM is busy, or default if it doesn't say."""
+    try:
+        return max(float(response.headers.get('Retry-After')), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+
+__client = None
+__client_lock = threading.Lock()
+
+def get_client():
+    """Returns the agent client for this process, created lazily so that each forked
+    tornado process gets its own."""
+    global __client
+    with __client_lock:
+        if __client is None or __client.pid != os.getpid():
+            __client = AgentHTTPClient(config.getint('cloud_verifier','agent_http_max_clients'),
+                                       config.getfloat('cloud_verifier','agent_http_connect_timeout'),
+                                       config.getfloat('cloud_verifier','agent_http_request_timeout'),
+                                       config.getboolean('cloud_verifier','agent_http_use_curl'),
+                                       config.getboolean('cloud_verifier','agent_http_compression'))
+            logger.info("Using %s HTTP client for agent requests with up to %d requests in flight"%(
+                'curl' if __client.use_curl else 'simple', __client.max_clients))
+        return __client
@@ -0,0 +1,242 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2019 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+import copy
+
+import tornado.ioloop
+
+import keylime_logging
+
+logger = keylime_logging.init_logging('agent_registry')
+
+# The verifier's in memory copy of the agents it is polling.  The agent dicts handed
+# out here are the live ones that process_agent passes around, the database is only a
+# write-behind copy of them.  Each verifier process has its own registry and only
+# tracks the agents it polls.
+#
+# Changes are found by comparing the persisted columns against what was last written.
+# Columns are compared by value, against a copy for JSON columns (policies, metadata)
+# so changes made in place are found too.  JSON columns too large to compare on every
+# flush, like whitelists, are given as identity_cols and compared by identity only;
+# assign a new object to change one of those rather than modifying it in place.
+
+class AgentRegistry(object):
+    db = None
+    # agent_id : live agent dict
+    agents = None
+    # agent_id : {column : value last written}
+    persisted = None
+    # agent_ids touched since the last flush
+    dirty = None
+    # agent_id : state set through the REST interface
+    user_states = None
+
+    def __init__(self,db,flush_interval,flush_size,user_state_values=(),identity_cols=()):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        # the operational states only set_user_state() sets
+        self.user_state_values = user_state_values
+        # JSON columns compared by identity
+        self.identity_cols = identity_cols
+        self.agents = {}
+        self.persisted = {}
+        self.dirty = set()
+        self.user_states = {}
+        self.flusher = None
+
+    def __persisted_value(self,key,value):
+        """What changes() compares the column key against once value is written."""
+        if key in self.db.json_cols_db and key not in self.identity_cols:
+            return copy.deepcopy(value)
+        return value
+
+    def __snapshot(self,agent):
+        snapshot = {}
+        for key in self.db.update_cols:
+            snapshot[key] = self.__persisted_value(key,agent.get(key))
+        return snapshot
+
+    def __track(self,agent_id,agent):
+        self.agents[agent_id] = agent
+        self.persisted[agent_id] = self.__snapshot(agent)
+        return agent
+
+    def get(self,agent_id):
+        """Returns the live agent if this process is polling it.  Otherwise the agent may
+        be owned by another verifier process, so a fresh copy is read from the database
+        and it is only tracked once it is touched."""
+        agent = self.agents.get(agent_id)
+        if agent is not None:
+            return agent
+        return self.db.get_agent(agent_id)
+
+    def get_agent_ids(self):
+        return self.db.get_agent_ids()
+
+    def add(self,agent_id,d,check=None):
+        """Adds a new agent, written through to the database.  Returns None if the agent
+        already exists.  check is passed on to the database's add_agent()."""
+        agent = self.db.add_agent(agent_id,d,check)
+        if agent is None:
+            return None
+        self.user_states.pop(agent_id,None)
+        return self.__track(agent_id,agent)
+
+    def remove(self,agent_id):
+        self.agents.pop(agent_id,None)
+        self.persisted.pop(agent_id,None)
+        self.dirty.discard(agent_id)
+        self.user_states.pop(agent_id,None)
+        return self.db.remove_agent(agent_id)
+
+    def set_user_state(self,agent_id,state,serial_key):
+        """Records a state requested through the REST interface, like terminate or stop.
+        This is written through and bumps the serial_key column, so the verifier process
+        polling the agent sees it with its next refresh()."""
+        self.user_states[agent_id] = state
+        self.__write_state(agent_id,state,serial_key)
+
+    def clear_user_state(self,agent_id,state,serial_key):
+        """Undoes set_user_state, for example when an agent is reactivated."""
+        self.user_states.pop(agent_id,None)
+        self.__write_state(agent_id,state,serial_key)
+
+    def __write_state(self,agent_id,state,serial_key):
+        agent = self.agents.get(agent_id)
+        if agent is not None:
+            agent['operational_state'] = state
+            self.persisted[agent_id]['operational_state'] = state
+        self.db.update_agents({'operational_state':state},'agent_id',agent_id,serial_key)
+        if agent is not None:
+            # take up the new serial, this process knows already
+            self.refresh(agent,serial_key,[])
+
+    def get_user_state(self,agent_id,states):
+        """Returns the REST requested state of the agent if it is one of states.  This
+        doesn't touch the database, states requested through another verifier process
+        are picked up by refresh()."""
+        state = self.user_states.get(agent_id)
+        if state in states:
+            return state
+        return None
+
+    def update(self,fields,key,value,serial_key,check=None):
+        """Sets fields of the agents whose column key holds value, written through to
+        the database in one statement, and bumps their serial_key column so that the
+        verifier processes polling them pick up the change with refresh().  Returns the
+        number of agents updated.  check is passed on to the database's update_agents()."""
+        count = self.db.update_agents(fields,key,value,serial_key,check)
+        for agent in self.agents.values():
+            if agent.get(key) == value:
+                self.refresh(agent,serial_key,fields.keys())
+        return count
+
+    def refresh(self,agent,serial_key,keys):
+        """Reloads keys of a live agent from the database if its serial_key column was
+        bumped by update() or set_user_state(), possibly in another verifier process.  
+        Only that one column is read otherwise.  Returns True if the agent was reloaded."""
+        agent_id = agent['agent_id']
+        serial = self.db.get_agent_value(agent_id,serial_key)
+        if serial is None or serial == agent.get(serial_key):
+            return False
+        row = self.db.get_agent(agent_id)
+        if row is None:
+            return False
+        persisted = self.persisted.get(agent_id)
+        keys = list(keys)+[serial_key]
+        state = row['operational_state']
+        if state in self.user_state_values:
+            self.user_states[agent_id] = state
+            keys.append('operational_state')
+        elif self.user_states.pop(agent_id,None) is not None:
+            keys.append('operational_state')
+        for k in keys:
+            agent[k] = row[k]
+            if persisted is not None:
+                persisted[k] = self.__persisted_value(k,row[k])
+        return True
+
+    def touch(self,agent):
+        """Notes that the agent may have changed.  It is written by the next flush if any
+        persisted column differs from what was last written."""
+        agent_id = agent['agent_id']
+        if agent_id not in self.agents:
+            self.__track(agent_id,agent)
+        elif self.agents[agent_id] is not agent:
+            self.agents[agent_id] = agent
+        self.dirty.add(agent_id)
+
+        if len(self.dirty)>=self.flush_size:
+            self.flush()
+        elif self.flusher is None:
+            self.flusher = tornado.ioloop.PeriodicCallback(self.flush,self.flush_interval*1000)
+            self.flusher.start()
+
+    def changes(self,agent_id):
+        agent = self.agents[agent_id]
+        persisted = self.persisted[agent_id]
+        changed = {}
+        for key in self.db.update_cols:
+            value = agent.get(key)
+            old = persisted.get(key)
+            if key in self.identity_cols:
+                if value is not old:
+                    changed[key] = value
+            elif value!=old:
+                changed[key] = value
+        return changed
+
+    def flush(self):
+        """Writes the changed columns of all touched agents in one transaction.  Returns
+        the number of agents written."""
+        if len(self.dirty)==0:
+            return 0
+        written = {}
+        for agent_id in self.dirty:
+            if agent_id not in self.agents:
+                continue
+            changed = self.changes(agent_id)
+            # polling may still be winding down, don't overwrite what the user asked for
+            if agent_id in self.user_states:
+                changed.pop('operational_state',None)
+            if len(changed)==0:
+                continue
+            self.db.queue_update(agent_id,changed)
+            written[agent_id] = changed
+        try:
+            self.db.flush()
+        except Exception as e:
+            # the agents stay dirty, the next flush tries again
+            logger.error("Unable to write %d agents to the database: %s"%(len(written),e))
+            logger.exception(e)
+            return 0
+        for agent_id,changed in written.iteritems():
+            persisted = self.persisted[agent_id]
+            for key,value in changed.iteritems():
+                persisted[key] = self.__persisted_value(key,value)
+        self.dirty = set()
+        return len(written)
+
+    def stop(self):
+        if self.flusher is not None:
+            self.flusher.stop()
+            self.flusher = None
+        self.flush()
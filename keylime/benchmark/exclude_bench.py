@@ -0,0 +1,95 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2019 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+# Compares matching measured paths against an exclude list with one big alternation
+# regex, as process_measurement_list used to, and with ima_whitelist.ExcludeMatcher.
+# The exclude lists are scaled up from patterns like the ones in
+# scripts/ima/exclude.txt.  The old alternation used capturing groups, which python
+# refuses beyond 100 patterns, so the baseline here uses non capturing ones.  Run from
+# the keylime/benchmark directory.
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from ima_whitelist import ExcludeMatcher
+
+TOP_DIRS = ['bin', 'boot', 'etc', 'home', 'lib', 'opt', 'root', 'sbin', 'srv', 'sys', 'tmp', 'usr', 'var']
+
+def make_patterns(count, rng):
+    patterns = []
+    for i in range(count):
+        top = rng.choice(TOP_DIRS)
+        kind = rng.random()
+        if kind < 0.4:
+            # a single file, like /var/log/wtmp
+            patterns.append("/%s/dir%d/file%d"%(top, rng.randint(0, 50), i))
+        elif kind < 0.75:
+            # a directory, like /sys/fs/.*
+            patterns.append("/%s/dir%d/sub%d/.*"%(top, rng.randint(0, 50), i))
+        elif kind < 0.95:
+            patterns.append("/%s/.*/\\.cache%d/.*\\.tmp$"%(top, i))
+        else:
+            patterns.append("/%s/dir%d/[a-f0-9]+\\.log%d"%(top, rng.randint(0, 50), i))
+    return patterns
+
+def make_paths(count, rng):
+    paths = []
+    for i in range(count):
+        top = rng.choice(TOP_DIRS)
+        depth = rng.randint(1, 4)
+        parts = ["dir%d"%rng.randint(0, 50)] + ["sub%d"%rng.randint(0, 2000) for _ in range(depth-1)]
+        paths.append("/%s/%s/file%d"%(top, '/'.join(parts), rng.randint(0, 2000)))
+    return paths
+
+def time_matcher(match, paths):
+    start = time.time()
+    matched = [match(path) for path in paths]
+    return time.time() - start, matched
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(argv[0])
+    parser.add_argument('-p', '--patterns', type=int, nargs='+', default=[4, 50, 100, 500, 2000], help="exclude list sizes")
+    parser.add_argument('-n', '--paths', type=int, default=20000, help="paths matched per exclude list")
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    args = parser.parse_args(argv[1:])
+
+    rng = random.Random(args.seed)
+    paths = make_paths(args.paths, rng)
+    print "%10s %14s %14s %14s %8s"%("patterns", "compile ms", "regex us/path", "matcher us/path", "matched")
+    for count in args.patterns:
+        patterns = make_patterns(count, rng)
+        start = time.time()
+        combined = re.compile("(?:" + ")|(?:".join(patterns) + ")")
+        matcher = ExcludeMatcher(patterns)
+        compile_time = time.time() - start
+
+        regex_time, expected = time_matcher(lambda path: combined.match(path) is not None, paths)
+        matcher_time, matched = time_matcher(matcher.match, paths)
+        if matched != expected:
+            raise Exception("matcher disagrees with the regex for %d patterns"%count)
+        print "%10d %14.2f %14.2f %14.2f %8d"%(count, compile_time*1000, regex_time/len(paths)*1e6, matcher_time/len(paths)*1e6, sum(matched))
+
+if __name__ == '__main__':
+    main()
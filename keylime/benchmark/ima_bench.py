@@ -0,0 +1,155 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2019 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+# Measures checking IMA measurement lists against a whitelist, the bulk of the
+# verifier's work for agents with IMA, on lists from ima_gen.py.  For each list size,
+# template and format it reports the end to end rate of ima.process_measurement_list
+# (or process_measurement_list_bin) and how long each phase takes on its own: parsing
+# the entries, checking template hashes, looking paths up in the whitelist (with the
+# exclude list) and extending the PCR.  Each configuration runs in its own process so
+# peak RSS is per configuration.  Run from the keylime/benchmark directory.
+
+import argparse
+import hashlib
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import ima
+import ima_whitelist
+import ima_gen
+
+def current_rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1])*resource.getpagesize()/1048576.0
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time()-start, result
+
+def parse(ml, binary):
+    if binary:
+        return list(ima.__binary_entries(ml))
+    return list(ima.__ascii_entries(ml.split('\n')))
+
+def check_template_hashes(entries):
+    errors = 0
+    for template_hash, tohash, _, _ in entries:
+        if template_hash != ima.START_HASH and hashlib.sha1(tohash).digest() != template_hash:
+            errors += 1
+    return errors
+
+def look_up(entries, lists):
+    whitelist = lists['whitelist']
+    exclude = lists['exclude']
+    compiled = isinstance(whitelist, ima_whitelist.CompiledWhitelist)
+    errors = 0
+    for template_hash, _, filedata_hash, path in entries:
+        if template_hash == ima.START_HASH or exclude.match(path):
+            continue
+        if compiled:
+            accept_list = whitelist.get_digests(path)
+            digest = filedata_hash
+        else:
+            accept_list = whitelist.get(path)
+            digest = filedata_hash.encode('hex')
+        if accept_list is None or digest not in accept_list:
+            errors += 1
+    return errors
+
+def chain(entries):
+    pcr = ima.START_HASH
+    for template_hash, _, _, _ in entries:
+        if template_hash == ima.START_HASH:
+            template_hash = ima.FF_HASH
+        pcr = hashlib.sha1(pcr+template_hash).digest()
+    return pcr.encode('hex')
+
+def run(count, template, binary, compiled, seed):
+    entries = ima_gen.make_entries(count, template, seed)
+    expected = ima_gen.expected_pcr(entries)
+    ml = ima_gen.to_binary(entries, template) if binary else ima_gen.to_ascii(entries, template)
+    wl_lines = ima_gen.make_whitelist(entries)
+    del entries
+    gen_rss = current_rss_mb()
+
+    times = {}
+    times['lists'], lists = timed(ima.process_whitelists, wl_lines, list(ima_gen.EXCLUDE))
+    if compiled:
+        times['compile'], lists = timed(ima.compile_whitelists, lists)
+    else:
+        times['compile'] = 0.0
+        lists['exclude'] = ima_whitelist.ExcludeMatcher(lists['exclude'])
+
+    if binary:
+        times['total'], pcr = timed(ima.process_measurement_list_bin, ml, lists)
+    else:
+        times['total'], pcr = timed(lambda: ima.process_measurement_list(ml.split('\n'), lists))
+    if pcr != expected:
+        raise Exception("got PCR %s, expected %s"%(pcr, expected))
+
+    times['parse'], parsed = timed(parse, ml, binary)
+    times['template'], errors = timed(check_template_hashes, parsed)
+    times['lookup'], errors2 = timed(look_up, parsed, lists)
+    times['chain'], pcr = timed(chain, parsed)
+    if errors+errors2 > 0 or pcr != expected:
+        raise Exception("phases disagree with the full check")
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+    print "%8d %-6s %-6s %-8s %12.0f %8.3f %8.3f %8.3f %8.3f %8.3f %8.3f %8.3f %8.1f %8.1f"%(
+        count, template, ('ascii', 'binary')[binary], ('dict', 'compiled')[compiled], count/times['total'],
+        times['total'], times['lists'], times['compile'], times['parse'], times['template'], times['lookup'], times['chain'],
+        gen_rss, peak)
+    sys.stdout.flush()
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(argv[0])
+    parser.add_argument('-n', '--entries', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('-t', '--template', nargs='+', choices=['ima', 'ima-ng'], default=['ima', 'ima-ng'])
+    parser.add_argument('-f', '--format', nargs='+', choices=['ascii', 'binary'], default=['ascii', 'binary'])
+    parser.add_argument('-w', '--whitelist', nargs='+', choices=['dict', 'compiled'], default=['compiled'])
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    args = parser.parse_args(argv[1:])
+
+    print "times in seconds, memory in MB.  lists is process_whitelists, gen rss is after generating the list"
+    print "%8s %-6s %-6s %-8s %12s %8s %8s %8s %8s %8s %8s %8s %8s %8s"%(
+        "entries", "tmpl", "format", "wl", "entries/s", "total", "lists", "compile", "parse", "template", "lookup", "chain", "gen rss", "peak rss")
+    for count in args.entries:
+        for template in args.template:
+            for fmt in args.format:
+                for wl in args.whitelist:
+                    # a fresh process for each so peak RSS means something
+                    pid = os.fork()
+                    if pid == 0:
+                        code = 0
+                        try:
+                            run(count, template, fmt == 'binary', wl == 'compiled', args.seed)
+                        except Exception as e:
+                            print "%d %s %s %s failed: %s"%(count, template, fmt, wl, e)
+                            code = 1
+                        sys.stdout.flush()
+                        os._exit(code)
+                    os.waitpid(pid, 0)
+
+if __name__ == '__main__':
+    main()
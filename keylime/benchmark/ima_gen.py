@@ -0,0 +1,174 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2019 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+# Generates synthetic IMA measurement lists with matching whitelists and exclude lists
+# for benchmarking.  Lists look like the ones in scripts/ima: a boot_aggregate entry,
+# then files from a system like directory tree, some measured again after changing, a
+# few violations (zero template hash, extended into the PCR as all ff) and some under
+# excluded directories.  The same seed always gives the same lists.  Run from the
+# keylime/benchmark directory, e.g. to write a 100k entry ima-ng list:
+#
+#     python ima_gen.py -n 100000 -t ima-ng -o /tmp/ima
+
+import argparse
+import hashlib
+import os
+import random
+import struct
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import ima
+from ima_whitelist import ExcludeMatcher
+
+# directory : (weight, file extensions)
+TREE = {
+    '/usr/bin': (10, ['']),
+    '/usr/sbin': (3, ['']),
+    '/usr/lib/x86_64-linux-gnu': (20, ['.so', '.so.1', '.so.6']),
+    '/usr/lib/python2.7': (15, ['.py', '.pyc', '.so']),
+    '/usr/share/perl5': (5, ['.pm']),
+    '/lib/modules/4.15.0/kernel/drivers': (5, ['.ko']),
+    '/etc': (5, ['', '.conf']),
+    '/opt/app/lib': (5, ['.jar', '.so']),
+    # excluded, see EXCLUDE
+    '/tmp': (3, ['', '.tmp']),
+    '/var/log': (2, ['.log']),
+    '/home/user/.cache': (2, ['']),
+    }
+EXCLUDE = [
+    '/tmp/.*',
+    '/var/log/.*',
+    '/home/.*/\\.cache/.*',
+    '/root/etc/fstab',
+    '/boot/grub/grubenv',
+    ]
+
+# how often an entry is a file measured again with new contents, and a violation
+REMEASURE_RATE = 0.02
+VIOLATION_RATE = 0.001
+
+def make_path(rng, dirs, cumulative):
+    directory = dirs[weighted(rng, cumulative)]
+    extensions = TREE[directory][1]
+    subdirs = '/'.join(['d%d'%rng.randint(0, 30) for _ in range(rng.randint(0, 3))])
+    name = "f%x%s"%(rng.getrandbits(32), rng.choice(extensions))
+    return '/'.join([p for p in [directory, subdirs, name] if p != ''])
+
+def weighted(rng, cumulative):
+    x = rng.random()*cumulative[-1]
+    for i, w in enumerate(cumulative):
+        if x < w:
+            return i
+    return len(cumulative)-1
+
+def template_data(template, filedata_hash, path):
+    """The data the template hash is over, as ima.py computes it."""
+    if template == 'ima':
+        return filedata_hash+path+'\0'*(ima.TCG_EVENT_NAME_LEN_MAX+1-len(path))
+    fields = ['sha1:\0'+filedata_hash, path+'\0']
+    return ''.join([struct.pack("<I", len(f))+f for f in fields])
+
+def make_entries(count, template, seed):
+    """count entries of (template hash, file hash, path) for template 'ima' or
+    'ima-ng'.  Violations have all zero hashes."""
+    rng = random.Random(seed)
+    dirs = sorted(TREE.keys())
+    cumulative = []
+    for d in dirs:
+        cumulative.append((cumulative[-1] if cumulative else 0)+TREE[d][0])
+
+    entries = [(None, ima.START_HASH, 'boot_aggregate')]
+    paths = []
+    while len(entries) < count:
+        x = rng.random()
+        if x < VIOLATION_RATE:
+            entries.append((ima.START_HASH, ima.START_HASH, make_path(rng, dirs, cumulative)))
+            continue
+        if x < VIOLATION_RATE+REMEASURE_RATE and len(paths) > 0:
+            path = rng.choice(paths)
+        else:
+            path = make_path(rng, dirs, cumulative)
+            paths.append(path)
+        entries.append((None, hashlib.sha1("%d %s"%(rng.getrandbits(64), path)).digest(), path))
+
+    for i, (template_hash, filedata_hash, path) in enumerate(entries):
+        if template_hash is None:
+            entries[i] = (hashlib.sha1(template_data(template, filedata_hash, path)).digest(), filedata_hash, path)
+    return entries
+
+def to_ascii(entries, template):
+    lines = []
+    for template_hash, filedata_hash, path in entries:
+        filedata = filedata_hash.encode('hex')
+        if template != 'ima':
+            filedata = 'sha1:'+filedata
+        lines.append("%d %s %s %s %s\n"%(ima.common.IMA_PCR, template_hash.encode('hex'), template, filedata, path))
+    return ''.join(lines)
+
+def to_binary(entries, template):
+    out = []
+    for template_hash, filedata_hash, path in entries:
+        out.append(ima.ENTRY_HEADER.pack(ima.common.IMA_PCR, template_hash, len(template)))
+        out.append(template)
+        if template == 'ima':
+            out.append(filedata_hash+struct.pack("<I", len(path))+path)
+        else:
+            data = template_data(template, filedata_hash, path)
+            out.append(struct.pack("<I", len(data))+data)
+    return ''.join(out)
+
+def make_whitelist(entries):
+    """Whitelist lines accepting every entry that isn't excluded, in the tenant's 'hash
+    path' format."""
+    exclude = ExcludeMatcher(EXCLUDE)
+    return ["%s %s"%(filedata_hash.encode('hex'), path) for template_hash, filedata_hash, path in entries
+            if template_hash != ima.START_HASH and not exclude.match(path)]
+
+def expected_pcr(entries):
+    """The IMA PCR value the entries extend to, computed independently of ima.py."""
+    pcr = ima.START_HASH
+    for template_hash, _, _ in entries:
+        if template_hash == ima.START_HASH:
+            template_hash = ima.FF_HASH
+        pcr = hashlib.sha1(pcr+template_hash).digest()
+    return pcr.encode('hex')
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(argv[0])
+    parser.add_argument('-n', '--entries', type=int, default=10000)
+    parser.add_argument('-t', '--template', choices=['ima', 'ima-ng'], default='ima-ng')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', required=True, help="directory to write ascii_runtime_measurements, binary_runtime_measurements, whitelist.txt and exclude.txt to")
+    args = parser.parse_args(argv[1:])
+
+    entries = make_entries(args.entries, args.template, args.seed)
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    for name, data in [('ascii_runtime_measurements', to_ascii(entries, args.template)),
+                       ('binary_runtime_measurements', to_binary(entries, args.template)),
+                       ('whitelist.txt', '\n'.join(make_whitelist(entries))+'\n'),
+                       ('exclude.txt', '\n'.join(EXCLUDE)+'\n')]:
+        with open(os.path.join(args.output, name), 'wb') as f:
+            f.write(data)
+    print "wrote %d %s entries to %s, PCR %d is %s"%(len(entries), args.template, args.output, ima.common.IMA_PCR, expected_pcr(entries))
+
+if __name__ == '__main__':
+    main()
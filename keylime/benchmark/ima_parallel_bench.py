@@ -0,0 +1,98 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2019 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+# Measures checking one large IMA measurement list split into pieces by the workers of
+# a verification_executor.VerificationExecutor, the way the verifier does with
+# ima_parallel_chunks set, against checking it in one go.  Split is the time to split
+# the list, pieces the time until all pieces are checked and combine the time to
+# extend the PCR with their results.  As in the verifier, each worker has the
+# compiled whitelist already and only the pieces are sent to it.  The speedup is
+# bounded by the number of cores.  Run from the keylime/benchmark directory.
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import tornado.ioloop
+import ima
+import ima_gen
+import verification_executor
+
+# the compiled lists, set before the workers are forked
+LISTS = None
+
+def check_piece(piece, binary):
+    return ima.check_piece(piece, binary, LISTS)
+
+def run_pieces(executor, io_loop, pieces, binary):
+    return io_loop.run_sync(lambda: [executor.submit(check_piece, piece, binary) for piece in pieces])
+
+def main(argv=sys.argv):
+    global LISTS
+    parser = argparse.ArgumentParser(argv[0])
+    parser.add_argument('-n', '--entries', type=int, default=200000)
+    parser.add_argument('-t', '--template', choices=['ima', 'ima-ng'], default='ima-ng')
+    parser.add_argument('-f', '--format', choices=['ascii', 'binary'], default='ascii')
+    parser.add_argument('-w', '--workers', type=int, nargs='+', default=sorted(set([1, 2, multiprocessing.cpu_count()])))
+    parser.add_argument('-c', '--chunks', type=int, default=0, help="pieces to split the list into, 2 per worker by default")
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    args = parser.parse_args(argv[1:])
+    binary = args.format == 'binary'
+
+    entries = ima_gen.make_entries(args.entries, args.template, args.seed)
+    expected = ima_gen.expected_pcr(entries)
+    ml = ima_gen.to_binary(entries, args.template) if binary else ima_gen.to_ascii(entries, args.template)
+    LISTS = ima.compile_whitelists(ima.process_whitelists(ima_gen.make_whitelist(entries), list(ima_gen.EXCLUDE)))
+    del entries
+
+    start = time.time()
+    if ima.check_measurement_list(ml, LISTS, binary=binary) != expected:
+        raise Exception("serial check failed")
+    serial = time.time()-start
+    print "%d %s %s entries, %.1f MB, %d cores" % (args.entries, args.template, args.format, len(ml)/1048576.0, multiprocessing.cpu_count())
+    print "serial check %.3f s" % serial
+    print "%8s %8s %8s %8s %8s %8s %8s" % ("workers", "pieces", "split", "pieces", "combine", "total", "speedup")
+
+    for workers in args.workers:
+        chunks = args.chunks or 2*workers
+        io_loop = tornado.ioloop.IOLoop()
+        executor = verification_executor.VerificationExecutor(workers, io_loop)
+        try:
+            # warm up the workers
+            run_pieces(executor, io_loop, [''] * workers, binary)
+            start = time.time()
+            pieces = ima.split_measurement_list(ml, chunks, binary)
+            split = time.time()
+            results = run_pieces(executor, io_loop, pieces, binary)
+            checked = time.time()
+            if ima.combine_pieces(results) != expected:
+                raise Exception("check in pieces failed")
+            done = time.time()
+        finally:
+            executor.shutdown()
+            io_loop.close()
+        print "%8d %8d %8.3f %8.3f %8.3f %8.3f %7.2fx" % (workers, len(pieces), split-start, checked-split, done-checked, done-start, serial/(done-start))
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
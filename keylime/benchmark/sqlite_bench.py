@@ -0,0 +1,132 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2019 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+# Measures per agent lookup and update cost of the verifier database as the number of
+# agents grows, for both the old (unindexed) schema and the current one.  Lookups
+# should stay flat with the current schema.  Run from the keylime/benchmark directory.
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import keylime_sqlite
+
+COLS_DB = {
+    'agent_id': 'TEXT PRIMARY KEY',
+    'v': 'TEXT',
+    'ip': 'TEXT',
+    'port': 'INT',
+    'operational_state': 'INT',
+    'public_key': 'TEXT',
+    'tpm_policy' : 'TEXT',
+    'vtpm_policy' : 'TEXT',
+    'metadata' : 'TEXT',
+    'ima_whitelist' : 'TEXT',
+    'revocation_key': 'TEXT',
+    'tpm_version': 'INT',
+    'accept_tpm_hash_algs': 'TEXT',
+    'accept_tpm_encryption_algs': 'TEXT',
+    'accept_tpm_signing_algs': 'TEXT',
+    'hash_alg': 'TEXT',
+    'enc_alg': 'TEXT',
+    'sign_alg': 'TEXT',
+    }
+JSON_COLS_DB = ['tpm_policy','vtpm_policy','metadata','ima_whitelist','accept_tpm_hash_algs','accept_tpm_encryption_algs','accept_tpm_signing_algs']
+
+def agent_row(agent_id):
+    row = []
+    for key in sorted(COLS_DB.keys()):
+        if key == 'agent_id':
+            row.append(agent_id)
+        elif key in JSON_COLS_DB:
+            row.append('{}')
+        elif 'INT' in COLS_DB[key]:
+            row.append(0)
+        else:
+            row.append('x'*32)
+    return row
+
+def populate(db_filename, num_agents, legacy):
+    """Bulk loads num_agents rows.  The legacy schema is created the way it was before
+    schema version 1, without a usable primary key."""
+    if legacy:
+        cols_db = dict(COLS_DB)
+        cols_db['agent_id'] = 'TEXT PRIMARY_KEY'
+        with sqlite3.connect(db_filename) as conn:
+            conn.execute("CREATE TABLE main(%s)"%", ".join(["%s %s"%(key,cols_db[key]) for key in sorted(cols_db.keys())]))
+    else:
+        keylime_sqlite.KeylimeDB(db_filename,COLS_DB,JSON_COLS_DB,{},index_cols=['operational_state'])
+
+    ids = ["agent-%08d"%i for i in range(num_agents)]
+    with sqlite3.connect(db_filename) as conn:
+        conn.executemany('INSERT INTO main(%s) VALUES(?%s)'%(",".join(sorted(COLS_DB.keys())),",?"*(len(COLS_DB)-1)),
+                         (agent_row(agent_id) for agent_id in ids))
+        conn.commit()
+    return ids
+
+def bench(num_agents, legacy, iterations):
+    fd, db_filename = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    os.remove(db_filename)
+    try:
+        ids = populate(db_filename, num_agents, legacy)
+        # these are the statements KeylimeDB.get_agent and update_agent issue, run
+        # directly so the legacy table is not migrated when it is opened
+        sample = [random.choice(ids) for _ in range(iterations)]
+        t0 = time.time()
+        for agent_id in sample:
+            with sqlite3.connect(db_filename) as conn:
+                conn.execute('SELECT * from main where agent_id=?',(agent_id,)).fetchall()
+        get_time = (time.time()-t0)/iterations
+
+        t0 = time.time()
+        for agent_id in sample:
+            with sqlite3.connect(db_filename) as conn:
+                conn.execute('UPDATE main SET operational_state = ? where agent_id = ?',(3,agent_id))
+                conn.commit()
+        update_time = (time.time()-t0)/iterations
+        return get_time, update_time
+    finally:
+        os.remove(db_filename)
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser("keylime-sqlite-bench")
+    parser.add_argument('-s', '--sizes', action='store', dest='sizes', default='100,1000,10000,100000', help="comma separated agent counts")
+    parser.add_argument('-n', '--iterations', action='store', dest='iterations', type=int, default=200)
+    parser.add_argument('--skip-legacy', action='store_true', dest='skip_legacy', default=False, help="only measure the current schema")
+    args = parser.parse_args(argv[1:])
+
+    schemas = [('current', False)]
+    if not args.skip_legacy:
+        schemas.insert(0, ('legacy', True))
+
+    print "%-8s %8s %14s %14s"%("schema", "agents", "get ms/op", "update ms/op")
+    for size in [int(s) for s in args.sizes.split(',')]:
+        for name, legacy in schemas:
+            get_time, update_time = bench(size, legacy, args.iterations)
+            print "%-8s %8d %14.3f %14.3f"%(name, size, get_time*1000, update_time*1000)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,93 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2019 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+# Compares in process TPM 2.0 quote checking (tpm2_quote) against tpm2_checkquote
+# using the quote in test-data/tpm2/files.  Run from the keylime/benchmark directory.
+
+import argparse
+import binascii
+import distutils.spawn
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import cmd_exec
+import tpm2_quote
+
+
+def load_quote(datadir):
+    files = {}
+    for name in ['quote.out', 'quotesig.out', 'quotepcr.out', 'akpub.pem']:
+        with open(os.path.join(datadir, name), 'rb') as f:
+            files[name] = f.read()
+    files['nonce'] = tpm2_quote.parse_attest(files['quote.out'])['extra_data']
+    return files
+
+def check_native(q, hash_alg):
+    return tpm2_quote.check_quote(q['nonce'], q['akpub.pem'], q['quote.out'], q['quotesig.out'], q['quotepcr.out'], hash_alg) is not None
+
+def check_tools(q, hash_alg):
+    # mirrors what tpm2.check_quote does for every quote
+    paths = []
+    try:
+        for name in ['akpub.pem', 'quote.out', 'quotesig.out', 'quotepcr.out']:
+            fd, path = tempfile.mkstemp()
+            os.write(fd, q[name])
+            os.close(fd)
+            paths.append(path)
+        cmd = "tpm2_checkquote -c %s -m %s -s %s -p %s -G %s -q %s"%(paths[0], paths[1], paths[2], paths[3], hash_alg, binascii.hexlify(q['nonce']))
+        retDict = cmd_exec.run(cmd, raiseOnError=False, lock=False)
+        return retDict['code'] == 0
+    finally:
+        for path in paths:
+            os.remove(path)
+
+def bench(name, func, q, hash_alg, iterations):
+    if not func(q, hash_alg):
+        print "%s: quote did not verify, skipping"%name
+        return None
+    t0 = time.time()
+    for _ in range(iterations):
+        func(q, hash_alg)
+    elapsed = time.time() - t0
+    print "%-8s %6d quotes in %8.3f s  %10.3f ms/quote  %10.1f quotes/s"%(name, iterations, elapsed, elapsed*1000/iterations, iterations/elapsed)
+    return elapsed/iterations
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser("keylime-tpm2-quote-bench")
+    parser.add_argument('-d', '--data', action='store', dest='datadir', default='../../test-data/tpm2/files', help="directory with quote.out, quotesig.out, quotepcr.out and akpub.pem")
+    parser.add_argument('-n', '--iterations', action='store', dest='iterations', type=int, default=1000)
+    parser.add_argument('-g', '--hash', action='store', dest='hash_alg', default='sha256')
+    args = parser.parse_args(argv[1:])
+
+    q = load_quote(args.datadir)
+    native = bench("native", check_native, q, args.hash_alg, args.iterations)
+
+    if distutils.spawn.find_executable("tpm2_checkquote") is None:
+        print "tpm2_checkquote not found in PATH, skipping tools benchmark"
+        return
+    tools = bench("tools", check_tools, q, args.hash_alg, max(1, args.iterations/10))
+    if native is not None and tools is not None:
+        print "native is %.1fx faster"%(tools/native)
+
+if __name__=="__main__":
+    main()
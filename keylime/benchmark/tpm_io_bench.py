@@ -0,0 +1,91 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2019 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+# Compares the per call overhead of the files tpm2 hands to the TPM tools: named
+# temporary files on disk, as tpm2.create_quote used to make, against cmd_exec.MemFile.
+# Each call makes the three output files of a quote.  With the stubbed TPM the tool
+# isn't run and only making and dropping the files counts.  With -t a shell stands in
+# for the tool and writes the canned quote from test-data/tpm2/emulator-inputs.txt to
+# them, and the outputs are read back through cmd_exec.run, like the real thing.  Run
+# from the keylime/benchmark directory.
+
+import argparse
+import base64
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import cmd_exec
+
+OUTPUTS = ['file://quoteMessage', 'file://quoteSignature', 'file://quotePCR']
+
+def load_canned(path):
+    with open(path, 'rb') as f:
+        canned = json.loads('{' + f.read().rstrip(',\r\n') + '}')
+    fileouts = canned['tpm2_deluxequote']['fileout']
+    return [base64.b64decode(fileouts[name]).decode('zlib') for name in OUTPUTS]
+
+def quote(make_file, outputs, run_tool):
+    files = [make_file() for _ in outputs]
+    try:
+        paths = [f.name for f in files]
+        if not run_tool:
+            # what tpm2.__run hands back for a stubbed TPM
+            return dict(zip(paths, outputs))
+        # the tool writes its outputs by path
+        cmd = "; ".join(["printf '%s' > %s"%(''.join(['\\%03o'%ord(c) for c in data]), path) for data, path in zip(outputs, paths)])
+        return cmd_exec.run(cmd, lock=False, outputpaths=paths)['fileouts']
+    finally:
+        for f in files:
+            f.close()
+
+def bench(name, make_file, outputs, run_tool, iterations):
+    fileouts = quote(make_file, outputs, run_tool)
+    if sorted(fileouts.values()) != sorted(outputs):
+        raise Exception("%s: outputs were not read back"%name)
+    t0 = time.time()
+    for _ in range(iterations):
+        quote(make_file, outputs, run_tool)
+    elapsed = time.time() - t0
+    print "%-10s %6d calls in %8.3f s  %10.1f us/call"%(name, iterations, elapsed, elapsed*1e6/iterations)
+    return elapsed/iterations
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser("keylime-tpm-io-bench")
+    parser.add_argument('-c', '--canned', action='store', dest='canned', default='../../test-data/tpm2/emulator-inputs.txt', help="canned TPM outputs")
+    parser.add_argument('-n', '--iterations', action='store', dest='iterations', type=int, default=20000)
+    parser.add_argument('-t', '--tool', action='store_true', dest='run_tool', default=False, help="run a stand in for the tool")
+    parser.add_argument('-d', '--dir', action='store', dest='tmpdir', default=None, help="directory for the named temporary files")
+    args = parser.parse_args(argv[1:])
+
+    outputs = load_canned(args.canned)
+    iterations = args.iterations
+    if args.run_tool:
+        iterations = max(1, iterations/20)
+    print "memfd_create: %s"%("yes" if cmd_exec._memfd_create is not None else "no, unlinked temporary files")
+    named = bench("named", lambda: tempfile.NamedTemporaryFile(dir=args.tmpdir), outputs, args.run_tool, iterations)
+    memory = bench("memfile", cmd_exec.MemFile, outputs, args.run_tool, iterations)
+    print "memfile takes %.2fx the time of named files"%(memory/named)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,186 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2019 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+import ConfigParser
+import os
+import random
+import threading
+import time
+
+import common
+import keylime_logging
+
+logger = keylime_logging.init_logging('circuit_breaker')
+
+# setup config
+config = ConfigParser.SafeConfigParser()
+config.read(common.CONFIG_FILE)
+
+# Retry pacing for the verifier's connections to agents.
+#
+# Retries back off exponentially with jitter so agents that lost contact together
+# don't retry together.  On top of that each agent and each subnet has a circuit
+# breaker: after enough consecutive connection failures it opens and attempts are
+# held back for a cooldown, then a single probe is let through (half open).  A
+# successful probe closes the breaker, a failed one reopens it with a longer cooldown.
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def backoff(base, attempt, max_delay):
+    """Delay before retry number attempt (counting from 0): uniformly random between
+    base and base*2^attempt, capped at max_delay."""
+    ceiling = min(max_delay, base * (2 ** min(attempt, 32)))
+    return random.uniform(base, max(base, ceiling))
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, threshold, cooldown, max_cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        # key : {state, failures, cooldown, open_until, probe_started}
+        self.circuits = {}
+
+    def state(self, key):
+        circuit = self.circuits.get(key)
+        if circuit is None:
+            return CLOSED
+        return circuit['state']
+
+    def wait_time(self, key, now=None):
+        """Seconds until key may be tried again, 0 if it may be tried now."""
+        circuit = self.circuits.get(key)
+        if circuit is None or circuit['state'] == CLOSED:
+            return 0
+        if now is None:
+            now = time.time()
+        if circuit['state'] == OPEN:
+            return max(0, circuit['open_until'] - now)
+        # half open, one probe at a time.  give up on a probe that never reported back
+        if circuit['probe_started'] is not None and now - circuit['probe_started'] < circuit['cooldown']:
+            return circuit['probe_started'] + circuit['cooldown'] - now
+        return 0
+
+    def begin(self, key, now=None):
+        """Call when an attempt allowed by wait_time is made."""
+        circuit = self.circuits.get(key)
+        if circuit is None or circuit['state'] == CLOSED:
+            return
+        if now is None:
+            now = time.time()
+        if circuit['state'] == OPEN:
+            circuit['state'] = HALF_OPEN
+            logger.info("Probing %s after %.1f s"%(key, circuit['cooldown']))
+        circuit['probe_started'] = now
+
+    def success(self, key):
+        circuit = self.circuits.pop(key, None)
+        if circuit is not None and circuit['state'] != CLOSED:
+            logger.info("Connection to %s recovered, closing circuit"%key)
+
+    def failure(self, key, now=None):
+        if now is None:
+            now = time.time()
+        circuit = self.circuits.setdefault(key, {'state': CLOSED, 'failures': 0, 'cooldown': self.cooldown,
+                                                 'open_until': 0, 'probe_started': None})
+        circuit['failures'] += 1
+        if circuit['state'] == HALF_OPEN:
+            circuit['cooldown'] = min(self.max_cooldown, circuit['cooldown']*2)
+        elif circuit['state'] == CLOSED and circuit['failures'] < self.threshold:
+            return
+        if circuit['state'] == CLOSED:
+            logger.warning("%d consecutive connection failures to %s, pausing attempts for %.1f s"%(circuit['failures'], key, circuit['cooldown']))
+        circuit['state'] = OPEN
+        circuit['probe_started'] = None
+        circuit['open_until'] = now + circuit['cooldown']
+
+
+def subnet_of(ip, prefix):
+    """The IPv4 subnet of ip with the given prefix length, or ip itself if it is not a
+    dotted quad."""
+    parts = ip.split('.')
+    if len(parts) != 4:
+        return ip
+    try:
+        addr = 0
+        for part in parts:
+            addr = (addr << 8) | int(part)
+    except ValueError:
+        return ip
+    mask = (0xffffffff << (32 - prefix)) & 0xffffffff
+    addr &= mask
+    return "%d.%d.%d.%d/%d"%(addr >> 24, (addr >> 16) & 0xff, (addr >> 8) & 0xff, addr & 0xff, prefix)
+
+
+class AgentBreakers(object):
+    """A breaker per agent address and one per subnet.  An attempt is allowed only if
+    both allow it."""
+
+    def __init__(self, agent_threshold, subnet_threshold, subnet_prefix, cooldown, max_cooldown):
+        self.subnet_prefix = subnet_prefix
+        self.agents = CircuitBreaker(agent_threshold, cooldown, max_cooldown)
+        self.subnets = CircuitBreaker(subnet_threshold, cooldown, max_cooldown)
+        self.pid = os.getpid()
+
+    def __keys(self, ip, port):
+        return "%s:%s"%(ip, port), subnet_of(ip, self.subnet_prefix)
+
+    def try_begin(self, ip, port, now=None):
+        """Returns 0 and records the attempt if ip:port may be contacted now, otherwise
+        the number of seconds to wait."""
+        if now is None:
+            now = time.time()
+        agent_key, subnet_key = self.__keys(ip, port)
+        wait = max(self.agents.wait_time(agent_key, now), self.subnets.wait_time(subnet_key, now))
+        if wait > 0:
+            return wait
+        self.agents.begin(agent_key, now)
+        self.subnets.begin(subnet_key, now)
+        return 0
+
+    def success(self, ip, port):
+        agent_key, subnet_key = self.__keys(ip, port)
+        self.agents.success(agent_key)
+        self.subnets.success(subnet_key)
+
+    def failure(self, ip, port, now=None):
+        agent_key, subnet_key = self.__keys(ip, port)
+        self.agents.failure(agent_key, now)
+        self.subnets.failure(subnet_key, now)
+
+
+__breakers = None
+__breakers_lock = threading.Lock()
+
+def get_breakers():
+    """Returns the breakers for this process."""
+    global __breakers
+    with __breakers_lock:
+        if __breakers is None or __breakers.pid != os.getpid():
+            __breakers = AgentBreakers(config.getint('cloud_verifier','breaker_agent_threshold'),
+                                       config.getint('cloud_verifier','breaker_subnet_threshold'),
+                                       config.getint('cloud_verifier','breaker_subnet_prefix'),
+                                       config.getfloat('cloud_verifier','breaker_cooldown'),
+                                       config.getfloat('cloud_verifier','breaker_max_cooldown'))
+        return __breakers
@@ -25,12 +25,10 @@ import keylime_logging
 logger = keylime_logging.init_logging('cloudagent')
 
 
-import BaseHTTPServer
-from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
-from SocketServer import ThreadingMixIn
 import threading
-from urlparse import urlparse
 import json
+import traceback
+import math
 import base64
 import ConfigParser
 import uuid
@@ -48,7 +46,15 @@ import revocation_notifier
 import importlib
 import shutil
 import tpm_obj
+import ima
+import tpm_executor
+import quote_batch
+import functools
 from tpm_abstract import TPM_Utilities
+import tornado.ioloop
+import tornado.web
+import tornado.httpserver
+from tornado import gen
 
 
 # read the config file
@@ -63,25 +69,125 @@ tpm_version = tpm.get_tpm_version()
 uvLock = threading.Lock()
 
 
-class Handler(BaseHTTPRequestHandler):
-    parsed_path = '' 
+def create_quote_responses(server, quote_type, nonce, pcrmask, vpcrmask, requests):
+    """Runs on a TPM executor thread: creates one quote and returns (response, IMA
+    measurement list chunks) for each of the quote requests (ima_ml_entry, partial) it
+    answers.  If the IMA PCR is in the mask, the chunks yield the list from entry 
+    ima_ml_entry on as it is read, to be streamed out as response['ima_measurement_list'],
+    otherwise they are None."""
+    # identity quotes are always shallow
+    hash_alg = tpm.defaults['hash']
+    if not tpm.is_vtpm() or quote_type=='identity':
+        quote = tpm.create_quote(nonce, server.rsapublickey_exportable, pcrmask, hash_alg)
+        imaMask = pcrmask
+    else:
+        quote = tpm.create_deep_quote(nonce, server.rsapublickey_exportable, vpcrmask, pcrmask)
+        imaMask = vpcrmask
+    
+    responses = []
+    for ima_ml_entry, partial in requests:
+        # Allow for a partial quote response (without pubkey) 
+        enc_alg = tpm.defaults['encrypt']
+        sign_alg = tpm.defaults['sign']
+        if partial:
+            response = { 
+                'quote': quote, 
+                'tpm_version': tpm_version,
+                'hash_alg': hash_alg,
+                'enc_alg': enc_alg,
+                'sign_alg': sign_alg,
+                }
+        else:
+            response = {
+                'quote': quote, 
+                'tpm_version': tpm_version,
+                'hash_alg': hash_alg,
+                'enc_alg': enc_alg,
+                'sign_alg': sign_alg,
+                'pubkey': server.rsapublickey_exportable, 
+            }
+        
+        # return a measurement list if available
+        ml_chunks = None
+        if TPM_Utilities.check_mask(imaMask, common.IMA_PCR):
+            binary = config.getboolean('cloud_agent','ima_ml_binary') and common.IMA_ML_BIN is not None and os.path.exists(common.IMA_ML_BIN)
+            ml_path = (common.IMA_ML, common.IMA_ML_BIN)[binary]
+            if not os.path.exists(ml_path):
+                logger.warn("IMA measurement list not available: %s"%(ml_path))
+            else:
+                # only send what the verifier hasn't seen yet
+                ml_chunks, nth_entry = ima.open_measurement_list(ml_path, ima_ml_entry, binary)
+                if binary:
+                    ml_chunks = ima.encode_binary_chunks(ml_chunks)
+                    response['ima_ml_format']=ima.ML_FORMAT_BINARY
+                response['ima_ml_entry']=nth_entry
+        responses.append((response, ml_chunks))
+    return responses
+
+def run_quote_batch(server, key, nonce, requests):
+    """Submits the quote for a batch of quote requests with the same key to the TPM
+    executor, raises QueueFull if too many quotes are waiting already."""
+    quote_type, pcrmask, vpcrmask = key
+    # verifiers polling for integrity go ahead of tenants
+    job_class = (tpm_executor.IDENTITY, tpm_executor.INTEGRITY)[quote_type == 'integrity']
+    return tpm_executor.get_executor().try_submit(job_class, create_quote_responses, server, quote_type, nonce, pcrmask, vpcrmask, requests)
+
+def log_failure(future):
+    """Logs the exception of a TPM job nobody waits for."""
+    try:
+        future.result()
+    except Exception as e:
+        logger.exception(e)
+
+
+class BaseHandler(tornado.web.RequestHandler):
+
+    def write_error(self, status_code, **kwargs):
+
+        self.set_header('Content-Type', 'text/json')
+        if self.settings.get("serve_traceback") and "exc_info" in kwargs:
+            # in debug mode, try to send a traceback
+            lines = []
+            for line in traceback.format_exception(*kwargs["exc_info"]):
+                lines.append(line)
+            self.finish(json.dumps({
+                'code': status_code,
+                'status': self._reason,
+                'traceback': lines,
+                'results': {},
+            }))
+        else:
+            self.finish(json.dumps({
+                'code': status_code,
+                'status': self._reason,
+                'results': {},
+            }))
+
+
+class Handler(BaseHandler):
+    server = None
     
-    def do_HEAD(self):
+    def initialize(self, server):
+        self.server = server
+    
+    def head(self):
         """Not supported"""
         common.echo_json_response(self, 405, "HEAD not supported")
 
-    def do_GET(self):
+    @gen.coroutine
+    def get(self):
         """This method services the GET request typically from either the Tenant or the Cloud Verifier.
         
         Only tenant and cloudverifier uri's are supported. Both requests require a nonce parameter.  
         The Cloud verifier requires an additional mask paramter.  If the uri or parameters are incorrect, a 400 response is returned.
+        /tpm_queue returns how much TPM work of each class is queued and how long it waited.
         """
         
-        logger.info('GET invoked from ' + str(self.client_address)  + ' with uri:' + self.path)
+        logger.info('GET invoked from ' + str(self.request.remote_ip)  + ' with uri:' + self.request.uri)
         
-        rest_params = common.get_restful_params(self.path)
+        rest_params = common.get_restful_params(self.request.uri)
         if rest_params is None:
-            common.echo_json_response(self, 405, "Not Implemented: Use /keys/ or /quotes/ interfaces")
+            common.echo_json_response(self, 405, "Not Implemented: Use /keys/, /quotes/ or /tpm_queue interfaces")
             return
         
         if "keys" in rest_params and rest_params['keys']=='verify':
@@ -108,6 +214,7 @@ class Handler(BaseHTTPRequestHandler):
             nonce = rest_params['nonce']
             pcrmask = rest_params['mask'] if 'mask' in rest_params else None
             vpcrmask = rest_params['vmask'] if 'vmask' in rest_params else None
+            ima_ml_entry = rest_params['ima_ml_entry'] if 'ima_ml_entry' in rest_params else '0'
             
             # if the query is not messed up
             if nonce is None:
@@ -116,96 +223,81 @@ class Handler(BaseHTTPRequestHandler):
                 return
             
             # Sanitization assurance (for tpm.run() tasks below) 
-            if not (nonce.isalnum() and (pcrmask is None or pcrmask.isalnum()) and (vpcrmask is None or vpcrmask.isalnum())):
+            if not (nonce.isalnum() and (pcrmask is None or pcrmask.isalnum()) and (vpcrmask is None or vpcrmask.isalnum()) and ima_ml_entry.isdigit()):
                 logger.warning('GET quote returning 400 response. parameters should be strictly alphanumeric')
                 common.echo_json_response(self, 400, "parameters should be strictly alphanumeric")
                 return
             
-            # identity quotes are always shallow
-            hash_alg = tpm.defaults['hash']
-            if not tpm.is_vtpm() or rest_params["quotes"]=='identity':
-                quote = tpm.create_quote(nonce, self.server.rsapublickey_exportable, pcrmask, hash_alg)
-                imaMask = pcrmask
-            else:
-                quote = tpm.create_deep_quote(nonce, self.server.rsapublickey_exportable, vpcrmask, pcrmask)
-                imaMask = vpcrmask
-            
-            # Allow for a partial quote response (without pubkey) 
-            enc_alg = tpm.defaults['encrypt']
-            sign_alg = tpm.defaults['sign']
-            if "partial" in rest_params and (rest_params["partial"] is None or int(rest_params["partial"],0) == 1):
-                response = { 
-                    'quote': quote, 
-                    'tpm_version': tpm_version,
-                    'hash_alg': hash_alg,
-                    'enc_alg': enc_alg,
-                    'sign_alg': sign_alg,
-                    }
-            else:
-                response = {
-                    'quote': quote, 
-                    'tpm_version': tpm_version,
-                    'hash_alg': hash_alg,
-                    'enc_alg': enc_alg,
-                    'sign_alg': sign_alg,
-                    'pubkey': self.server.rsapublickey_exportable, 
-                }
+            partial = "partial" in rest_params and (rest_params["partial"] is None or int(rest_params["partial"],0) == 1)
+            key = (rest_params["quotes"], pcrmask, vpcrmask)
+            try:
+                (response, ml_chunks), proof = yield self.server.quote_batcher.request(key, nonce, (int(ima_ml_entry), partial))
+            except tpm_executor.QueueFull as e:
+                logger.warning('GET quote returning 503 response. %s'%e)
+                job_class = (tpm_executor.IDENTITY, tpm_executor.INTEGRITY)[rest_params["quotes"] == 'integrity']
+                self.set_header('Retry-After', str(int(math.ceil(max(tpm_executor.get_executor().wait_estimate(job_class),1)))))
+                common.echo_json_response(self, 503, "TPM busy, try again later")
+                return
             
-            # return a measurement list if available
-            if TPM_Utilities.check_mask(imaMask, common.IMA_PCR):
-                if not os.path.exists(common.IMA_ML):
-                    logger.warn("IMA measurement list not available: %s"%(common.IMA_ML))
-                else:
-                    with open(common.IMA_ML,'r') as f:
-                        ml = f.read()
-                    response['ima_measurement_list']=ml
+            # a quote over the nonces of several requests, with the proof that this 
+            # nonce is one of them
+            if proof is not None:
+                response['quote'] += ":" + proof
             
-            common.echo_json_response(self, 200, "Success", response)
+            if ml_chunks is None:
+                common.echo_json_response(self, 200, "Success", response)
+            else:
+                # the measurement list goes out as it is read from disk, off of the IOLoop
+                yield common.echo_json_response_stream(self, 200, "Success", response, 'ima_measurement_list', ml_chunks, common.read_chunk)
             logger.info('GET %s quote returning 200 response.'%(rest_params["quotes"]))
             return
         
+        elif "tpm_queue" in rest_params:
+            stats = tpm_executor.get_executor().get_stats()
+            stats['quote_batches'] = self.server.quote_batcher.get_stats()
+            common.echo_json_response(self, 200, "Success", stats)
+            return
+        
         else:
-            logger.warning('GET returning 400 response. uri not supported: ' + self.path)
+            logger.warning('GET returning 400 response. uri not supported: ' + self.request.path)
             common.echo_json_response(self, 400, "uri not supported")
             return
         
 
-    def do_POST(self):
+    def post(self):
         """This method services the POST request typically from either the Tenant or the Cloud Verifier.
         
         Only tenant and cloudverifier uri's are supported. Both requests require a nonce parameter.  
         The Cloud verifier requires an additional mask parameter.  If the uri or parameters are incorrect, a 400 response is returned.
         """        
-        rest_params = common.get_restful_params(self.path)
+        rest_params = common.get_restful_params(self.request.uri)
         if rest_params is None:
             common.echo_json_response(self, 405, "Not Implemented: Use /keys/ interface")
             return
         
-        content_length = int(self.headers.get('Content-Length', 0))
-        if content_length <= 0:
-            logger.warning('POST returning 400 response, expected content in message. url:  ' + self.path)
+        if len(self.request.body) == 0:
+            logger.warning('POST returning 400 response, expected content in message. url:  ' + self.request.path)
             common.echo_json_response(self, 400, "expected content in message")
             return
         
-        post_body = self.rfile.read(content_length)
-        json_body = json.loads(post_body)
+        json_body = json.loads(self.request.body)
             
         b64_encrypted_key = json_body['encrypted_key']
         decrypted_key = crypto.rsa_decrypt(self.server.rsaprivatekey,base64.b64decode(b64_encrypted_key))
         
         have_derived_key = False
 
-        if rest_params["keys"] == "ukey":
+        if rest_params.get("keys") == "ukey":
             self.server.add_U(decrypted_key)
             self.server.auth_tag = json_body['auth_tag']
             self.server.payload = json_body.get('payload',None)
             
             have_derived_key = self.server.attempt_decryption(self)
-        elif rest_params["keys"] == "vkey":
+        elif rest_params.get("keys") == "vkey":
             self.server.add_V(decrypted_key)
             have_derived_key = self.server.attempt_decryption(self)
         else:
-            logger.warning('POST returning  response. uri not supported: ' + self.path)
+            logger.warning('POST returning  response. uri not supported: ' + self.request.path)
             common.echo_json_response(self, 400, "uri not supported")
             return
         logger.info('POST of %s key returning 200'%(('V','U')[rest_params["keys"] == "ukey"]))
@@ -215,6 +307,90 @@ class Handler(BaseHTTPRequestHandler):
         if not have_derived_key:
             return
         
+        # writes to the TPM, and must not be turned away
+        future = tpm_executor.get_executor().submit(tpm_executor.KEYS, self.server.process_derived_key)
+        tornado.ioloop.IOLoop.current().add_future(future, log_failure)
+
+class CloudAgentServer(object):
+    """The state of the cloud agent shared by its request handlers.  Requests are 
+    handled on the tornado IOLoop and TPM work is done by the tpm_executor threads."""
+   
+    ''' Do not modify directly unless you acquire uvLock. Set chosen for uniqueness of contained values''' 
+    u_set = set([])
+    v_set = set([])
+    
+    rsaprivatekey = None
+    rsapublickey = None
+    rsapublickey_exportable = None
+    done = threading.Event()
+    auth_tag = None
+    payload = None
+    enc_keyname = None
+    K = None
+    final_U = None
+    agent_uuid = None
+    
+    def __init__(self, agent_uuid):
+        secdir = secure_mount.mount()
+        keyname = "%s/%s"%(secdir,config.get('cloud_agent','rsa_keyname'))
+        
+        # read or generate the key depending on configuration
+        if os.path.isfile(keyname):
+            # read in private key
+            logger.debug( "Using existing key in %s"%keyname)
+            f = open(keyname,"r")
+            rsa_key = crypto.rsa_import_privkey(f.read())
+        else:
+            logger.debug("key not found, generating a new one")
+            rsa_key = crypto.rsa_generate(2048)
+            with open(keyname,"w") as f:
+                f.write(crypto.rsa_export_privkey(rsa_key))
+        
+        self.rsaprivatekey = rsa_key
+        self.rsapublickey_exportable = crypto.rsa_export_pubkey(self.rsaprivatekey)
+        
+        #attempt to get a U value from the TPM NVRAM
+        nvram_u = tpm.read_key_nvram()
+        if nvram_u is not None:
+            logger.info("Existing U loaded from TPM NVRAM")
+            self.add_U(nvram_u)
+        self.enc_keyname = config.get('cloud_agent','enc_keyname')
+        self.agent_uuid = agent_uuid
+        
+        # only TPM 2.0 quotes can be checked against a Merkle root of nonces
+        window = config.getfloat('cloud_agent','quote_batch_window')
+        if window > 0 and (tpm_version != 2 or tpm.is_vtpm()):
+            logger.warning("quote_batch_window is only supported with a TPM 2.0, not batching quotes")
+            window = 0
+        self.quote_batcher = quote_batch.QuoteBatcher(window, config.getint('cloud_agent','quote_batch_max'), functools.partial(run_quote_batch, self))
+
+
+    def add_U(self, u):
+        """Threadsafe method for adding a U value received from the Tenant
+        
+        Do not modify u_set of v_set directly.
+        """
+        with uvLock:
+            # be very careful printing K, U, or V as they leak in logs stored on unprotected disks
+            if common.INSECURE_DEBUG:
+                logger.debug( "Adding U len %d data:%s"%(len(u),base64.b64encode(u)))
+            self.u_set.add(u)
+
+        
+    def add_V(self, v):
+        """Threadsafe method for adding a U value received from the Cloud Verifier
+        
+        Do not modify u_set of v_set directly.        
+        """
+        with uvLock:
+            # be very careful printing K, U, or V as they leak in logs stored on unprotected disks
+            if common.INSECURE_DEBUG:
+                logger.debug( "Adding V: " + base64.b64encode(v))
+            self.v_set.add(v)
+
+    def process_derived_key(self):
+        """Runs on a TPM executor thread once K has been derived: writes out the key, 
+        stores U in the TPM NVRAM, decrypts the payload and optionally measures it."""
         # woo hoo we have a key 
         # ok lets write out the key now
         secdir = secure_mount.mount() # confirm that storage is still securely mounted
@@ -224,15 +400,15 @@ class Handler(BaseHTTPRequestHandler):
             shutil.rmtree("%s/unzipped"%secdir)
         
         # write out key file
-        f = open(secdir+"/"+self.server.enc_keyname,'w')
-        f.write(base64.b64encode(self.server.K))
+        f = open(secdir+"/"+self.enc_keyname,'w')
+        f.write(base64.b64encode(self.K))
         f.close()
         
         #stow the U value for later
-        tpm.write_key_nvram(self.server.final_U)
+        tpm.write_key_nvram(self.final_U)
         
         # optionally extend a hash of they key and payload into specified PCR
-        tomeasure = self.server.K
+        tomeasure = self.K
         
         # if we have a good key, now attempt to write out the encrypted payload
         dec_path = "%s/%s"%(secdir, config.get('cloud_agent',"dec_payload_file"))
@@ -241,15 +417,15 @@ class Handler(BaseHTTPRequestHandler):
         dec_payload = None
         enc_payload = None
         
-        if self.server.payload is not None:
-            dec_payload = crypto.decrypt(self.server.payload, str(self.server.K))
-            enc_payload = self.server.payload
+        if self.payload is not None:
+            dec_payload = crypto.decrypt(self.payload, str(self.K))
+            enc_payload = self.payload
         elif os.path.exists(enc_path):
             # if no payload provided, try to decrypt one from a previous run stored in encrypted_payload
             with open(enc_path,'r') as f:
                 enc_payload = f.read()
             try:
-                dec_payload = crypto.decrypt(enc_payload,str(self.server.K))
+                dec_payload = crypto.decrypt(enc_payload,str(self.K))
                 logger.info("Decrypted previous payload in %s to %s"%(enc_path,dec_path))
             except Exception as e:
                 logger.warning("Unable to decrypt previous payload %s with derived key: %s"%(enc_path,e))
@@ -259,7 +435,7 @@ class Handler(BaseHTTPRequestHandler):
         # also write out encrypted payload to be decrytped next time
         if enc_payload is not None:
             with open(enc_path,'w') as f:
-                f.write(self.server.payload)
+                f.write(self.payload)
 
         # deal with payload
         payload_thread = None
@@ -278,7 +454,7 @@ class Handler(BaseHTTPRequestHandler):
                     def initthread():
                         import subprocess
                         env = os.environ.copy()
-                        env['AGENT_UUID']=self.server.agent_uuid
+                        env['AGENT_UUID']=self.agent_uuid
                         proc= subprocess.Popen(["/bin/bash",initscript],env=env,shell=False,cwd='%s/unzipped'%secdir,
                                                 stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
                         while True:
@@ -310,101 +486,7 @@ class Handler(BaseHTTPRequestHandler):
             
         if payload_thread is not None:
             payload_thread.start()
-            
-        return
 
-    def get_query_tag_value(self, path, query_tag):
-        """This is a utility method to query for specific the http parameters in the uri.  
-        
-        Returns the value of the parameter, or None if not found."""  
-        data = { }
-        parsed_path = urlparse(self.path)
-        query_tokens = parsed_path.query.split('&')
-        # find the 'ids' query, there can only be one
-        for tok in query_tokens:
-            query_tok = tok.split('=')
-            query_key = query_tok[0]
-            if query_key is not None and query_key == query_tag:
-                # ids tag contains a comma delimited list of ids
-                data[query_tag] = query_tok[1]    
-                break        
-        return data.get(query_tag,None) 
-    
-    def log_message(self, logformat, *args):
-        return
-                
-#consider using PooledProcessMixIn
-# https://github.com/muayyad-alsadi/python-PooledProcessMixIn
-class CloudAgentHTTPServer(ThreadingMixIn, HTTPServer):
-    """Http Server which will handle each request in a separate thread."""
-   
-    ''' Do not modify directly unless you acquire uvLock. Set chosen for uniqueness of contained values''' 
-    u_set = set([])
-    v_set = set([])
-    
-    rsaprivatekey = None
-    rsapublickey = None
-    rsapublickey_exportable = None
-    done = threading.Event()
-    auth_tag = None
-    payload = None
-    enc_keyname = None
-    K = None
-    final_U = None
-    agent_uuid = None
-    
-    def __init__(self, server_address, RequestHandlerClass, agent_uuid):
-        """Constructor overridden to provide ability to pass configuration arguments to the server"""
-        secdir = secure_mount.mount()
-        keyname = "%s/%s"%(secdir,config.get('cloud_agent','rsa_keyname'))
-        
-        # read or generate the key depending on configuration
-        if os.path.isfile(keyname):
-            # read in private key
-            logger.debug( "Using existing key in %s"%keyname)
-            f = open(keyname,"r")
-            rsa_key = crypto.rsa_import_privkey(f.read())
-        else:
-            logger.debug("key not found, generating a new one")
-            rsa_key = crypto.rsa_generate(2048)
-            with open(keyname,"w") as f:
-                f.write(crypto.rsa_export_privkey(rsa_key))
-        
-        self.rsaprivatekey = rsa_key
-        self.rsapublickey_exportable = crypto.rsa_export_pubkey(self.rsaprivatekey)
-        
-        #attempt to get a U value from the TPM NVRAM
-        nvram_u = tpm.read_key_nvram()
-        if nvram_u is not None:
-            logger.info("Existing U loaded from TPM NVRAM")
-            self.add_U(nvram_u)
-        BaseHTTPServer.HTTPServer.__init__(self, server_address, RequestHandlerClass)
-        self.enc_keyname = config.get('cloud_agent','enc_keyname')
-        self.agent_uuid = agent_uuid
-
-
-    def add_U(self, u):
-        """Threadsafe method for adding a U value received from the Tenant
-        
-        Do not modify u_set of v_set directly.
-        """
-        with uvLock:
-            # be very careful printing K, U, or V as they leak in logs stored on unprotected disks
-            if common.INSECURE_DEBUG:
-                logger.debug( "Adding U len %d data:%s"%(len(u),base64.b64encode(u)))
-            self.u_set.add(u)
-
-        
-    def add_V(self, v):
-        """Threadsafe method for adding a U value received from the Cloud Verifier
-        
-        Do not modify u_set of v_set directly.        
-        """
-        with uvLock:
-            # be very careful printing K, U, or V as they leak in logs stored on unprotected disks
-            if common.INSECURE_DEBUG:
-                logger.debug( "Adding V: " + base64.b64encode(v))
-            self.v_set.add(v)
 
     def attempt_decryption(self, handler):
         """On reception of a U or V value, this method is called to attempt the decryption of the Cloud Init script
@@ -536,12 +618,22 @@ def main(argv=sys.argv):
     if not retval:
         raise Exception("Registration failed on activate")
     
-    serveraddr = ('', config.getint('general', 'cloudagent_port'))
-    server = CloudAgentHTTPServer(serveraddr,Handler,agent_uuid)
-    serverthread = threading.Thread(target=server.serve_forever)
+    port = config.getint('general', 'cloudagent_port')
+    server = CloudAgentServer(agent_uuid)
+    # compress responses, mostly measurement lists, for clients that accept it
+    transforms = []
+    if config.getboolean('cloud_agent','compress_responses'):
+        transforms.append(common.CompressContentEncoding)
+    app = tornado.web.Application([
+        (r".*", Handler, {'server':server}),
+        ], transforms=transforms)
+    # keep-alive connections from verifiers polling the agent are kept until idle
+    http_server = tornado.httpserver.HTTPServer(app, idle_connection_timeout=config.getint('cloud_agent','keepalive_timeout'))
+    http_server.listen(port)
+    # start the TPM workers
+    tpm_executor.get_executor()
 
-    logger.info( 'Starting Cloud Agent on port %s use <Ctrl-C> to stop'%serveraddr[1])
-    serverthread.start()
+    logger.info( 'Starting Cloud Agent on port %s use <Ctrl-C> to stop'%port)
     
     # want to listen for revocations?
     if config.getboolean('cloud_agent','listen_notfications'):
@@ -585,7 +677,8 @@ def main(argv=sys.argv):
                     execute(revocation)
                 except Exception as e:
                     logger.warn("Exception during execution of revocation action %s: %s"%(action,e))
-        try:
+        
+        def listen_revocations():
             while True:
                 try:
                     revocation_notifier.await_notifications(perform_actions,revocation_cert_path=cert_path)
@@ -593,18 +686,18 @@ def main(argv=sys.argv):
                     logger.exception(e)
                     logger.warn("No connection to revocation server, retrying in 10s...")
                     time.sleep(10)
-        except KeyboardInterrupt:
-            logger.info("TERM Signal received, shutting down...")
-            tpm.flush_keys()
-            server.shutdown()
-    else:  
-        try:
-            while True:
-                time.sleep(1)
-        except KeyboardInterrupt:
-            logger.info("TERM Signal received, shutting down...")
-            tpm.flush_keys()
-            server.shutdown()
+        revocation_thread = threading.Thread(target=listen_revocations)
+        revocation_thread.daemon = True
+        revocation_thread.start()
+    
+    try:
+        tornado.ioloop.IOLoop.instance().start()
+    except KeyboardInterrupt:
+        logger.info("TERM Signal received, shutting down...")
+        http_server.stop()
+        tornado.ioloop.IOLoop.instance().stop()
+        tpm_executor.get_executor().shutdown()
+        tpm.flush_keys()
 
 if __name__=="__main__":
     try:
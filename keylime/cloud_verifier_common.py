@@ -37,6 +37,9 @@ import revocation_notifier
 import keylime_sqlite
 import ConfigParser
 import tpm_obj
+import ima
+import quote_batch
+import whitelist_store
 from tpm_abstract import TPM_Utilities, Hash_Algorithms, Encrypt_Algorithms, Sign_Algorithms
 
 
@@ -156,10 +159,44 @@ def init_mtls(section='cloud_verifier',generatedir='cv_ca'):
     context.verify_mode = ssl.CERT_REQUIRED
     return context
 
+# registrar keys of the agents polled by this process, see get_registrar_keys
+registrar_key_cache = None
+
+def get_registrar_key_cache():
+    global registrar_key_cache
+    if registrar_key_cache is None:
+        registrar_key_cache = registrar_client.KeyCache(config.getfloat('cloud_verifier','registrar_cache_ttl'))
+    return registrar_key_cache
+
+def fetch_registrar_keys(agent_id):
+    registrar_client.init_client_tls(config,'cloud_verifier')
+    return registrar_client.getKeysAsync(config.get("general","registrar_ip"),config.get("general","registrar_tls_port"),agent_id,
+                                         config.getint('cloud_verifier','registrar_max_clients'))
+
+def get_registrar_keys(agent_id):
+    """Returns a Future for the registrar keys of an agent without blocking the IOLoop.
+    Keys are cached and refreshed from the registrar per registrar_cache_ttl and
+    common.MAX_STALE_REGISTRAR_CACHE."""
+    return get_registrar_key_cache().get_async(agent_id, fetch_registrar_keys)
+
+def invalidate_registrar_keys(agent_id):
+    get_registrar_key_cache().invalidate(agent_id)
+
 def process_quote_response(agent, json_response):
     """Validates the response from the Cloud agent.
     
-    This method invokes an Registrar Server call to register, and then check the quote. 
+    The agent's registrar_keys have to be fetched with get_registrar_keys() first.
+    """
+    job = prepare_quote_check(agent, json_response)
+    if not job:
+        return job
+    return finish_quote_check(agent, job, check_quote(job))
+
+def prepare_quote_check(agent, json_response):
+    """Parses the agent response and gathers everything needed to check the quote.
+    
+    Returns a picklable job for check_quote() or None/False if the response could not be 
+    checked.  The agent is only updated with the negotiated TPM algorithms here.
     """
     received_public_key = None
     quote = None
@@ -170,14 +207,41 @@ def process_quote_response(agent, json_response):
         quote = json_response["quote"]
         
         ima_measurement_list = json_response.get("ima_measurement_list",None)
+        # agents that don't support incremental lists always send all of it
+        ima_ml_entry = int(json_response.get("ima_ml_entry",0))
+        ima_ml_format = json_response.get("ima_ml_format",ima.ML_FORMAT_ASCII)
+        if ima_ml_format not in [ima.ML_FORMAT_ASCII,ima.ML_FORMAT_BINARY]:
+            logger.error("unsupported IMA measurement list format: %s"%ima_ml_format)
+            return False
         
         logger.debug("received quote:      %s"%quote)
         logger.debug("for nonce:           %s"%agent['nonce'])
         logger.debug("received public key: %s"%received_public_key)
         logger.debug("received ima_measurement_list    %s"%(ima_measurement_list!=None))
+        logger.debug("starting at ima_ml_entry         %d"%ima_ml_entry)
     except Exception:
         return None
     
+    # agents batching quote requests quote over a Merkle root of several nonces and 
+    # send the proof that ours is one of them, which tpm.check_quote() folds back into
+    # the root.  turn away malformed proofs before getting the registrar keys
+    quote_tokens = quote.split(":")
+    if len(quote_tokens) > 3:
+        try:
+            proof = quote_batch.decode_proof(quote_tokens[3])
+        except Exception as e:
+            logger.error("agent sent a batched quote with a malformed nonce proof: %s"%e)
+            return False
+        logger.debug("quote is batched, nonce proof of %d hashes"%len(proof))
+    
+    # the list either continues where the last verified one ended or starts over
+    ima_state = get_ima_state(agent)
+    ima_state['partial'] = ima_ml_entry != 0
+    ima_state['binary'] = ima_ml_format == ima.ML_FORMAT_BINARY
+    if ima_ml_entry != 0 and ima_ml_entry != ima_state['entry']:
+        logger.error("agent sent IMA measurement list from entry %d, but %d was requested"%(ima_ml_entry,ima_state['entry']))
+        return False
+    
     # if no public key provided, then ensure we have cached it
     if received_public_key is None:
         if agent.get('public_key',"") == "" or agent.get('b64_encrypted_V',"")=="":
@@ -186,16 +250,12 @@ def process_quote_response(agent, json_response):
         agent['provide_V'] = False
         received_public_key = agent['public_key']
     
+    # fetched with get_registrar_keys before getting here, never with a blocking request
     if agent.get('registrar_keys',"") is "":
-        registrar_client.init_client_tls(config,'cloud_verifier')
-        registrar_keys = registrar_client.getKeys(config.get("general","registrar_ip"),config.get("general","registrar_tls_port"),agent['agent_id'])
-        if registrar_keys is None:
-            logger.warning("AIK not found in registrar, quote not validated")
-            return False
-        agent['registrar_keys']  = registrar_keys
+        logger.error("registrar keys of agent %s were not fetched, quote not validated"%agent['agent_id'])
+        return False
         
     tpm_version = json_response.get('tpm_version')
-    tpm = tpm_obj.getTPM(need_hw_tpm=False,tpm_version=tpm_version)
     hash_alg = json_response.get('hash_alg')
     enc_alg = json_response.get('enc_alg')
     sign_alg = json_response.get('sign_alg')
@@ -218,40 +278,238 @@ def process_quote_response(agent, json_response):
     if not Sign_Algorithms.is_accepted(sign_alg, agent['accept_tpm_signing_algs']):
         raise Exception("TPM Quote is using an unaccepted signing algorithm: %s"%sign_alg)
     
-    if tpm.is_deep_quote(quote):
-        validQuote = tpm.check_deep_quote(agent['nonce'],
-                                                received_public_key,
-                                                quote,
-                                                agent['registrar_keys']['aik'],
-                                                agent['registrar_keys']['provider_keys']['aik'],
-                                                agent['vtpm_policy'],
-                                                agent['tpm_policy'],
-                                                ima_measurement_list,
-                                                agent['ima_whitelist'])
+    job = {
+        'agent_id': agent['agent_id'],
+        'tpm_version': tpm_version,
+        'nonce': agent['nonce'],
+        'public_key': received_public_key,
+        'quote': quote,
+        'aik': agent['registrar_keys']['aik'],
+        'provider_aik': None,
+        'tpm_policy': agent['tpm_policy'],
+        'vtpm_policy': agent['vtpm_policy'],
+        'ima_measurement_list': ima_measurement_list,
+        'ima_whitelist': None,
+        'ima_whitelist_ref': None,
+        'ima_state': ima_state,
+        'hash_alg': hash_alg,
+        }
+    if agent['registrar_keys'].get('provider_keys') is not None:
+        job['provider_aik'] = agent['registrar_keys']['provider_keys'].get('aik')
+    job['ima_whitelist_ref'],job['ima_whitelist'] = get_job_whitelist(agent)
+    return job
+
+def check_quote(job):
+    """Checks a quote prepared by prepare_quote_check().
+    
+    This is the expensive part of quote verification and does not touch any verifier 
+    state, so it is safe to run in a verification_executor worker process.  Returns 
+    {'valid': bool, 'ima_state': where the next IMA measurement list should start,
+    'ima_failures': ima.FailureSummary.to_dict() of a failed measurement list or None,
+    'ima_pieces': None, or the pieces a large measurement list was split into}.
+    
+    A measurement list is split up if job['ima_state']['chunks'] is set, see 
+    AbstractTPM.__check_ima().  The quote is not checked then, the pieces have to be
+    checked with check_ima_piece() and the quote checked again with the results.
+    """
+    ima_whitelist = acquire_job_whitelist(job)
+    try:
+        return __check_quote(job, ima_whitelist)
+    finally:
+        release_job_whitelist(job)
+
+def __check_quote(job, ima_whitelist):
+    ima_state = job['ima_state']
+    ima_measurement_list = job['ima_measurement_list']
+    if ima_measurement_list is not None and ima_state['binary']:
+        ima_measurement_list = ima.decode_binary_list(ima_measurement_list)
+    tpm = tpm_obj.getTPM(need_hw_tpm=False,tpm_version=job['tpm_version'])
+    if tpm.is_deep_quote(job['quote']):
+        valid = tpm.check_deep_quote(job['nonce'],
+                                    job['public_key'],
+                                    job['quote'],
+                                    job['aik'],
+                                    job['provider_aik'],
+                                    job['vtpm_policy'],
+                                    job['tpm_policy'],
+                                    ima_measurement_list,
+                                    ima_whitelist,
+                                    ima_state=ima_state)
     else:
-        validQuote = tpm.check_quote(agent['nonce'],
-                                           received_public_key,
-                                           quote,
-                                           agent['registrar_keys']['aik'],
-                                           agent['tpm_policy'],
-                                           ima_measurement_list,
-                                           agent['ima_whitelist'],
-                                           hash_alg)
-    if not validQuote:
+        valid = tpm.check_quote(job['nonce'],
+                               job['public_key'],
+                               job['quote'],
+                               job['aik'],
+                               job['tpm_policy'],
+                               ima_measurement_list,
+                               ima_whitelist,
+                               job['hash_alg'],
+                               ima_state=ima_state)
+    ima_state.pop('checked',None)
+    return {'valid': bool(valid), 'ima_state': ima_state, 'ima_failures': ima_state.pop('failures',None), 'ima_pieces': ima_state.pop('pieces',None)}
+
+def get_piece_job(job):
+    """The part of a job from prepare_quote_check() check_ima_piece() needs."""
+    return {
+        'agent_id': job['agent_id'],
+        'ima_whitelist': job['ima_whitelist'],
+        'ima_whitelist_ref': job['ima_whitelist_ref'],
+        'binary': job['ima_state']['binary'],
+        }
+
+def check_ima_piece(piece_job, piece):
+    """Checks a piece of the IMA measurement list check_quote() split up against the 
+    whitelist of piece_job, from get_piece_job().  Returns ima.check_piece() of it.  Like
+    check_quote(), this runs in a verification_executor worker process."""
+    ima_whitelist = acquire_job_whitelist(piece_job)
+    try:
+        return ima.check_piece(piece, piece_job['binary'], ima_whitelist)
+    finally:
+        release_job_whitelist(piece_job)
+
+def needs_full_ima_list(result):
+    """True if check_quote() could not add a partial IMA measurement list up to the PCR
+    value, in which case the quote should be requested again with the full list."""
+    return bool(result) and not result['valid'] and result['ima_state']['resync']
+
+def get_whitelist_version(agent):
+    """The ima.whitelist_version() of the agent's whitelist, cached while the agent keeps 
+    the same whitelist object.  Whitelists in the whitelist store are named by it."""
+    if agent.get('ima_whitelist_ref'):
+        return agent['ima_whitelist_ref']
+    cached = agent.get('ima_whitelist_digest')
+    if cached is None or cached[0] is not agent['ima_whitelist']:
+        cached = (agent['ima_whitelist'], ima.whitelist_version(agent['ima_whitelist']))
+        agent['ima_whitelist_digest'] = cached
+    return cached[1]
+
+def get_job_whitelist(agent):
+    """The (digest, lists) a verification job gets the agent's whitelist by.  Whitelists
+    are sent to the workers by the digest they have in the whitelist store, never
+    pickled along with every job.  Whitelists sent along with an agent are stored
+    inline the first time, until no agent has them anymore (see 
+    remove_inline_whitelists()); lists that aren't a whitelist, like no lists at all,
+    are sent as they are with a digest of None."""
+    if agent.get('ima_whitelist_ref'):
+        return agent['ima_whitelist_ref'],None
+    lists = agent['ima_whitelist']
+    if not isinstance(lists,dict) or 'whitelist' not in lists:
+        return None,lists
+    version = get_whitelist_version(agent)
+    store = whitelist_store.get_store()
+    if agent.get('ima_whitelist_inline') != version or not store.exists(version,True):
+        store.add(lists, version, inline=True)
+        agent['ima_whitelist_inline'] = version
+    return version,None
+
+def acquire_job_whitelist(job):
+    """The compiled lists of a job from get_job_whitelist().  Each worker process
+    compiles, or maps, a whitelist once and keeps it in its whitelist store; lists
+    acquired for a job with a digest have to be released after."""
+    if job['ima_whitelist_ref'] is None:
+        return job['ima_whitelist']
+    lists = whitelist_store.get_store().acquire(job['ima_whitelist_ref'])
+    if lists is None:
+        raise Exception("IMA whitelist %s of agent %s not found"%(job['ima_whitelist_ref'],job['agent_id']))
+    return lists
+
+def release_job_whitelist(job):
+    if job['ima_whitelist_ref'] is not None:
+        whitelist_store.get_store().release(job['ima_whitelist_ref'])
+
+def get_ima_state(agent):
+    """The IMA entries verified for the agent as an ima.new_state().  Entries verified 
+    against a different whitelist don't count."""
+    ima_state = ima.new_state()
+    ima_state['whitelist'] = get_whitelist_version(agent)
+    if agent.get('ima_whitelist_version') == ima_state['whitelist'] and agent.get('ima_running_hash'):
+        ima_state['entry'] = agent.get('ima_ml_entry') or 0
+        ima_state['hash'] = agent['ima_running_hash']
+        ima_state['offset'] = agent.get('ima_ml_offset') or 0
+        ima_state['last'] = agent.get('ima_ml_last') or ""
+    return ima_state
+
+def set_ima_state(agent, ima_state):
+    agent['ima_ml_entry'] = ima_state['entry']
+    agent['ima_running_hash'] = ima_state['hash']
+    agent['ima_ml_offset'] = ima_state['offset']
+    agent['ima_ml_last'] = ima_state['last']
+    agent['ima_whitelist_version'] = ima_state['whitelist']
+
+# columns holding the IMA whitelist of an agent, and what has been verified against it
+IMA_POLICY_COLS = ['ima_whitelist','ima_whitelist_ref','ima_whitelist_inline']
+IMA_STATE_COLS = ['ima_ml_entry','ima_running_hash','ima_ml_offset','ima_ml_last','ima_whitelist_version']
+
+def prepare_ima_policy(json_body):
+    """The IMA_POLICY_COLS for a request body with either an ima_whitelist (possibly
+    JSON encoded, as the tenant sends it) or the ima_whitelist_ref of a whitelist in the
+    whitelist store."""
+    ref = json_body.get('ima_whitelist_ref') or ""
+    if ref != "":
+        check_whitelist_ref(ref)
+        # the shared copy is used
+        return {'ima_whitelist': {}, 'ima_whitelist_ref': ref, 'ima_whitelist_inline': ""}
+    lists = json_body['ima_whitelist']
+    if isinstance(lists,basestring):
+        lists = json.loads(lists)
+    inline = ""
+    if lists:
+        whitelist_store.check_lists(lists)
+        inline = ima.whitelist_version(lists)
+    return {'ima_whitelist': lists, 'ima_whitelist_ref': "", 'ima_whitelist_inline': inline}
+
+def check_whitelist_ref(ref):
+    if not whitelist_store.get_store().exists(ref):
+        raise Exception("IMA whitelist %s not found, upload it to /whitelists first"%ref)
+
+def ima_policy_check(fields):
+    """The check for AgentRegistry.add() or update() with IMA_POLICY_COLS fields.  The 
+    referenced whitelist may have been deleted since prepare_ima_policy(), it is looked 
+    for again under the database write lock that deleting it takes as well."""
+    ref = fields['ima_whitelist_ref']
+    if ref == "":
+        return None
+    return lambda: check_whitelist_ref(ref)
+
+def get_inline_whitelists(db,key,value):
+    """The digests of the inline whitelists of the agents whose column key holds value."""
+    return set([db.get_agent_value(agent_id,'ima_whitelist_inline') for agent_id in db.get_agent_ids(key,value)])
+
+def remove_inline_whitelists(db,digests):
+    """Removes the inline whitelists with these digests that no agent has anymore, 
+    after agents were removed or got another whitelist.  An agent getting one of them
+    meanwhile stores it again with get_job_whitelist()."""
+    store = whitelist_store.get_store()
+    for digest in digests:
+        if digest and db.remove_unreferenced('ima_whitelist_inline',digest,lambda: store.remove(digest,inline=True)) == 0:
+            logger.debug("removed inline whitelist %s"%digest)
+
+def reset_ima_state(agent):
+    ima_state = ima.new_state()
+    ima_state['whitelist'] = ""
+    set_ima_state(agent, ima_state)
+
+def finish_quote_check(agent, job, result):
+    """Applies the result of check_quote() to the agent."""
+    if result and result.get('ima_failures') is not None:
+        agent['ima_failures'] = dict(result['ima_failures'], time=time.time(), whitelist=result['ima_state']['whitelist'])
+    if not result or not result['valid']:
         return False
     
+    set_ima_state(agent, result['ima_state'])
+    
     # set a flag so that we know that the agent was verified once.
     # we only issue notifications for agents that were at some point good
     agent['first_verified']=True
     
     # has public key changed? if so, clear out b64_encrypted_V, it is no longer valid
-    if received_public_key != agent.get('public_key',""):
-        agent['public_key'] = received_public_key
+    if job['public_key'] != agent.get('public_key',""):
+        agent['public_key'] = job['public_key']
         agent['b64_encrypted_V'] = ""
         agent['provide_V'] = True
     
     # ok we're done
-    return validQuote
+    return True
 
 
 def prepare_v(agent):
@@ -285,12 +543,15 @@ def prepare_get_quote(agent):
         'nonce': agent['nonce'],
         'mask': agent['tpm_policy']['mask'],
         'vmask': agent['vtpm_policy']['mask'],
+        'ima_ml_entry': get_ima_state(agent)['entry'],
         }
     
     return params
 
 def process_get_status(agent):
-    if isinstance(agent['ima_whitelist'],dict) and 'whitelist' in agent['ima_whitelist']:
+    if agent.get('ima_whitelist_ref'):
+        wl_len = whitelist_store.get_store().count_paths(agent['ima_whitelist_ref']) or 0
+    elif isinstance(agent['ima_whitelist'],dict) and 'whitelist' in agent['ima_whitelist']:
         wl_len = len(agent['ima_whitelist']['whitelist'])
     else:
         wl_len = 0
@@ -302,6 +563,8 @@ def process_get_status(agent):
                 'vtpm_policy':agent['vtpm_policy'],
                 'metadata':agent['metadata'],
                 'ima_whitelist_len':wl_len,
+                'ima_whitelist_ref':agent.get('ima_whitelist_ref') or "",
+                'tag':agent.get('tag') or "",
                 'tpm_version':agent['tpm_version'],
                 'accept_tpm_hash_algs':agent['accept_tpm_hash_algs'],
                 'accept_tpm_encryption_algs':agent['accept_tpm_encryption_algs'],
@@ -363,7 +626,7 @@ def notifyError(agent,msgtype='revocation'):
 def init_db(db_filename):
     # in the form key, SQL type
     cols_db = {
-        'agent_id': 'TEXT PRIMARY_KEY',
+        'agent_id': 'TEXT PRIMARY KEY',
         'v': 'TEXT',
         'ip': 'TEXT',
         'port': 'INT',
@@ -381,10 +644,20 @@ def init_db(db_filename):
         'hash_alg': 'TEXT',
         'enc_alg': 'TEXT',
         'sign_alg': 'TEXT',
+        'ima_ml_entry': 'INT',
+        'ima_running_hash': 'TEXT',
+        'ima_ml_offset': 'INT',
+        'ima_ml_last': 'TEXT',
+        'ima_whitelist_version': 'TEXT',
+        'ima_whitelist_ref': 'TEXT',
+        'ima_whitelist_inline': 'TEXT',
+        'ima_policy_serial': 'INT',
+        'tag': 'TEXT',
+        'ima_failures': 'TEXT',
         }
     
     # these are the columns that contain json data and need marshalling
-    json_cols_db = ['tpm_policy','vtpm_policy','metadata','ima_whitelist','accept_tpm_hash_algs', 'accept_tpm_encryption_algs', 'accept_tpm_signing_algs']
+    json_cols_db = ['tpm_policy','vtpm_policy','metadata','ima_whitelist','accept_tpm_hash_algs', 'accept_tpm_encryption_algs', 'accept_tpm_signing_algs','ima_failures']
     
     # in the form key : default value
     exclude_db = {
@@ -395,6 +668,7 @@ def init_db(db_filename):
         'num_retries': 0,
         'pending_event': None,
         'first_verified':False,
+        'ima_whitelist_digest':None,
         }
-    return keylime_sqlite.KeylimeDB(db_filename,cols_db,json_cols_db,exclude_db)
+    return keylime_sqlite.KeylimeDB(db_filename,cols_db,json_cols_db,exclude_db,index_cols=['operational_state','ima_whitelist_ref','ima_whitelist_inline','tag'])
 
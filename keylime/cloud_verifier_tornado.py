@@ -30,15 +30,29 @@ import sys
 import tornado.ioloop
 import tornado.web
 import functools
+import random
+from tornado import gen
 from tornado import httpserver
-from tornado.httpclient import AsyncHTTPClient
 from tornado.httputil import url_concat
+import agent_http_client
+import agent_registry
+import circuit_breaker
 import cloud_verifier_common
+import ima
+import poll_scheduler
 import revocation_notifier
+import verification_executor
+import whitelist_store
 
 config = ConfigParser.SafeConfigParser()
 config.read(common.CONFIG_FILE)
 
+# agent states that are only set through the REST interface.  like whitelist changes,
+# they bump the agent's ima_policy_serial so the verifier process polling the agent
+# picks them up with AgentRegistry.refresh()
+USER_STATES = [cloud_verifier_common.CloudAgent_Operational_State.TERMINATED,
+               cloud_verifier_common.CloudAgent_Operational_State.TENANT_FAILED]
+
 class BaseHandler(tornado.web.RequestHandler):
 
     def write_error(self, status_code, **kwargs):
@@ -74,10 +88,115 @@ class MainHandler(tornado.web.RequestHandler):
     def put(self):
         common.echo_json_response(self, 405, "Not Implemented: Use /agents/ interface instead")
 
-class AgentsHandler(BaseHandler):
+class ScheduleHandler(BaseHandler):
+    def get(self):
+        """Returns the poll schedule of the verifier process that takes the request: how
+        many agents are scheduled, in flight and waiting for the in flight budget, and the
+        agents due next.  The optional limit parameter caps the number of agents listed.
+        """
+        rest_params = common.get_restful_params(self.request.uri)
+        if rest_params is None or "schedule" not in rest_params:
+            common.echo_json_response(self, 400, "uri not supported")
+            return
+        
+        try:
+            limit = int(rest_params.get("limit",100))
+        except ValueError:
+            common.echo_json_response(self, 400, "limit must be an integer")
+            return
+        
+        common.echo_json_response(self, 200, "Success", poll_scheduler.get_scheduler().get_schedule(limit))
+
+class WhitelistsHandler(BaseHandler):
+    """IMA whitelists shared by agents, addressed by their ima.whitelist_version()
+    digest.  Agents reference one with ima_whitelist_ref instead of sending their own
+    ima_whitelist."""
     db = None
     def initialize(self, db):
         self.db = db
+    
+    def __digest(self):
+        rest_params = common.get_restful_params(self.request.uri)
+        if rest_params is None or "whitelists" not in rest_params:
+            common.echo_json_response(self, 400, "uri not supported")
+            return False,None
+        digest = rest_params["whitelists"]
+        if digest is not None and not whitelist_store.valid_digest(digest):
+            common.echo_json_response(self, 400, "invalid whitelist digest")
+            return False,None
+        return True,digest
+    
+    def head(self):
+        """Tells whether the whitelist with the given digest is stored, without sending it."""
+        rest_params = common.get_restful_params(self.request.uri)
+        if rest_params is None or not whitelist_store.valid_digest(rest_params.get("whitelists")):
+            self.set_status(400)
+        elif whitelist_store.get_store().exists(rest_params["whitelists"]):
+            self.set_status(200)
+        else:
+            self.set_status(404)
+        self.finish()
+    
+    def get(self):
+        """Returns the whitelist with the given digest as it was uploaded, or the digests
+        of all whitelists if none is given."""
+        ok,digest = self.__digest()
+        if not ok:
+            return
+        store = whitelist_store.get_store()
+        if digest is None:
+            common.echo_json_response(self, 200, "Success", {'digests':store.digests(), 'cache':store.get_stats()})
+            return
+        data = store.read(digest)
+        if data is None:
+            common.echo_json_response(self, 404, "whitelist not found")
+            return
+        common.echo_json_response(self, 200, "Success", {'digest':digest, 'ima_whitelist':json.loads(data)})
+    
+    def post(self):
+        """Stores the whitelist in the body, which has to have the digest in the uri.  
+        Storing a whitelist that is already there is fine."""
+        ok,digest = self.__digest()
+        if not ok:
+            return
+        if digest is None:
+            common.echo_json_response(self, 400, "uri not supported")
+            return
+        try:
+            lists = json.loads(self.request.body)
+            whitelist_store.get_store().add(lists, digest)
+        except Exception as e:
+            common.echo_json_response(self, 400, "Exception error: %s"%e)
+            logger.warning("POST returning 400 response. Exception error: %s"%e)
+            return
+        common.echo_json_response(self, 200, "Success", {'digest':digest})
+        logger.info('POST returning 200 response for whitelist %s'%digest)
+    
+    def delete(self):
+        """Deletes a whitelist no agent references."""
+        ok,digest = self.__digest()
+        if not ok:
+            return
+        if digest is None:
+            common.echo_json_response(self, 400, "uri not supported")
+            return
+        # agents are added with a check under the same lock, see ima_policy_check()
+        removed = []
+        refs = self.db.remove_unreferenced('ima_whitelist_ref', digest, 
+                                           lambda: removed.append(whitelist_store.get_store().remove(digest)))
+        if refs > 0:
+            common.echo_json_response(self, 409, "whitelist is used by %d agents"%refs)
+            return
+        if not removed[0]:
+            common.echo_json_response(self, 404, "whitelist not found")
+            return
+        common.echo_json_response(self, 200, "Success")
+        logger.info('DELETE returning 200 response for whitelist %s'%digest)
+
+class AgentsHandler(BaseHandler):
+    registry = None
+    def initialize(self, registry):
+        self.registry = registry
        
     def head(self):
         """HEAD not supported"""
@@ -91,6 +210,9 @@ class AgentsHandler(BaseHandler):
         agent to be returned. If the agent_id is not found, a 404 response is returned.  If the agent_id
         was not found, it either completed successfully, or failed.  If found, the agent_id is still polling 
         to contact the Cloud Agent. 
+        
+        /agents/<agent_id>/ima_failures returns the IMA failures found in the latest quote of the agent 
+        with an IMA measurement list that did not check out, or 404 if there was none.
         """
         rest_params = common.get_restful_params(self.request.uri)
         if rest_params is None:
@@ -105,8 +227,13 @@ class AgentsHandler(BaseHandler):
         agent_id = rest_params["agents"]
         
         if agent_id is not None:
-            agent = self.db.get_agent(agent_id)
-            if agent != None:
+            agent = self.registry.get(agent_id)
+            if agent != None and "ima_failures" in rest_params:
+                if agent.get('ima_failures') is None:
+                    common.echo_json_response(self, 404, "no failed IMA measurement list for agent")
+                else:
+                    common.echo_json_response(self, 200, "Success", agent['ima_failures'])
+            elif agent != None:
                 response = cloud_verifier_common.process_get_status(agent)
                 common.echo_json_response(self, 200, "Success", response)
                 #logger.info('GET returning 200 response for agent_id: ' + agent_id)
@@ -116,7 +243,7 @@ class AgentsHandler(BaseHandler):
                 common.echo_json_response(self, 404, "agent id not found")
         else:
             # return the available keys in the DB
-            json_response = self.db.get_agent_ids()
+            json_response = self.registry.get_agent_ids()
             common.echo_json_response(self, 200, "Success", {'uuids':json_response})
             logger.info('GET returning 200 response for agent_id list')
             
@@ -141,7 +268,7 @@ class AgentsHandler(BaseHandler):
             common.echo_json_response(self, 400, "uri not supported")
             logger.warning('DELETE returning 400 response. uri not supported: ' + self.request.path)
                         
-        agent = self.db.get_agent(agent_id)
+        agent = self.registry.get(agent_id)
         
         if agent is None:
             common.echo_json_response(self, 404, "agent id not found")
@@ -152,11 +279,12 @@ class AgentsHandler(BaseHandler):
         if op_state == cloud_verifier_common.CloudAgent_Operational_State.SAVED or \
         op_state == cloud_verifier_common.CloudAgent_Operational_State.FAILED or \
         op_state == cloud_verifier_common.CloudAgent_Operational_State.INVALID_QUOTE:
-            self.db.remove_agent(agent_id)
+            self.registry.remove(agent_id)
+            cloud_verifier_common.remove_inline_whitelists(self.registry.db, [agent.get('ima_whitelist_inline')])
             common.echo_json_response(self, 200, "Success")
             logger.info('DELETE returning 200 response for agent id: ' + agent_id)
         else:            
-            self.db.update_agent(agent_id, 'operational_state',cloud_verifier_common.CloudAgent_Operational_State.TERMINATED)
+            self.registry.set_user_state(agent_id, cloud_verifier_common.CloudAgent_Operational_State.TERMINATED, 'ima_policy_serial')
             common.echo_json_response(self, 202, "Accepted")
             logger.info('DELETE returning 202 response for agent id: ' + agent_id)
 
@@ -196,7 +324,10 @@ class AgentsHandler(BaseHandler):
                     d['tpm_policy'] = json_body['tpm_policy']
                     d['vtpm_policy'] = json_body['vtpm_policy']
                     d['metadata'] = json_body['metadata']
-                    d['ima_whitelist'] = json_body['ima_whitelist']
+                    d.update(cloud_verifier_common.prepare_ima_policy(json_body))
+                    d['ima_policy_serial'] = 0
+                    d['tag'] = json_body.get('tag') or ""
+                    d['ima_failures'] = None
                     d['revocation_key'] = json_body['revocation_key']
                     d['tpm_version'] = 0
                     d['accept_tpm_hash_algs'] = json_body['accept_tpm_hash_algs']
@@ -205,8 +336,16 @@ class AgentsHandler(BaseHandler):
                     d['hash_alg'] = ""
                     d['enc_alg'] = ""
                     d['sign_alg'] = ""
+                    d['ima_ml_entry'] = 0
+                    d['ima_running_hash'] = ""
+                    d['ima_ml_offset'] = 0
+                    d['ima_ml_last'] = ""
+                    d['ima_whitelist_version'] = ""
                     
-                    new_agent = self.db.add_agent(agent_id,d)
+                    new_agent = self.registry.add(agent_id,d,cloud_verifier_common.ima_policy_check(d))
+                    
+                    # the agent may have registered again since we last saw it
+                    cloud_verifier_common.invalidate_registrar_keys(agent_id)
                     
                     # don't allow overwriting
                     if new_agent is None:
@@ -249,21 +388,27 @@ class AgentsHandler(BaseHandler):
             if agent_id is None:
                 common.echo_json_response(self, 400, "uri not supported")
                 logger.warning("PUT returning 400 response. uri not supported")
+                return
+            
+            if "ima_whitelist" in rest_params:
+                self.put_ima_whitelist(agent_id, rest_params)
+                return
             
-            agent = self.db.get_agent(agent_id)
-            if agent is not None:
+            agent = self.registry.get(agent_id)
+            if agent is None:
                 common.echo_json_response(self, 404, "agent id not found")
                 logger.info('PUT returning 404 response. agent id: ' + agent_id + ' not found.')
+                return
                 
             if "reactivate" in rest_params:
-                agent['operational_state']=cloud_verifier_common.CloudAgent_Operational_State.START
+                self.registry.clear_user_state(agent_id, cloud_verifier_common.CloudAgent_Operational_State.START, 'ima_policy_serial')
                 self.process_agent(agent, cloud_verifier_common.CloudAgent_Operational_State.GET_QUOTE)
                 common.echo_json_response(self, 200, "Success")
                 logger.info('PUT returning 200 response for agent id: ' + agent_id)
             elif "stop" in rest_params:
                 # do stuff for terminate
                 logger.debug("Stopping polling on %s"%agent_id)
-                self.db.update_agent(agent_id,'operational_state',cloud_verifier_common.CloudAgent_Operational_State.TENANT_FAILED)
+                self.registry.set_user_state(agent_id, cloud_verifier_common.CloudAgent_Operational_State.TENANT_FAILED, 'ima_policy_serial')
                 common.echo_json_response(self, 200, "Success")
                 logger.info('PUT returning 200 response for agent id: ' + agent_id)
             else:
@@ -279,26 +424,94 @@ class AgentsHandler(BaseHandler):
         self.finish()
 
 
+    def put_ima_whitelist(self, agent_id, rest_params):
+        """Replaces the IMA whitelist of an agent, or with agent id * that of all agents
+        with the tag parameter, without adding them again.  The body holds an 
+        ima_whitelist or an ima_whitelist_ref like a POST does.  The next poll of each 
+        agent uses the new whitelist and checks the whole measurement list against it."""
+        fields = cloud_verifier_common.prepare_ima_policy(json.loads(self.request.body))
+        cloud_verifier_common.reset_ima_state(fields)
+        check = cloud_verifier_common.ima_policy_check(fields)
+        if agent_id == '*':
+            tag = rest_params.get("tag")
+            if not tag:
+                common.echo_json_response(self, 400, "tag required to update all agents")
+                return
+            replaced = cloud_verifier_common.get_inline_whitelists(self.registry.db, 'tag', tag)
+            count = self.registry.update(fields, 'tag', tag, 'ima_policy_serial', check)
+        else:
+            replaced = cloud_verifier_common.get_inline_whitelists(self.registry.db, 'agent_id', agent_id)
+            count = self.registry.update(fields, 'agent_id', agent_id, 'ima_policy_serial', check)
+            if count == 0:
+                common.echo_json_response(self, 404, "agent id not found")
+                logger.info('PUT returning 404 response. agent id: ' + agent_id + ' not found.')
+                return
+        cloud_verifier_common.remove_inline_whitelists(self.registry.db, replaced)
+        common.echo_json_response(self, 200, "Success", {'updated':count})
+        logger.info('PUT returning 200 response, IMA whitelist of %d agents set to %s'%(count, ima.whitelist_version(fields['ima_whitelist']) if fields['ima_whitelist_ref'] == "" else fields['ima_whitelist_ref']))
+    
+    def breaker_allows(self, agent, retry):
+        """Returns True if the agent may be contacted now.  Otherwise the agent or its
+        subnet is known to be unreachable, so retry is scheduled for when the circuit
+        breaker lets a probe through.  Waiting doesn't count against max_retries."""
+        wait = circuit_breaker.get_breakers().try_begin(agent['ip'], agent['port'])
+        if wait == 0:
+            return True
+        scheduler = poll_scheduler.get_scheduler()
+        scheduler.complete(agent['agent_id'])
+        # spread out the agents waiting on the same breaker
+        scheduler.schedule(agent['agent_id'], wait + random.uniform(0, wait), retry)
+        return False
+    
+    def record_response(self, agent, response):
+        """Tells the circuit breakers how contacting the agent went.  Returns True if the
+        request failed to reach the agent."""
+        if response.error and (isinstance(response.error, IOError) or response.code == 599):
+            circuit_breaker.get_breakers().failure(agent['ip'], agent['port'])
+            return True
+        circuit_breaker.get_breakers().success(agent['ip'], agent['port'])
+        return False
+    
     def invoke_get_quote(self, agent, need_pubkey):
+        if not self.breaker_allows(agent, functools.partial(self.invoke_get_quote, agent, need_pubkey)):
+            return
+        # the whitelist may have been replaced, or the agent stopped, through any
+        # verifier process
+        version = cloud_verifier_common.get_whitelist_version(agent)
+        if self.registry.refresh(agent, 'ima_policy_serial', cloud_verifier_common.IMA_POLICY_COLS+cloud_verifier_common.IMA_STATE_COLS):
+            if self.registry.get_user_state(agent['agent_id'], USER_STATES) is not None:
+                self.process_agent(agent, agent['operational_state'])
+                return
+            if cloud_verifier_common.get_whitelist_version(agent) != version:
+                logger.info("IMA whitelist of agent %s changed to %s"%(agent['agent_id'], cloud_verifier_common.get_whitelist_version(agent)))
         params = cloud_verifier_common.prepare_get_quote(agent)
         agent['operational_state'] = cloud_verifier_common.CloudAgent_Operational_State.GET_QUOTE
-        client = tornado.httpclient.AsyncHTTPClient()
         
         partial_req = "1"
         if need_pubkey:
             partial_req = "0"
         
-        url = "http://%s:%d/quotes/integrity?nonce=%s&mask=%s&vmask=%s&partial=%s"%(agent['ip'],agent['port'],params["nonce"],params["mask"],params['vmask'],partial_req) 
+        url = "http://%s:%d/quotes/integrity?nonce=%s&mask=%s&vmask=%s&partial=%s&ima_ml_entry=%d"%(agent['ip'],agent['port'],params["nonce"],params["mask"],params['vmask'],partial_req,params['ima_ml_entry']) 
         # the following line adds the agent and params arguments to the callback as a convenience
         cb = functools.partial(self.on_get_quote_response, agent, url)
-        client.fetch(url, callback=cb)
+        agent_http_client.get_client().fetch(url, cb)
     
     def on_get_quote_response(self, agent, url, response):
         if agent is None:
             raise Exception("agent deleted while being processed")
-        if response.error: 
+        stats = agent_http_client.get_client().get_stats()
+        logger.debug("quote from agent %s received, %d agent requests in flight, waited %f s for a connection"%(agent['agent_id'],stats['in_flight'],stats['last_queue_time']))
+        connection_error = self.record_response(agent, response)
+        if response.code == 503:
+            # the TPM of the agent is busy, ask again when it says to without using up a retry
+            wait = agent_http_client.retry_after(response, config.getfloat('cloud_verifier','retry_interval'))
+            logger.info("agent %s is busy, asking for a quote again in %f seconds"%(agent['agent_id'],wait))
+            poll_scheduler.get_scheduler().complete(agent['agent_id'])
+            cb = functools.partial(self.invoke_get_quote, agent, True)
+            poll_scheduler.get_scheduler().schedule(agent['agent_id'], wait, cb)
+        elif response.error: 
             # this is a connection error, retry get quote
-            if isinstance(response.error, IOError) or (isinstance(response.error, tornado.web.HTTPError) and response.error.code == 599):
+            if connection_error:
                 self.process_agent(agent, cloud_verifier_common.CloudAgent_Operational_State.GET_QUOTE_RETRY)
             else:
                 #catastrophic error, do not continue
@@ -307,51 +520,106 @@ class AgentsHandler(BaseHandler):
                 self.process_agent(agent, cloud_verifier_common.CloudAgent_Operational_State.FAILED)
         else:
             try:
- 
-#                writeTime=False
-#                with cloud_verifier_common.Timer() as t:
-                    json_response = json.loads(response.body)
-
-                    # validate the cloud agent response
-                    if cloud_verifier_common.process_quote_response(agent, json_response['results']):
-                        #only write timing if the quote was successful
-#                         if self.time_series_log_file_base_name is not None:
-#                             self.time_series_log_file.write("%s\n" % time.time())
-#                             self.time_series_log_file.flush()
-#                         writeTime=True
-                         
-                        if agent['provide_V']:
-                            self.process_agent(agent, cloud_verifier_common.CloudAgent_Operational_State.PROVIDE_V)
-                        else:
-                            self.process_agent(agent, cloud_verifier_common.CloudAgent_Operational_State.GET_QUOTE)
-                    else:
-                        self.process_agent(agent, cloud_verifier_common.CloudAgent_Operational_State.INVALID_QUOTE)
-                        cloud_verifier_common.notifyError(agent)
- 
-#                 if self.get_q_log_file_base_name is not None and writeTime:
-#                     self.get_q_log_file.write("%s\n" % t.secs)
-#                     self.get_q_log_file.flush()  
-                 
+                json_response = json.loads(response.body)
+                
+                # get the AIK without blocking, it is usually cached
+                future = cloud_verifier_common.get_registrar_keys(agent['agent_id'])
+                cb = functools.partial(self.on_registrar_keys, agent, json_response['results'])
+                tornado.ioloop.IOLoop.current().add_future(future, cb)
             except Exception as e:
-                logger.exception(e)            
-
-
+                logger.exception(e)
+                poll_scheduler.get_scheduler().complete(agent['agent_id'])
+    
+    def on_registrar_keys(self, agent, json_response, future):
+        try:
+            registrar_keys = future.result()
+            if registrar_keys is None:
+                logger.warning("AIK not found in registrar, quote not validated")
+                self.on_quote_checked(agent, False, False)
+                return
+            agent['registrar_keys'] = registrar_keys
+            
+            # validate the cloud agent response
+            job = cloud_verifier_common.prepare_quote_check(agent, json_response)
+            if not job:
+                self.on_quote_checked(agent, job, job)
+                return
+            
+            # the actual quote and IMA check can be slow, keep it off the IOLoop
+            future = self.check_quote(job)
+            cb = functools.partial(self.on_quote_checked_future, agent, job)
+            tornado.ioloop.IOLoop.current().add_future(future, cb)
+        except Exception as e:
+            logger.exception(e)
+            poll_scheduler.get_scheduler().complete(agent['agent_id'])
+    
+    @gen.coroutine
+    def check_quote(self, job):
+        """Checks the quote of a job from prepare_quote_check() in the verification 
+        workers.  A large IMA measurement list comes back from the first check split up
+        and its pieces are checked in parallel, by all of the workers, before the quote is 
+        checked with their results."""
+        executor = verification_executor.get_executor()
+        if executor.num_workers > 1:
+            job['ima_state']['chunks'] = config.getint('cloud_verifier','ima_parallel_chunks')
+        result = yield executor.submit(cloud_verifier_common.check_quote, job)
+        if result['ima_pieces'] is None:
+            raise gen.Return(result)
+        
+        piece_job = cloud_verifier_common.get_piece_job(job)
+        pieces = result['ima_pieces']['pieces']
+        logger.debug("checking IMA measurement list of agent %s in %d pieces"%(job['agent_id'],len(pieces)))
+        checked = yield [executor.submit(cloud_verifier_common.check_ima_piece, piece_job, piece) for piece in pieces]
+        job['ima_state']['checked'] = {'offset': result['ima_pieces']['offset'], 'pieces': checked}
+        result = yield executor.submit(cloud_verifier_common.check_quote, job)
+        raise gen.Return(result)
+    
+    def on_quote_checked_future(self, agent, job, future):
+        stats = verification_executor.get_executor().get_stats()
+        logger.debug("quote check for agent %s done, verification queue depth %d, last latency %f s"%(agent['agent_id'],stats['queue_depth'],stats['last_latency']))
+        try:
+            self.on_quote_checked(agent, job, future.result())
+        except Exception as e:
+            # the check itself failed, e.g. its worker died, which says nothing about
+            # the quote.  ask for a new one
+            logger.error("Quote check for agent %s failed: %s"%(agent['agent_id'],e))
+            self.process_agent(agent, cloud_verifier_common.CloudAgent_Operational_State.GET_QUOTE_RETRY)
+    
+    def on_quote_checked(self, agent, job, validQuote):
+        try:
+            if job and cloud_verifier_common.needs_full_ima_list(validQuote):
+                # the agent rebooted or the list otherwise changed under us, start over
+                logger.info("requesting full IMA measurement list from agent %s"%agent['agent_id'])
+                cloud_verifier_common.reset_ima_state(agent)
+                poll_scheduler.get_scheduler().complete(agent['agent_id'])
+                cb = functools.partial(self.invoke_get_quote, agent, False)
+                poll_scheduler.get_scheduler().schedule(agent['agent_id'], 0, cb)
+            elif job and cloud_verifier_common.finish_quote_check(agent, job, validQuote):
+                if agent['provide_V']:
+                    self.process_agent(agent, cloud_verifier_common.CloudAgent_Operational_State.PROVIDE_V)
+                else:
+                    self.process_agent(agent, cloud_verifier_common.CloudAgent_Operational_State.GET_QUOTE)
+            else:
+                self.process_agent(agent, cloud_verifier_common.CloudAgent_Operational_State.INVALID_QUOTE)
+                cloud_verifier_common.notifyError(agent)
+        except Exception as e:
+            logger.exception(e)
 
     def invoke_provide_v(self, agent):
-        if agent['pending_event'] is not None:
-            agent['pending_event'] = None
+        if not self.breaker_allows(agent, functools.partial(self.invoke_provide_v, agent)):
+            return
         v_json_message = cloud_verifier_common.prepare_v(agent)
         agent['operational_state'] = cloud_verifier_common.CloudAgent_Operational_State.PROVIDE_V
-        client = tornado.httpclient.AsyncHTTPClient()
         url = "http://%s:%d/keys/vkey"%(agent['ip'],agent['port'])
         cb = functools.partial(self.on_provide_v_response, agent, url)
-        client.fetch(url, method="POST", callback=cb, headers=None, body=v_json_message)
+        agent_http_client.get_client().fetch(url, cb, method="POST", body=v_json_message)
     
     def on_provide_v_response(self, agent, url_with_params, response):
         if agent is None:
             raise Exception("Agent deleted while being processed")
+        connection_error = self.record_response(agent, response)
         if response.error: 
-            if isinstance(response.error, IOError) or (isinstance(response.error, tornado.web.HTTPError) and response.error.code == 599):
+            if connection_error:
                 self.process_agent(agent, cloud_verifier_common.CloudAgent_Operational_State.PROVIDE_V_RETRY)
             else:
                 #catastrophic error, do not continue
@@ -363,22 +631,24 @@ class AgentsHandler(BaseHandler):
  
     def process_agent(self, agent, new_operational_state):
         try:
+            # whatever request brought us here is done, let the next poll have its slot
+            poll_scheduler.get_scheduler().complete(agent['agent_id'])
+            
             main_agent_operational_state = agent['operational_state']
-            stored_agent = self.db.get_agent(agent['agent_id'])
+            user_state = self.registry.get_user_state(agent['agent_id'], USER_STATES)
             
             # if the user did terminated this agent
-            if stored_agent['operational_state'] == cloud_verifier_common.CloudAgent_Operational_State.TERMINATED:
+            if user_state == cloud_verifier_common.CloudAgent_Operational_State.TERMINATED:
                 logger.warning("agent %s terminated by user."%agent['agent_id'])
-                if agent['pending_event'] is not None:
-                    tornado.ioloop.IOLoop.current().remove_timeout(agent['pending_event'])
-                self.db.remove_agent(agent['agent_id'])
+                poll_scheduler.get_scheduler().cancel(agent['agent_id'])
+                self.registry.remove(agent['agent_id'])
+                cloud_verifier_common.remove_inline_whitelists(self.registry.db, [agent.get('ima_whitelist_inline')])
                 return
             
             # if the user tells us to stop polling because the tenant quote check failed
-            if stored_agent['operational_state']==cloud_verifier_common.CloudAgent_Operational_State.TENANT_FAILED:
+            if user_state == cloud_verifier_common.CloudAgent_Operational_State.TENANT_FAILED:
                 logger.warning("agent %s has failed tenant quote.  stopping polling"%agent['agent_id'])
-                if agent['pending_event'] is not None:
-                    tornado.ioloop.IOLoop.current().remove_timeout(agent['pending_event'])
+                poll_scheduler.get_scheduler().cancel(agent['agent_id'])
                 return
             
             # If failed during processing, log regardless and drop it on the floor
@@ -386,20 +656,20 @@ class AgentsHandler(BaseHandler):
             if new_operational_state == cloud_verifier_common.CloudAgent_Operational_State.FAILED or \
                 new_operational_state == cloud_verifier_common.CloudAgent_Operational_State.INVALID_QUOTE:
                 agent['operational_state'] = new_operational_state
-                if agent['pending_event'] is not None:
-                    tornado.ioloop.IOLoop.current().remove_timeout(agent['pending_event'])
-                self.db.overwrite_agent(agent['agent_id'], agent)
+                poll_scheduler.get_scheduler().cancel(agent['agent_id'])
+                self.registry.touch(agent)
                 logger.warning("agent %s failed, stopping polling"%agent['agent_id'])
                 return
             
-            # propagate all state 
-            self.db.overwrite_agent(agent['agent_id'], agent)
+            # propagate all state, only changed columns reach the database
+            self.registry.touch(agent)
             
             # if new, get a quote
             if main_agent_operational_state == cloud_verifier_common.CloudAgent_Operational_State.START and \
                 new_operational_state == cloud_verifier_common.CloudAgent_Operational_State.GET_QUOTE:
                 agent['num_retries']=0
-                self.invoke_get_quote(agent, True)
+                cb = functools.partial(self.invoke_get_quote, agent, True)
+                poll_scheduler.get_scheduler().schedule(agent['agent_id'], 0, cb)
                 return
             
             if main_agent_operational_state == cloud_verifier_common.CloudAgent_Operational_State.GET_QUOTE and \
@@ -414,18 +684,14 @@ class AgentsHandler(BaseHandler):
                 agent['num_retries']=0
                 interval = config.getfloat('cloud_verifier','quote_interval')
                 
-                if interval==0:
-                    self.invoke_get_quote(agent, False)
-                else:
-                    #logger.debug("Setting up callback to check again in %f seconds"%interval)
-                    # set up a call back to check again
-                    cb = functools.partial(self.invoke_get_quote, agent, False)
-                    pending = tornado.ioloop.IOLoop.current().call_later(interval,cb)
-                    agent['pending_event'] = pending
+                # set up a call back to check again, spread out over the interval
+                cb = functools.partial(self.invoke_get_quote, agent, False)
+                poll_scheduler.get_scheduler().schedule_poll(agent['agent_id'], interval, cb)
                 return
             
             maxr = config.getint('cloud_verifier','max_retries')
-            retry = config.getfloat('cloud_verifier','retry_interval')
+            # back off exponentially with jitter so agents that dropped together don't retry together
+            retry = circuit_breaker.backoff(config.getfloat('cloud_verifier','retry_interval'),agent['num_retries'],config.getfloat('cloud_verifier','max_retry_interval'))
             if main_agent_operational_state == cloud_verifier_common.CloudAgent_Operational_State.GET_QUOTE and \
                 new_operational_state == cloud_verifier_common.CloudAgent_Operational_State.GET_QUOTE_RETRY:
                 if agent['num_retries']>=maxr:
@@ -439,7 +705,7 @@ class AgentsHandler(BaseHandler):
                     cb = functools.partial(self.invoke_get_quote, agent, True)
                     agent['num_retries']+=1
                     logger.info("connection to %s refused after %d/%d tries, trying again in %f seconds"%(agent['ip'],agent['num_retries'],maxr,retry))
-                    tornado.ioloop.IOLoop.current().call_later(retry,cb)
+                    poll_scheduler.get_scheduler().schedule(agent['agent_id'], retry, cb)
                 return   
             
             if main_agent_operational_state == cloud_verifier_common.CloudAgent_Operational_State.PROVIDE_V and \
@@ -452,7 +718,7 @@ class AgentsHandler(BaseHandler):
                     cb = functools.partial(self.invoke_provide_v, agent)
                     agent['num_retries']+=1
                     logger.info("connection to %s refused after %d/%d tries, trying again in %f seconds"%(agent['ip'],agent['num_retries'],maxr,retry))
-                    tornado.ioloop.IOLoop.current().call_later(retry,cb)
+                    poll_scheduler.get_scheduler().schedule(agent['agent_id'], retry, cb)
                 return
             
             print agent
@@ -479,6 +745,7 @@ def main(argv=sys.argv):
     
     db_filename = "%s/%s"%(common.WORK_DIR,config.get('cloud_verifier','db_filename'))
     db = cloud_verifier_common.init_db(db_filename)
+    registry = agent_registry.AgentRegistry(db,config.getfloat('cloud_verifier','agent_flush_interval'),config.getint('cloud_verifier','agent_flush_size'),USER_STATES,['ima_whitelist'])
     db.update_all_agents('operational_state', cloud_verifier_common.CloudAgent_Operational_State.SAVED)
     
     num = db.count_agents()
@@ -489,7 +756,9 @@ def main(argv=sys.argv):
     logger.info('Starting Cloud Verifier (tornado) on port ' + cloudverifier_port + ', use <Ctrl-C> to stop')
 
     app = tornado.web.Application([
-        (r"/(?:v[0-9]/)?agents/.*", AgentsHandler,{'db':db}),
+        (r"/(?:v[0-9]/)?agents/.*", AgentsHandler,{'registry':registry}),
+        (r"/(?:v[0-9]/)?schedule/?.*", ScheduleHandler),
+        (r"/(?:v[0-9]/)?whitelists/?.*", WhitelistsHandler,{'db':db}),
         (r".*", MainHandler),
         ])
     
@@ -508,6 +777,7 @@ def main(argv=sys.argv):
         tornado.ioloop.IOLoop.instance().start()
     except KeyboardInterrupt:
         tornado.ioloop.IOLoop.instance().stop()
+        registry.stop()
         if config.getboolean('cloud_verifier', 'revocation_notifier'):
             revocation_notifier.stop_broker()
 
@@ -17,8 +17,10 @@ above. Use of this work other than as specifically authorized by the U.S. Govern
 violate any copyrights that exist in this work.
 '''
 
+import ctypes
 import os
 import subprocess
+import tempfile
 import threading
 import common
 import time
@@ -29,6 +31,65 @@ utilLock = threading.Lock()
 
 EXIT_SUCESS=0
 
+try:
+    _memfd_create = ctypes.CDLL(None, use_errno=True).memfd_create
+except (OSError, AttributeError):
+    _memfd_create = None
+
+
+class MemFile(object):
+    """An anonymous in-memory file for tools run by run() to read or write, used like
+    a NamedTemporaryFile.  The tools open it as name, /dev/fd/N of the descriptor they
+    inherit, so nothing is written to disk or left behind if the process dies.  Uses
+    memfd_create where the C library has it, an already unlinked temporary file where
+    it doesn't.  The descriptor is inherited by every command started while it is open.
+    """
+    
+    def __init__(self, data=None):
+        fd = -1
+        if _memfd_create is not None:
+            fd = _memfd_create("keylime", 0)
+        if fd < 0:
+            with tempfile.TemporaryFile() as f:
+                # the duplicate is inheritable, unlike the original
+                fd = os.dup(f.fileno())
+        self.fd = fd
+        self.name = "/dev/fd/%d"%fd
+        if data is not None:
+            self.write(data)
+    
+    def write(self, data):
+        """Appends data at the current offset, like a file."""
+        while len(data) > 0:
+            data = data[os.write(self.fd, data):]
+    
+    def flush(self):
+        pass
+    
+    def read(self):
+        """All of the contents, whatever wrote them."""
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(self.fd, 65536)
+            if chunk == "":
+                return "".join(chunks)
+            chunks.append(chunk)
+    
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+    
+    def __del__(self):
+        self.close()
+
 
 def run(cmd,expectedcode=EXIT_SUCESS,raiseOnError=True,lock=True,outputpaths=None,env=os.environ):
     global utilLock
@@ -23,7 +23,12 @@ import ConfigParser
 import sys
 import urlparse
 import json
+import zlib
+import multiprocessing.pool
+import tornado.ioloop
 import tornado.web
+from tornado import gen
+from tornado.concurrent import Future
 from BaseHTTPServer import BaseHTTPRequestHandler
 import httplib
 import yaml
@@ -207,6 +212,104 @@ def echo_json_response(handler,code,status=None,results=None):
     else:
         return False
 
+# the thread read_chunk() reads on, created when first needed
+chunk_reader = None
+
+def __next_chunk(chunks):
+    try:
+        return (True,next(chunks,None))
+    except Exception as e:
+        return (False,e)
+
+def read_chunk(chunks):
+    """A Future for the next of the chunks iterator, or None after the last one.  It is
+    read on a thread of its own, so the IOLoop doesn't wait for the disk meanwhile."""
+    global chunk_reader
+    if chunk_reader is None or chunk_reader[0] != os.getpid():
+        chunk_reader = (os.getpid(),multiprocessing.pool.ThreadPool(1))
+    future = Future()
+    io_loop = tornado.ioloop.IOLoop.current()
+    def on_done(outcome):
+        if outcome[0]:
+            io_loop.add_callback(future.set_result,outcome[1])
+        else:
+            io_loop.add_callback(future.set_exception,outcome[1])
+    chunk_reader[1].apply_async(__next_chunk,(chunks,),callback=on_done)
+    return future
+
+@gen.coroutine
+def echo_json_response_stream(handler,code,status=None,results=None,key=None,chunks=None,read=None):
+    """Like echo_json_response() for tornado handlers, but results[key] is the string 
+    made up of chunks, which are written out and flushed one by one instead of the
+    whole response being built in memory first.  Each chunk must be valid on its own
+    in a JSON string, e.g. whole lines.  read(chunks), e.g. read_chunk, returns a 
+    Future for the next chunk, or None after the last, if chunks are slow to get."""
+    if status is None:
+        status = httplib.responses[code]
+    if results is None:
+        results = {}
+    
+    head = json.dumps(results)[:-1]
+    if len(results) > 0:
+        head += ", "
+    handler.set_status(code)
+    handler.set_header('Content-Type', 'application/json')
+    handler.write('{"code": %d, "status": %s, "results": %s%s: "'%(code,json.dumps(status),head,json.dumps(key)))
+    chunks = iter(chunks)
+    while True:
+        if read is None:
+            chunk = next(chunks,None)
+        else:
+            chunk = yield read(chunks)
+        if chunk is None:
+            break
+        handler.write(json.dumps(chunk)[1:-1])
+        yield handler.flush()
+    handler.write('"}}')
+    handler.finish()
+
+class CompressContentEncoding(tornado.web.OutputTransform):
+    """Compresses JSON responses with gzip or deflate, whichever the client accepts 
+    first.  tornado's own GZipContentEncoding only knows gzip.  Every flush of the 
+    response is flushed through the compressor, so streamed responses go out as they
+    are written."""
+    LEVEL = 6
+    # not worth it for short responses
+    MIN_LENGTH = 1024
+    
+    def __init__(self, request):
+        self.encoding = None
+        self.compressor = None
+        for token in request.headers.get("Accept-Encoding", "").split(","):
+            params = [param.strip() for param in token.split(";")]
+            if params[0] in ("gzip","deflate") and "q=0" not in params:
+                self.encoding = params[0]
+                break
+    
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        if 'Vary' in headers:
+            headers['Vary'] += ', Accept-Encoding'
+        else:
+            headers['Vary'] = 'Accept-Encoding'
+        if (self.encoding is not None and headers.get("Content-Type", "").split(";")[0] == 'application/json' 
+                and (not finishing or len(chunk) >= self.MIN_LENGTH) and "Content-Encoding" not in headers):
+            headers["Content-Encoding"] = self.encoding
+            # gzip wraps the deflate stream in its own header and trailer, deflate in zlib's
+            wbits = (zlib.MAX_WBITS, 16+zlib.MAX_WBITS)[self.encoding == "gzip"]
+            self.compressor = zlib.compressobj(self.LEVEL, zlib.DEFLATED, wbits)
+            chunk = self.transform_chunk(chunk, finishing)
+            if "Content-Length" in headers:
+                if finishing:
+                    headers["Content-Length"] = str(len(chunk))
+                else:
+                    del headers["Content-Length"]
+        return status_code, headers, chunk
+    
+    def transform_chunk(self, chunk, finishing):
+        if self.compressor is not None:
+            chunk = self.compressor.compress(chunk) + self.compressor.flush((zlib.Z_SYNC_FLUSH, zlib.Z_FINISH)[finishing])
+        return chunk
+
 def list_to_dict(list):
     """Convert list into dictionary via grouping [k0,v0,k1,v1,...]"""
     params = {}
@@ -257,8 +360,10 @@ MAX_STALE_REGISTRAR_CACHE = 200
 
 if STUB_IMA:
     IMA_ML = '../scripts/ima/ascii_runtime_measurements'
+    IMA_ML_BIN = None
 else:
     IMA_ML = '/sys/kernel/security/ima/ascii_runtime_measurements'
+    IMA_ML_BIN = '/sys/kernel/security/ima/binary_runtime_measurements'
     
 IMA_PCR = 10
 
@@ -23,12 +23,12 @@ import base64
 # Crypto implementation using Cryptodomex package
  
 from Cryptodome.Random import get_random_bytes 
-from Cryptodome.Hash import HMAC,SHA384
+from Cryptodome.Hash import HMAC,SHA1,SHA384
 from Cryptodome.Cipher import PKCS1_OAEP
 from Cryptodome.PublicKey import RSA
 from Cryptodome.Cipher import AES
 from Cryptodome.Protocol import KDF
-from Cryptodome.Signature import pss
+from Cryptodome.Signature import pss, pkcs1_15
 
  
 def rsa_import_pubkey(buf):
@@ -59,6 +59,15 @@ def rsa_verify(pubkey,received_message,signature):
         return True
     except ValueError:
         return False
+
+# TPM 1.2 signatures (quotes, certify) are PKCS#1 v1.5 over SHA1, signature is raw bytes
+def rsa_verify_sha1_pkcs1(pubkey,received_message,signature):
+    h = SHA1.new(received_message)
+    try:
+        pkcs1_15.new(pubkey).verify(h, signature)
+        return True
+    except ValueError:
+        return False
    
 # don't use tpm randomness on encrypt to avoid contention for TPM  
 def rsa_encrypt(key,message):
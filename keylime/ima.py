@@ -21,11 +21,15 @@ violate any copyrights that exist in this work.
 import sys
 import common
 import keylime_logging
+import ima_whitelist
 import hashlib
 import struct
-import re
 import os
 import ConfigParser
+import json
+import base64
+import zlib
+import logging
 
 logger = keylime_logging.init_logging('ima')
 
@@ -40,103 +44,129 @@ config.read(common.CONFIG_FILE)
 START_HASH = '0000000000000000000000000000000000000000'.decode('hex')
 FF_HASH =  'ffffffffffffffffffffffffffffffffffffffff'.decode('hex')
 
-# struct event {
-#     struct {
-#         u_int32_t pcr;
-#         u_int8_t digest[SHA_DIGEST_LENGTH];
-#         u_int32_t name_len;
-#     } header;
-#     char name[TCG_EVENT_NAME_LEN_MAX + 1];
-#     struct ima_template_desc *template_desc; /* template descriptor */
-#     u_int32_t template_data_len;
-#     u_int8_t *template_data;    /* template related data */
-# };
-
-
-def read_unpack(fd,fmt):
-    return struct.unpack(fmt,fd.read(struct.calcsize(fmt)))
-    
+# Binary measurement list entries, as in binary_runtime_measurements (little endian):
+#
+#     u32 pcr
+#     u8  template_hash[SHA_DIGEST_LEN]
+#     u32 template_name_len
+#     char template_name[template_name_len]
+#     template data
+#
+# For the 'ima' template the data is the file digest (20 bytes) followed by a u32
+# length and the file name without terminator.  For the others it is a u32 length and
+# then the template data exactly as it is hashed into the template hash: each field as
+# a u32 length followed by its data.
+
 TCG_EVENT_NAME_LEN_MAX=255
 SHA_DIGEST_LEN=20
 
+# how a measurement list is sent to the verifier: as is, or the binary list zlib
+# compressed and base64 encoded
+ML_FORMAT_ASCII = 'ascii'
+ML_FORMAT_BINARY = 'binary'
+
+ENTRY_HEADER = struct.Struct("<I20sI")
+U32 = struct.Struct("<I")
+
+# how much of a measurement list is read from disk at once when it is streamed
+ML_CHUNK_SIZE = 64*1024
+
+# template name : fields
 defined_templates={
                    'ima':'d|n',
                    'ima-ng':'d-ng|n-ng',
-                   'ima-sig':'d-ng|n-ng|sig;',
+                   'ima-sig':'d-ng|n-ng|sig',
                    }
 
-def ima_eventname_parse():
-    pass
+def next_entry(ml, offset, binary=False):
+    """Returns the offset just past the entry starting at offset, or -1 if there is no
+    complete entry there."""
+    if not binary:
+        if offset >= len(ml):
+            return -1
+        end = ml.find('\n',offset)
+        if end == -1:
+            return len(ml)
+        return end+1
+    
+    pos = offset+ENTRY_HEADER.size
+    if pos > len(ml):
+        return -1
+    name_len = ENTRY_HEADER.unpack_from(ml,offset)[2]
+    if name_len > TCG_EVENT_NAME_LEN_MAX:
+        raise Exception("invalid binary measurement list, template name too long: %d"%name_len)
+    pos += name_len
+    if ml[pos-name_len:pos] == 'ima':
+        pos += SHA_DIGEST_LEN
+    if pos+U32.size > len(ml):
+        return -1
+    pos += U32.size+U32.unpack_from(ml,pos)[0]
+    if pos > len(ml):
+        return -1
+    return pos
 
-def ima_eventdigest_ng_parse():
-    pass
+def encode_binary_list(ml):
+    return base64.b64encode(zlib.compress(ml))
 
+def encode_binary_chunks(chunks):
+    """Yields the pieces of encode_binary_list() of the list made up of chunks, as they
+    are compressed."""
+    compressor = zlib.compressobj()
+    rest = ''
+    for chunk in chunks:
+        rest += compressor.compress(chunk)
+        # base64 encodes 3 bytes at a time, keep the rest for the next piece
+        size = len(rest) - len(rest)%3
+        if size > 0:
+            yield base64.b64encode(rest[:size])
+            rest = rest[size:]
+    yield base64.b64encode(rest + compressor.flush())
 
-def ima_eventname_ng_parse():
-    pass
+def decode_binary_list(data):
+    return zlib.decompress(base64.b64decode(data))
 
-def ima_eventsig_parse():
-    pass
+def iter_lines(ml):
+    """Yields the lines of an ascii measurement list like ml.split('\\n'), without 
+    building a list of all of them."""
+    start = 0
+    while True:
+        end = ml.find('\n',start)
+        if end == -1:
+            yield ml[start:]
+            return
+        yield ml[start:end]
+        start = end+1
 
-supported_fields ={
-                   "n":ima_eventname_parse,
-                   "d-ng":ima_eventdigest_ng_parse,
-                   "n-ng":ima_eventname_ng_parse,
-                   "sig":ima_eventsig_parse,
-                   }
- 
-def read_measreument_list_bin(path,whitelist):
-    raise Exception("not implementated fully yet")
-    f = open(path, 'rb')
+def count_entries(ml, binary=False):
+    """(number of entries, last entry) of ml, like split_entries() without keeping the
+    entries."""
+    count = 0
+    start = offset = 0
+    while True:
+        end = next_entry(ml,offset,binary)
+        if end == -1:
+            return count,ml[start:offset]
+        count += 1
+        start,offset = offset,end
 
+def split_entries(ml, binary=False):
+    """Splits a measurement list into its entries, each as it appears in the list."""
+    if not binary:
+        return ml.splitlines(True)
+    entries = []
+    offset = 0
     while True:
-        template={}
-        (template['pcr'],template['digest'],template['name_len']) = read_unpack(f,"<I20sI")
-        
-        if template['name_len']>TCG_EVENT_NAME_LEN_MAX:
-            raise Exception("Error event name too long %d",template['name_len'])
-    
-        name = read_unpack(f,"<%ds"%template['name_len'])[0]
-        
-        is_ima_template = name=='ima'
-        if not is_ima_template:
-            template['data_len']=read_unpack(f,"<I")[0]
-            print "reading ima len %d"%template['data_len']
-        else:
-            template['data_len'] = SHA_DIGEST_LEN+TCG_EVENT_NAME_LEN_MAX+1
-        
-        template['data'] = read_unpack(f,"<%ds"%template['data_len'])[0]
-        
-        if is_ima_template:
-            field_len = read_unpack(f,"<I")[0]
-            extra_data=read_unpack(f,"<%ds"%field_len)[0]
-            template['data']+= extra_data 
-        
-        print "record %s"%template
-        
-        if template['name'] not in defined_templates.keys():
-            template['name']='ima'
-        template['desc-fmt']=defined_templates[template['name']]
-        
-        #tokens = template['desc-fmt'].split('|') 
-        
-        import pdb; pdb.set_trace()
-        
-def process_measurement_list(lines,lists=None,m2w=None):
-    errs = [0,0,0,0]
-    runninghash = START_HASH
-    
-    
-    if lists is not None:
-        whitelist = lists['whitelist']
-        exclude_list = lists['exclude']
-    else:
-        whitelist = None
-        
-    combined=None
-    if exclude_list != []:
-        combined = "(" + ")|(".join(exclude_list) + ")"
-        
+        end = next_entry(ml,offset,True)
+        if end == -1:
+            break
+        entries.append(ml[offset:end])
+        offset = end
+    return entries
+
+def __ascii_entries(lines):
+    """Yields (template hash, hashed template data, file hash, path) for each line, or 
+    None for an invalid one.  Template data is None for violations, which are recorded
+    with a zero template hash."""
     for line in lines:
         line = line.strip()
         tokens = line.split(None, 4)
@@ -145,57 +175,288 @@ def process_measurement_list(lines,lists=None,m2w=None):
             continue
         if len(tokens) != 5:
             logger.error("invalid measurement list file line: -%s-"%(line))
-            return None
+            yield None
+            return
         
-        #print tokens
-        #pcr = tokens[0]
         template_hash=tokens[1].decode('hex')
         mode = tokens[2]
+        tohash = None
         
-        if mode =="ima-ng":        
+        if mode =="ima-ng":
             filedata = tokens[3]
             ftokens = filedata.split(":")
             filedata_algo = str(ftokens[0])
             filedata_hash = ftokens[1].decode('hex')
             path = str(tokens[4])
             
-            # this is some IMA weirdness
-            if template_hash == START_HASH:
-                template_hash = FF_HASH
-            else:
+            if template_hash != START_HASH:
                 #verify template hash. yep this is terrible
                 fmt = "<I%dsBB%dsI%dsB"%(len(filedata_algo),len(filedata_hash),len(path))
                 # +2 for the : and the null terminator, and +1 on path for null terminator
                 tohash=struct.pack(fmt,len(filedata_hash)+len(filedata_algo)+2,filedata_algo,ord(':'),ord('\0'),filedata_hash,len(path)+1,path,ord('\0'))
-                expected_template_hash = hashlib.sha1(tohash).digest()
-                
-                if expected_template_hash!=template_hash:
-                    errs[0]+=1
-                    logger.warning("template hash for file %s does not match %s != %s"%(path,expected_template_hash.encode('hex'),template_hash.encode('hex')))     
         elif mode=='ima':
             filedata_hash = tokens[3].decode('hex')
             path = str(tokens[4])
             
-            # this is some IMA weirdness
-            if template_hash == START_HASH:
-                template_hash = FF_HASH
-            else:
+            if template_hash != START_HASH:
                 #verify template hash. yep this is terrible
                 # name needs to be null padded out to MAX len. +1 is for the null terminator of the string itself
                 fmt = "<%ds%ds%ds"%(len(filedata_hash),len(path),TCG_EVENT_NAME_LEN_MAX-len(path)+1)
                 tohash=struct.pack(fmt,filedata_hash,path,str(bytearray(TCG_EVENT_NAME_LEN_MAX-len(path)+1)))
-                #print len(tohash)
-                #print tohash.encode('hex')
-                expected_template_hash = hashlib.sha1(tohash).digest()
-                
-                if expected_template_hash!=template_hash:
-                    errs[0]+=1
-                    logger.warning("template hash for file %s does not match %s != %s"%(path,expected_template_hash.encode('hex'),template_hash.encode('hex')))     
         else:
             raise Exception("unsupported ima template mode: %s"%mode)
+        
+        yield template_hash, tohash, filedata_hash, path
+
+def __binary_entries(ml):
+    """Like __ascii_entries() for a binary measurement list.  The template data is
+    hashed as it appears in the list."""
+    offset = 0
+    while offset < len(ml):
+        end = next_entry(ml,offset,True)
+        if end == -1:
+            logger.error("truncated binary measurement list entry at byte %d"%offset)
+            yield None
+            return
+        _, template_hash, name_len = ENTRY_HEADER.unpack_from(ml,offset)
+        pos = offset+ENTRY_HEADER.size
+        name = ml[pos:pos+name_len]
+        pos += name_len
+        
+        if name == 'ima':
+            filedata_hash = ml[pos:pos+SHA_DIGEST_LEN]
+            path = ml[pos+SHA_DIGEST_LEN+U32.size:end]
+            # hashed with the name null padded out to MAX len, +1 for the terminator
+            tohash = filedata_hash+path+'\0'*(TCG_EVENT_NAME_LEN_MAX+1-len(path))
+        elif name in defined_templates:
+            tohash = ml[pos+U32.size:end]
+            fields = []
+            pos = 0
+            while pos < len(tohash):
+                field_len = U32.unpack_from(tohash,pos)[0]
+                fields.append(tohash[pos+U32.size:pos+U32.size+field_len])
+                pos += U32.size+field_len
+            if len(fields) < 2:
+                logger.error("invalid %s template data in binary measurement list at byte %d"%(name,offset))
+                yield None
+                return
+            # algo:\0digest and the null terminated path
+            filedata_hash = fields[0][fields[0].find(':\0')+2:]
+            path = fields[1].rstrip('\0')
+        else:
+            raise Exception("unsupported ima template mode: %s"%name)
+        
+        if template_hash == START_HASH:
+            tohash = None
+        yield template_hash, tohash, filedata_hash, path
+        offset = end
+
+# (path, entry, byte offset) just past the last entry handed out by open_measurement_list
+__last_read = None
+
+def __entry_chunks(f, binary, chunk_size):
+    """Yields (chunk, number of entries in it) for the rest of the measurement list 
+    file f, in chunks of whole entries of about chunk_size bytes.  The last chunk is 
+    whatever is left at the end, even if it isn't a whole entry."""
+    rest = ''
+    while True:
+        data = f.read(chunk_size)
+        if data == '':
+            if rest != '':
+                yield rest,count_entries(rest,binary)[0]
+            return
+        rest += data
+        if binary:
+            count = 0
+            offset = 0
+            while True:
+                end = next_entry(rest,offset,True)
+                if end == -1:
+                    break
+                count += 1
+                offset = end
+        else:
+            offset = rest.rfind('\n')+1
+            count = rest.count('\n',0,offset)
+        if offset > 0:
+            yield rest[:offset],count
+            rest = rest[offset:]
+
+def __skip_entries(f, nth_entry, binary, chunk_size):
+    """Reads through nth_entry entries of the measurement list file f and returns the
+    byte offset just past them, or -1 if the list has fewer entries."""
+    offset = 0
+    skipped = 0
+    for chunk,count in __entry_chunks(f,binary,chunk_size):
+        if skipped+count < nth_entry:
+            skipped += count
+            offset += len(chunk)
+            continue
+        pos = 0
+        for _ in range(nth_entry-skipped):
+            pos = next_entry(chunk,pos,binary)
+        return offset+pos
+    if skipped == nth_entry:
+        return offset
+    return -1
+
+def __stream_entries(f, ml_path, nth_entry, offset, binary, chunk_size):
+    global __last_read
+    try:
+        for chunk,count in __entry_chunks(f,binary,chunk_size):
+            nth_entry += count
+            offset += len(chunk)
+            yield chunk
+        __last_read = (ml_path,nth_entry,offset)
+    finally:
+        f.close()
+
+def open_measurement_list(ml_path, nth_entry=0, binary=False, chunk_size=ML_CHUNK_SIZE):
+    """Like read_measurement_list(), but returns (chunks, nth_entry) right after finding
+    entry nth_entry.  chunks yields the list from there on in pieces of whole entries as
+    it is read, so it is never all in memory.  Finding the entry only reads through the
+    entries before it."""
+    f = open(ml_path,('r','rb')[binary])
+    try:
+        last_read = __last_read
+        if nth_entry > 0 and last_read is not None and last_read[:2] == (ml_path,nth_entry):
+            offset = last_read[2]
+        else:
+            offset = __skip_entries(f,nth_entry,binary,chunk_size)
+            if offset == -1:
+                offset = 0
+                nth_entry = 0
+        f.seek(offset)
+    except Exception:
+        f.close()
+        raise
+    return __stream_entries(f,ml_path,nth_entry,offset,binary,chunk_size),nth_entry
+
+def read_measurement_list(ml_path, nth_entry=0, binary=False):
+    """Reads the measurement list starting at entry nth_entry (counting from 0).
+    
+    Returns (ml, nth_entry).  If the list has fewer than nth_entry entries, e.g. because
+    the machine rebooted, the whole list is returned with nth_entry 0.  Requests that
+    continue where the previous one stopped seek straight to the next entry.
+    """
+    chunks,nth_entry = open_measurement_list(ml_path,nth_entry,binary)
+    return ''.join(chunks),nth_entry
+
+def new_state():
+    """Where checking a measurement list should pick up: after 'entry' entries, which
+    take up the first 'offset' bytes of the list and end with the line 'last', with
+    running hash 'hash' (hex).  'partial' is set if the list to check only holds the
+    entries after those, 'binary' if it is a binary list."""
+    return {'entry': 0, 'hash': '', 'offset': 0, 'last': '', 'partial': False, 'binary': False, 'resync': False}
+
+def reset_state(state):
+    state.update({'entry': 0, 'hash': '', 'offset': 0, 'last': ''})
+
+def starts_with(ml, offset, last, binary=False):
+    """Cheap check that ml still holds the entries described by offset and last, i.e.
+    the entry ending at offset is last."""
+    start = offset - len(last)
+    if start < 0 or ml[start:offset] != last:
+        return False
+    return start == 0 or binary or ml[start-1] == '\n'
+
+def whitelist_version(lists):
+    """A digest identifying the contents of whitelist and exclude list lists."""
+    return hashlib.sha1(json.dumps(lists, sort_keys=True)).hexdigest()
+
+# kinds of failed entries, as indexes into FailureSummary.counts
+TEMPLATE_HASH_FAILURE = 0
+NOT_FOUND_FAILURE = 1
+HASH_FAILURE = 2
+GOOD_ENTRIES = 3
+
+class FailureSummary(object):
+    """How the entries of a measurement list failed to check out: counts of each kind of
+    failure and of good entries, and the first max_samples offending entries of each kind
+    as [path, detail].  A bad list is reported with one of these, and logged once, 
+    rather than with a log message per entry."""
+    KINDS = ['template_hash', 'not_found', 'hash']
+    
+    def __init__(self, max_samples=None):
+        if max_samples is None:
+            max_samples = config.getint('cloud_verifier','ima_failure_samples')
+        self.max_samples = max_samples
+        self.counts = [0,0,0,0]
+        self.samples = [[],[],[]]
+    
+    def add(self, kind, path, detail=""):
+        self.counts[kind] += 1
+        if len(self.samples[kind]) < self.max_samples:
+            self.samples[kind].append([path, detail])
+    
+    def merge(self, other):
+        """Adds the failures of other, for entries after the ones in this summary."""
+        for kind in range(len(self.counts)):
+            self.counts[kind] += other.counts[kind]
+        for kind in range(len(self.samples)):
+            room = self.max_samples - len(self.samples[kind])
+            self.samples[kind].extend(other.samples[kind][:max(room,0)])
+    
+    def failed(self):
+        return sum(self.counts[:GOOD_ENTRIES]) > 0
+    
+    def to_dict(self):
+        d = {'good': self.counts[GOOD_ENTRIES]}
+        for kind, name in enumerate(self.KINDS):
+            d[name] = self.counts[kind]
+            d[name + '_samples'] = self.samples[kind]
+        return d
+    
+    def __str__(self):
+        examples = [sample[0] for samples in self.samples for sample in samples[:3]]
+        return "template-hash %d fnf %d hash %d good %d, e.g. %s"%(tuple(self.counts) + (", ".join(examples),))
+
+def process_measurement_list(lines,lists=None,m2w=None,start_hash=START_HASH,failures=None):
+    """Checks lines against the whitelist and returns the resulting PCR value as hex, or
+    None on errors.  To check a list piecewise, pass the value returned for the previous
+    lines as start_hash (as raw bytes).  failures, if given, is a FailureSummary the 
+    entries are counted in."""
+    return __process_entries(__ascii_entries(lines),lists,m2w,start_hash,failures)
+
+def process_measurement_list_bin(ml,lists=None,m2w=None,start_hash=START_HASH,failures=None):
+    """Like process_measurement_list() for a binary measurement list."""
+    return __process_entries(__binary_entries(ml),lists,m2w,start_hash,failures)
+
+def __unpack_lists(lists):
+    """(whitelist, ExcludeMatcher or None) from lists."""
+    if lists is None:
+        return None,None
+    exclude_list = lists['exclude']
+    if isinstance(exclude_list,ima_whitelist.ExcludeMatcher):
+        return lists['whitelist'],exclude_list
+    if exclude_list != []:
+        return lists['whitelist'],ima_whitelist.ExcludeMatcher(exclude_list)
+    return lists['whitelist'],None
+
+def __check_entries(entries,whitelist,exclude,m2w,failures):
+    """Checks entries against the whitelist, counting them in the FailureSummary 
+    failures, and yields the hash each one extends the PCR with.  Yields None and stops
+    at an invalid entry."""
+    # compiled whitelists are looked up with raw digests
+    compiled = isinstance(whitelist,ima_whitelist.CompiledWhitelist)
+    counts = failures.counts
+    debug = logger.isEnabledFor(logging.DEBUG)
+        
+    for entry in entries:
+        if entry is None:
+            yield None
+            return
+        template_hash, tohash, filedata_hash, path = entry
+        
+        # this is some IMA weirdness
+        if template_hash == START_HASH:
+            template_hash = FF_HASH
+        else:
+            expected_template_hash = hashlib.sha1(tohash).digest()
+            if expected_template_hash!=template_hash:
+                failures.add(TEMPLATE_HASH_FAILURE,path,"%s != %s"%(expected_template_hash.encode('hex'),template_hash.encode('hex')))
                
-        # update hash
-        runninghash = hashlib.sha1(runninghash+template_hash).digest()
+        yield template_hash
         
         # write out the new hash
         if m2w is not None:
@@ -209,29 +470,118 @@ def process_measurement_list(lines,lists=None,m2w=None):
                 continue
             
             # determine if path matches any exclusion list items
-            if combined is not None and re.match(combined,path):
-                logger.debug("IMA: ignoring excluded path %s"%path)
+            if exclude is not None and exclude.match(path):
+                if debug:
+                    logger.debug("IMA: ignoring excluded path %s"%path)
                 continue            
             
-            accept_list = whitelist.get(path,None)
+            if compiled:
+                accept_list = whitelist.get_digests(path)
+                digest = filedata_hash
+            else:
+                accept_list = whitelist.get(path,None)
+                digest = filedata_hash.encode('hex')
             if accept_list is None:
-                logger.warning("File not found in whitelist: %s"%(path))
-                errs[1]+=1
+                failures.add(NOT_FOUND_FAILURE,path)
                 continue
-            if filedata_hash.encode('hex') not in accept_list:
-                logger.warning("Hashes for file %s don't match %s not in %s"%(path,filedata_hash.encode('hex'),accept_list))
-                errs[2]+=1
+            if digest not in accept_list:
+                failures.add(HASH_FAILURE,path,filedata_hash.encode('hex'))
                 continue
         
-        errs[3]+=1
-        
+        counts[GOOD_ENTRIES]+=1
+
+def __result(runninghash,failures):
     # clobber the retval if there were IMA file errors 
-    if sum(errs[:3])>0:
-        logger.error("IMA ERRORS: template-hash %d fnf %d hash %d good %d"%tuple(errs))
+    if failures.failed():
+        logger.error("IMA ERRORS: %s"%failures)
         return None
-        
     return runninghash.encode('hex')
 
+def __process_entries(entries,lists,m2w,start_hash,failures):
+    if failures is None:
+        failures = FailureSummary()
+    runninghash = start_hash
+    whitelist,exclude = __unpack_lists(lists)
+    
+    for template_hash in __check_entries(entries,whitelist,exclude,m2w,failures):
+        if template_hash is None:
+            return None
+        # update hash
+        runninghash = hashlib.sha1(runninghash+template_hash).digest()
+    
+    return __result(runninghash,failures)
+
+def __split_list(ml,count,binary):
+    """Splits a measurement list into about count pieces of whole entries."""
+    size = max(len(ml)/count,1)
+    pieces = []
+    start = 0
+    while start < len(ml):
+        if binary:
+            end = start
+            while end != -1 and end-start < size:
+                end = next_entry(ml,end,True)
+            if end == -1:
+                # truncated, the last piece will say so
+                end = len(ml)
+        else:
+            end = ml.find('\n',start+size)
+            end = len(ml) if end == -1 else end+1
+        pieces.append(ml[start:end])
+        start = end
+    return pieces
+
+def split_measurement_list(ml,chunks,binary=False):
+    """Splits the measurement list ml into about chunks pieces of whole entries, to be
+    checked with check_piece() in parallel, if it is at least ima_parallel_min_size 
+    bytes.  Returns None for smaller lists."""
+    if chunks < 2 or len(ml) < config.getint('cloud_verifier','ima_parallel_min_size'):
+        return None
+    return __split_list(ml,chunks,binary)
+
+def check_piece(piece,binary,lists,max_samples=None):
+    """Checks a piece of a measurement list from split_measurement_list() and returns 
+    (the hashes it extends the PCR with, concatenated, or None if it is invalid, a
+    FailureSummary)."""
+    failures = FailureSummary(max_samples)
+    if binary:
+        entries = __binary_entries(piece)
+    else:
+        entries = __ascii_entries(iter_lines(piece))
+    whitelist,exclude = __unpack_lists(lists)
+    hashes = []
+    for template_hash in __check_entries(entries,whitelist,exclude,None,failures):
+        if template_hash is None:
+            return None,failures
+        hashes.append(template_hash)
+    return ''.join(hashes),failures
+
+def combine_pieces(results,start_hash=START_HASH,failures=None):
+    """The PCR value as hex, or None on errors, of a measurement list whose pieces were
+    checked with check_piece(), from their results in order.  Failed entries are
+    counted in the FailureSummary failures, if given."""
+    if failures is None:
+        failures = FailureSummary()
+    runninghash = start_hash
+    for hashes,piece_failures in results:
+        failures.merge(piece_failures)
+        if hashes is None:
+            return None
+        for pos in xrange(0,len(hashes),SHA_DIGEST_LEN):
+            runninghash = hashlib.sha1(runninghash+hashes[pos:pos+SHA_DIGEST_LEN]).digest()
+    return __result(runninghash,failures)
+
+def check_measurement_list(ml,lists,start_hash=START_HASH,binary=False,failures=None):
+    """Checks the measurement list ml and returns the PCR value as hex or None on 
+    errors.  Failed entries are counted in the FailureSummary failures, if given."""
+    if binary:
+        return process_measurement_list_bin(ml,lists,start_hash=start_hash,failures=failures)
+    return process_measurement_list(iter_lines(ml),lists,start_hash=start_hash,failures=failures)
+
+def compile_whitelists(lists):
+    """Returns lists from process_whitelists() with the whitelist and exclude list compiled."""
+    return {'whitelist':ima_whitelist.CompiledWhitelist.from_dict(lists['whitelist']),'exclude':ima_whitelist.ExcludeMatcher(lists['exclude'])}
+
 def process_whitelists(wl_data, excl_data):
     # Pull in default config values if not specified 
     if wl_data is None:
@@ -296,7 +646,8 @@ def read_excllist(exclude_path=None):
     return excl_list
 
 def main(argv=sys.argv):
-    #read_measreument_list_bin("/sys/kernel/security/ima/binary_runtime_measurements", None)
+    #with open("/sys/kernel/security/ima/binary_runtime_measurements",'rb') as f:
+    #    print "binary list digest is %s"%process_measurement_list_bin(f.read())
     
     whitelist_path = 'whitelist.txt'
     #whitelist_path = '../scripts/gerardo/whitelist.txt'
@@ -0,0 +1,418 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2019 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+import array
+import bisect
+import mmap
+import re
+import struct
+import sys
+import zlib
+
+import keylime_logging
+
+logger = keylime_logging.init_logging('ima_whitelist')
+
+# A whitelist compiled into a single buffer, so it takes a fraction of the memory of
+# the {path: [hex digest, ...]} dict from ima.process_whitelists(), pickles as one
+# string, and can be saved to and mmap'ed from a file.  Everything is little endian:
+#
+#     header   magic, version, number of paths, number of digests, table size
+#     table    table size u32 slots, open addressing on crc32(path), each holding
+#              1 + the index of an entry or 0 if empty.  table size is a power of 2
+#              at least twice the number of paths
+#     entries  per path: u32 path offset, u32 path length, u32 digests offset,
+#              u32 digests length.  offsets are from the start of the buffer
+#     paths    the utf-8 paths back to back
+#     digests  per path its raw digests, each prefixed with a u8 length
+
+MAGIC = 'KLWL'
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct("<4sIIII")
+SLOT = struct.Struct("<I")
+ENTRY = struct.Struct("<IIII")
+
+
+# regex characters that make a pattern more than a literal
+REGEX_SPECIAL = set('.^$*+?{}[]|()')
+# anchored globs are indexed by this many trailing characters
+SUFFIX_LEN = 3
+# exclude lists up to this long are matched with one regex
+SMALL_EXCLUDE_LIST = 16
+
+
+def _u32_array(values):
+    a = array.array('I', values)
+    if a.itemsize != 4:
+        a = array.array('L', values)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a.tostring()
+
+
+class CompiledWhitelist(object):
+
+    def __init__(self, buf, path=None):
+        magic, version, self.num_paths, self.num_digests, self.table_size = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise Exception("not a compiled whitelist (version %d)"%FORMAT_VERSION)
+        self.buf = buf
+        self.path = path
+        self.mask = self.table_size - 1
+        self.entries_offset = HEADER.size + SLOT.size*self.table_size
+
+    @staticmethod
+    def compile(items):
+        """Compiles an iterable of (path, hex digest) pairs."""
+        digests = {}
+        for path, digest in items:
+            if isinstance(path, unicode):
+                path = path.encode('utf-8')
+            raw = digest.decode('hex')
+            raw = chr(len(raw)) + raw
+            known = digests.get(path)
+            if known is None:
+                digests[path] = raw
+            elif raw[1:] not in CompiledWhitelist.__split(known):
+                digests[path] = known + raw
+
+        paths = sorted(digests.keys())
+        table_size = 1
+        while table_size < 2*len(paths):
+            table_size *= 2
+
+        paths_offset = HEADER.size + SLOT.size*table_size + ENTRY.size*len(paths)
+        digests_offset = paths_offset + sum([len(p) for p in paths])
+        table = [0]*table_size
+        entries = []
+        path_at = paths_offset
+        digests_at = digests_offset
+        num_digests = 0
+        for index, path in enumerate(paths):
+            slot = zlib.crc32(path) & (table_size - 1)
+            while table[slot] != 0:
+                slot = (slot + 1) & (table_size - 1)
+            table[slot] = index + 1
+            entries.extend([path_at, len(path), digests_at, len(digests[path])])
+            path_at += len(path)
+            digests_at += len(digests[path])
+            num_digests += len(CompiledWhitelist.__split(digests[path]))
+
+        buf = ''.join([HEADER.pack(MAGIC, FORMAT_VERSION, len(paths), num_digests, table_size),
+                       _u32_array(table),
+                       _u32_array(entries),
+                       ''.join(paths),
+                       ''.join([digests[p] for p in paths])])
+        return CompiledWhitelist(buf)
+
+    @staticmethod
+    def from_dict(whitelist):
+        """Compiles a {path: [hex digest, ...]} whitelist as made by ima.process_whitelists()."""
+        return CompiledWhitelist.compile((path, digest) for path, hashes in whitelist.iteritems() for digest in hashes)
+
+    @staticmethod
+    def from_lines(lines):
+        """Compiles whitelist lines of the form "<hex digest> <path>", e.g. straight from
+        an open whitelist file, without holding on to the text."""
+        def items():
+            boot_aggregate = False
+            for line in lines:
+                tokens = line.strip().split(None, 1)
+                if len(tokens) != 2:
+                    continue
+                boot_aggregate = boot_aggregate or tokens[1] == 'boot_aggregate'
+                yield tokens[1], tokens[0]
+            if not boot_aggregate:
+                logger.warning("No boot_aggregate value found in whitelist, adding an empty one")
+                yield 'boot_aggregate', '00'*20
+        return CompiledWhitelist.compile(items())
+
+    @staticmethod
+    def load(filename, use_mmap=True):
+        with open(filename, 'rb') as f:
+            if use_mmap:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                buf = f.read()
+        return CompiledWhitelist(buf, filename)
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.buf[:])
+
+    @staticmethod
+    def __split(raw):
+        digests = []
+        pos = 0
+        while pos < len(raw):
+            size = ord(raw[pos])
+            digests.append(raw[pos+1:pos+1+size])
+            pos += 1 + size
+        return digests
+
+    def __find(self, path):
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        buf = self.buf
+        slot = zlib.crc32(path) & self.mask
+        while True:
+            index = SLOT.unpack_from(buf, HEADER.size + SLOT.size*slot)[0]
+            if index == 0:
+                return None
+            path_at, path_len, digests_at, digests_len = ENTRY.unpack_from(buf, self.entries_offset + ENTRY.size*(index-1))
+            if path_len == len(path) and buf[path_at:path_at+path_len] == path:
+                return buf[digests_at:digests_at+digests_len]
+            slot = (slot + 1) & self.mask
+
+    def get_digests(self, path):
+        """The raw digests accepted for path, or None if path is not in the whitelist."""
+        raw = self.__find(path)
+        if raw is None:
+            return None
+        return CompiledWhitelist.__split(raw)
+
+    def get(self, path, default=None):
+        """Like dict.get() on the whitelist dict, returning hex digests."""
+        digests = self.get_digests(path)
+        if digests is None:
+            return default
+        return [d.encode('hex') for d in digests]
+
+    def __contains__(self, path):
+        return self.__find(path) is not None
+
+    def __len__(self):
+        return self.num_paths
+
+    def iteritems(self):
+        for index in range(self.num_paths):
+            path_at, path_len, digests_at, digests_len = ENTRY.unpack_from(self.buf, self.entries_offset + ENTRY.size*index)
+            yield self.buf[path_at:path_at+path_len], [d.encode('hex') for d in CompiledWhitelist.__split(self.buf[digests_at:digests_at+digests_len])]
+
+    def to_dict(self):
+        return dict(self.iteritems())
+
+    def get_stats(self):
+        size = len(self.buf)
+        return {
+            'paths': self.num_paths,
+            'digests': self.num_digests,
+            'bytes': size,
+            'bytes_per_entry': float(size)/max(1, self.num_digests),
+            'mmap': isinstance(self.buf, mmap.mmap),
+            }
+
+    def __getstate__(self):
+        return {'buf': self.buf[:]}
+
+    def __setstate__(self, state):
+        self.__init__(state['buf'])
+
+
+def _parse_pattern(pattern):
+    """Splits an exclude pattern that only uses literal characters (escaped or not) and
+    .* into its literal pieces.  Returns (pieces, anchored at the end) or None if the
+    pattern needs a real regex."""
+    pieces = ['']
+    anchored = False
+    pos = 0
+    while pos < len(pattern):
+        c = pattern[pos]
+        if c == '\\' and pos+1 < len(pattern) and not pattern[pos+1].isalnum():
+            pieces[-1] += pattern[pos+1]
+            pos += 2
+        elif pattern.startswith('.*', pos):
+            if pieces[-1] != '' or pos == 0:
+                # a leading .* leaves an empty first piece
+                pieces.append('')
+            pos += 2
+        elif c == '$' and pos == len(pattern)-1:
+            anchored = True
+            pos += 1
+        elif c in REGEX_SPECIAL or c == '\\':
+            return None
+        else:
+            pieces[-1] += c
+            pos += 1
+    if len(pieces) > 1 and pieces[-1] == '':
+        # ends with .*, which matches anything
+        pieces.pop()
+        anchored = False
+    return pieces, anchored
+
+
+def _literal_prefix(pattern):
+    """The literal characters every match of pattern starts with."""
+    if '|' in pattern:
+        return ''
+    prefix = ''
+    pos = 0
+    while pos < len(pattern):
+        c = pattern[pos]
+        if c == '\\' and pos+1 < len(pattern) and not pattern[pos+1].isalnum():
+            c = pattern[pos+1]
+            pos += 1
+        elif c in REGEX_SPECIAL or c == '\\':
+            break
+        elif pattern[pos+1:pos+2] in ['*', '?', '{']:
+            # the character is optional or repeated
+            break
+        prefix += c
+        pos += 1
+    return prefix
+
+
+def _top_dir(path):
+    """'/usr/' for '/usr/bin/ls', None for paths not in a top level directory."""
+    if not path.startswith('/'):
+        return None
+    end = path.find('/', 1)
+    if end == -1:
+        return None
+    return path[:end+1]
+
+
+class ExcludeMatcher(object):
+    """Matches paths against a list of exclude regexes like re.match against their
+    alternation would, with the common cases handled without regexes:
+    
+    - literal patterns, or literals followed by .*, are prefixes.  They are kept sorted
+      with prefixes that are covered by shorter ones dropped, so the only candidate for
+      a path is the greatest prefix not after it, found with bisect.
+    - globs, literals joined by .* and optionally ending in $, are matched by finding
+      the pieces in order with str.find.
+    - the rest are regexes.  Globs and regexes are grouped by the top level directory
+      their literal prefix is in, and regexes in a group are compiled into one, so a
+      path is only checked against the patterns that could match it.  Globs ending in
+      $ are also indexed by their last few characters.
+
+    Short lists are just one regex.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.small = None
+        if len(self.patterns) <= SMALL_EXCLUDE_LIST:
+            # a handful of patterns are quicker in one regex
+            if len(self.patterns) > 0:
+                self.small = re.compile("(?:" + ")|(?:".join(self.patterns) + ")")
+            self.prefixes = []
+            self.groups = {}
+            self.generic = ([], {}, None)
+            return
+        prefixes = []
+        # top level directory or None : ([glob], [regex])
+        groups = {}
+        for pattern in self.patterns:
+            parsed = _parse_pattern(pattern)
+            if parsed is not None and len(parsed[0]) == 1 and not parsed[1]:
+                prefixes.append(parsed[0][0])
+                continue
+            if parsed is not None:
+                group = groups.setdefault(_top_dir(parsed[0][0]), ([], []))
+                group[0].append(parsed)
+            else:
+                group = groups.setdefault(_top_dir(_literal_prefix(pattern)), ([], []))
+                group[1].append(pattern)
+
+        self.prefixes = []
+        for prefix in sorted(set(prefixes)):
+            if len(self.prefixes) == 0 or not prefix.startswith(self.prefixes[-1]):
+                self.prefixes.append(prefix)
+        self.groups = {}
+        for key, (globs, regexes) in groups.items():
+            # globs ending in $ and a few literal characters, like .*\.pyc$, are only
+            # tried on paths with that ending
+            other_globs = []
+            by_suffix = {}
+            for pieces, anchored in globs:
+                if anchored and len(pieces) > 1 and len(pieces[-1]) >= SUFFIX_LEN:
+                    by_suffix.setdefault(pieces[-1][-SUFFIX_LEN:], []).append((pieces, anchored))
+                else:
+                    other_globs.append((pieces, anchored))
+            combined = None
+            if len(regexes) > 0:
+                # not capturing, python only allows 100 groups in a regex
+                combined = re.compile("(?:" + ")|(?:".join(regexes) + ")")
+            self.groups[key] = (other_globs, by_suffix, combined)
+        self.generic = self.groups.pop(None, ([], {}, None))
+
+    @staticmethod
+    def __match_glob(path, pieces, anchored):
+        if len(pieces) == 1:
+            # anything else would be a prefix
+            return path == pieces[0]
+        if not path.startswith(pieces[0]):
+            return False
+        pos = len(pieces[0])
+        for piece in pieces[1:-1]:
+            pos = path.find(piece, pos)
+            if pos == -1:
+                return False
+            pos += len(piece)
+        last = pieces[-1]
+        if anchored:
+            return len(path) - len(last) >= pos and path.endswith(last)
+        return path.find(last, pos) != -1
+
+    def __match_group(self, path, group):
+        globs, by_suffix, combined = group
+        for pieces, anchored in globs:
+            if ExcludeMatcher.__match_glob(path, pieces, anchored):
+                return True
+        if by_suffix:
+            for pieces, anchored in by_suffix.get(path[-SUFFIX_LEN:], ()):
+                if ExcludeMatcher.__match_glob(path, pieces, anchored):
+                    return True
+        return combined is not None and combined.match(path) is not None
+
+    def match(self, path):
+        if self.small is not None:
+            return self.small.match(path) is not None
+        index = bisect.bisect_right(self.prefixes, path)
+        if index > 0 and path.startswith(self.prefixes[index-1]):
+            return True
+        group = self.groups.get(_top_dir(path))
+        if group is not None and self.__match_group(path, group):
+            return True
+        return self.__match_group(path, self.generic)
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def __getstate__(self):
+        return {'patterns': self.patterns}
+
+    def __setstate__(self, state):
+        # verification workers get the same exclude lists over and over
+        key = tuple(state['patterns'])
+        matcher = _matcher_cache.get(key)
+        if matcher is None:
+            if len(_matcher_cache) >= MATCHER_CACHE_SIZE:
+                _matcher_cache.clear()
+            matcher = ExcludeMatcher(state['patterns'])
+            _matcher_cache[key] = matcher
+        self.__dict__.update(matcher.__dict__)
+
+
+MATCHER_CACHE_SIZE = 64
+# tuple of patterns : ExcludeMatcher, for unpickling
+_matcher_cache = {}
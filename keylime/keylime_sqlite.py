@@ -24,6 +24,13 @@ logger = keylime_logging.init_logging('keylime_sqlite')
 import os
 import sqlite3
 import json
+import threading
+
+# bump this and add a step to KeylimeDB.migrations when the on disk schema changes
+SCHEMA_VERSION = 1
+
+# sqlite3 keeps this many prepared statements per connection
+CACHED_STATEMENTS = 64
 
 class KeylimeDB():
     db_filename = None
@@ -33,16 +40,31 @@ class KeylimeDB():
     json_cols_db = None
     # in the form key : default value
     exclude_db = None
+    # columns other than agent_id that get an index
+    index_cols = None
+    # agent_id : {column : marshalled value}, waiting for flush()
+    pending = None
 
-    def __init__(self,dbname,cols_db,json_cols_db,exclude_db):
+    def __init__(self,dbname,cols_db,json_cols_db,exclude_db,index_cols=[]):
         self.db_filename = dbname
-        self.cols_db = cols_db
         self.json_cols_db = json_cols_db
         self.exclude_db = exclude_db
 
-        if 'agent_id' not in cols_db or 'PRIMARY_KEY' not in cols_db['agent_id']:
+        if 'agent_id' not in cols_db or ('PRIMARY KEY' not in cols_db['agent_id'] and 'PRIMARY_KEY' not in cols_db['agent_id']):
             raise Exception("the primary key of the database must be agent_id")
 
+        # older schemas said PRIMARY_KEY, which sqlite silently takes as part of the type name
+        self.cols_db = dict(cols_db)
+        self.cols_db['agent_id'] = cols_db['agent_id'].replace('PRIMARY_KEY','PRIMARY KEY')
+        self.index_cols = [col for col in index_cols if col in self.cols_db]
+
+        self.pending = {}
+        self.pending_lock = threading.RLock()
+        self.local = threading.local()
+        # one statement that rewrites every column of an agent
+        self.update_cols = sorted([key for key in self.cols_db.keys() if key!='agent_id'])
+        self.overwrite_sql = 'UPDATE main SET %s where agent_id = ?'%(", ".join(["%s = ?"%key for key in self.update_cols]))
+
         # turn off persistence by default in development mode
         if common.DEVELOP_IN_ECLIPSE and os.path.exists(self.db_filename):
             os.remove(self.db_filename)
@@ -54,19 +76,146 @@ class KeylimeDB():
         if os.geteuid()!=0 and common.REQUIRE_ROOT:
             logger.warning("Creating database without root.  Sensitive data may be at risk!")
 
-        with sqlite3.connect(self.db_filename) as conn:
+        with self.connection() as conn:
             cur = conn.cursor()
-            createstr = "CREATE TABLE IF NOT EXISTS main("
-            for key in sorted(self.cols_db.keys()):
-                createstr += "%s %s, "%(key,self.cols_db[key])
-            # lop off the last comma space
-            createstr = createstr[:-2]+')'
-            cur.execute(createstr)
+            cur.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='main'")
+            exists = cur.fetchone()[0]>0
+            cur.execute("PRAGMA user_version")
+            version = cur.fetchone()[0]
+
+            if not exists:
+                cur.execute(self.__create_table_sql('main'))
+            elif version<SCHEMA_VERSION:
+                self.__migrate(cur, version)
+            elif version>SCHEMA_VERSION:
+                raise Exception("Database %s has schema version %d, newer than supported version %d"%(self.db_filename,version,SCHEMA_VERSION))
+            self.__add_missing_columns(cur)
+
+            for col in self.index_cols:
+                cur.execute("CREATE INDEX IF NOT EXISTS main_%s ON main(%s)"%(col,col))
+            cur.execute("PRAGMA user_version = %d"%SCHEMA_VERSION)
             conn.commit()
         os.chmod(self.db_filename,0o600)
 
+    def __create_table_sql(self,name):
+        createstr = "CREATE TABLE %s("%name
+        for key in sorted(self.cols_db.keys()):
+            createstr += "%s %s, "%(key,self.cols_db[key])
+        # lop off the last comma space
+        return createstr[:-2]+')'
+
+    def __table_columns(self,cur):
+        cur.execute("PRAGMA table_info(main)")
+        return [row[1] for row in cur.fetchall()]
+
+    def __migrate(self,cur,version):
+        for step in range(version,SCHEMA_VERSION):
+            logger.info("Migrating database %s from schema version %d to %d"%(self.db_filename,step,step+1))
+            self.migrations[step](self,cur)
+
+    def __migrate_primary_key(self,cur):
+        """Version 0 tables had no primary key (see PRIMARY_KEY above), so rebuild the table
+        with a real one.  agent_id was never unique, keep the most recently written row."""
+        oldcols = self.__table_columns(cur)
+        cols = sorted(self.cols_db.keys())
+        values = []
+        for key in cols:
+            if key in oldcols:
+                values.append(key)
+            elif key in self.json_cols_db:
+                values.append("'null'")
+            else:
+                values.append("NULL")
+        cur.execute("DROP TABLE IF EXISTS main_migrate")
+        cur.execute(self.__create_table_sql('main_migrate'))
+        cur.execute("INSERT OR REPLACE INTO main_migrate(%s) SELECT %s FROM main ORDER BY rowid"%(",".join(cols),",".join(values)))
+        cur.execute("DROP TABLE main")
+        cur.execute("ALTER TABLE main_migrate RENAME TO main")
+
+    # migrations[n] takes schema version n to n+1
+    migrations = [__migrate_primary_key]
+
+    def __add_missing_columns(self,cur):
+        existing = self.__table_columns(cur)
+        for key in sorted(self.cols_db.keys()):
+            if key not in existing:
+                logger.info("Adding column %s to database %s"%(key,self.db_filename))
+                coldef = "%s %s"%(key,self.cols_db[key])
+                # existing rows have to hold valid json for get_agent
+                if key in self.json_cols_db:
+                    coldef += " DEFAULT 'null'"
+                cur.execute("ALTER TABLE main ADD COLUMN %s"%coldef)
+
+    def connection(self):
+        """Returns the connection for the calling thread, opening it if needed.  Connections
+        are not shared across threads or across a fork."""
+        conn = getattr(self.local,'conn',None)
+        if conn is not None and self.local.pid==os.getpid():
+            return conn
+        conn = sqlite3.connect(self.db_filename,cached_statements=CACHED_STATEMENTS)
+        # WAL lets readers in other processes run alongside the writer, and with it
+        # synchronous=NORMAL only gives up durability of the last transactions on power loss
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        self.local.conn = conn
+        self.local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        self.flush()
+        conn = getattr(self.local,'conn',None)
+        if conn is not None and self.local.pid==os.getpid():
+            conn.close()
+        self.local.conn = None
+
+    def marshal(self,key,value):
+        if key in self.json_cols_db:
+            return json.dumps(value)
+        return value
+
+    def queue_update(self,agent_id,fields):
+        """Queues new values for some columns of an agent until the next flush().  Later
+        writes to the same column replace earlier ones.  Returns True if the queue was
+        empty, so the caller knows to schedule a flush."""
+        for key in fields.keys():
+            if key not in self.update_cols:
+                raise Exception("Database key %s not in schema: %s"%(key,self.cols_db.keys()))
+        changes = {}
+        for key,value in fields.iteritems():
+            changes[key] = self.marshal(key,value)
+        with self.pending_lock:
+            was_empty = len(self.pending)==0
+            self.pending.setdefault(agent_id,{}).update(changes)
+        return was_empty
+
+    def queue_overwrite(self,agent_id,agent):
+        """Like overwrite_agent but the write is held until the next flush()."""
+        return self.queue_update(agent_id,dict([(key,agent[key]) for key in self.update_cols]))
+
+    def flush(self):
+        """Writes all queued agents in a single transaction."""
+        with self.pending_lock:
+            if len(self.pending)==0:
+                return 0
+            # agents with the same set of changed columns share a statement
+            batches = {}
+            for agent_id,changes in self.pending.iteritems():
+                cols = tuple(sorted(changes.keys()))
+                batches.setdefault(cols,[]).append([changes[key] for key in cols]+[agent_id])
+            with self.connection() as conn:
+                for cols,rows in batches.iteritems():
+                    if cols==tuple(self.update_cols):
+                        sql = self.overwrite_sql
+                    else:
+                        sql = 'UPDATE main SET %s where agent_id = ?'%(", ".join(["%s = ?"%key for key in cols]))
+                    conn.executemany(sql,rows)
+            count = len(self.pending)
+            self.pending = {}
+        return count
+
     def print_db(self):
-        with sqlite3.connect(self.db_filename) as conn:
+        self.flush()
+        with self.connection() as conn:
             cur = conn.cursor()
             cur.execute('SELECT * FROM main')
             rows = cur.fetchall()
@@ -81,29 +230,35 @@ class KeylimeDB():
             agent[key] = self.exclude_db[key]
         return agent
 
-    def add_agent(self,agent_id, d):
+    def add_agent(self,agent_id, d, check=None):
+        """Adds an agent, returns None if it already exists.  If given, check() is called 
+        before the insert is committed, under the database write lock; an exception from 
+        it undoes the insert."""
         d = self.add_defaults(d)
 
         d['agent_id']=agent_id
 
-        with sqlite3.connect(self.db_filename) as conn:
+        self.flush()
+        with self.connection() as conn:
             cur = conn.cursor()
-            cur.execute('SELECT * from main where agent_id=?',(d['agent_id'],))
+            cur.execute('SELECT agent_id from main where agent_id=?',(d['agent_id'],))
             rows = cur.fetchall()
             # don't allow overwrite
             if len(rows)>0:
                 return None
 
             insertlist = []
-            for key in sorted(self.cols_db.keys()):
+            cols = sorted(self.cols_db.keys())
+            for key in cols:
                 v = d[key]
                 if key in self.json_cols_db and (isinstance(d[key],dict) or isinstance(d[key],list)):
                     v = json.dumps(d[key])
                 insertlist.append(v)
 
-            cur.execute('INSERT INTO main VALUES(?%s)'%(",?"*(len(insertlist)-1)),insertlist)
-
-            conn.commit()
+            # name the columns, ones added by a migration are not in sorted order
+            cur.execute('INSERT INTO main(%s) VALUES(?%s)'%(",".join(cols),",?"*(len(insertlist)-1)),insertlist)
+            if check is not None:
+                check()
 
         # these are JSON strings and should be converted to dictionaries
         for item in self.json_cols_db:
@@ -113,14 +268,14 @@ class KeylimeDB():
         return d
 
     def remove_agent(self,agent_id):
-        with sqlite3.connect(self.db_filename) as conn:
+        with self.pending_lock:
+            self.pending.pop(agent_id,None)
+        self.flush()
+        with self.connection() as conn:
             cur = conn.cursor()
-            cur.execute('SELECT * from main where agent_id=?',(agent_id,))
-            rows = cur.fetchall()
-            if len(rows)==0:
-                return False
             cur.execute('DELETE FROM main WHERE agent_id=?',(agent_id,))
-            conn.commit()
+            if cur.rowcount==0:
+                return False
 
         return True
 
@@ -128,31 +283,52 @@ class KeylimeDB():
         if key not in self.cols_db.keys():
             raise Exception("Database key %s not in schema: %s"%(key,self.cols_db.keys()))
 
-        with sqlite3.connect(self.db_filename) as conn:
+        self.flush()
+        with self.connection() as conn:
             cur = conn.cursor()
             # marshall back to string
             if key in self.json_cols_db:
                 value = json.dumps(value)
             cur.execute('UPDATE main SET %s = ? where agent_id = ?'%(key),(value,agent_id))
-            conn.commit()
 
         return
 
+    def update_agents(self,fields,where_key,where_value,increment=None,check=None):
+        """Sets the columns in fields, and adds 1 to column increment, of the agents whose
+        column where_key holds where_value, in one statement.  Returns the number of
+        agents updated.  check() is called like with add_agent()."""
+        for key in fields.keys()+[where_key]+([increment] if increment is not None else []):
+            if key not in self.cols_db.keys():
+                raise Exception("Database key %s not in schema: %s"%(key,self.cols_db.keys()))
+
+        cols = sorted(fields.keys())
+        assignments = ["%s = ?"%key for key in cols]
+        if increment is not None:
+            assignments.append("%s = coalesce(%s,0)+1"%(increment,increment))
+        self.flush()
+        with self.connection() as conn:
+            cur = conn.cursor()
+            cur.execute('UPDATE main SET %s where %s = ?'%(", ".join(assignments),where_key),
+                        [self.marshal(key,fields[key]) for key in cols]+[self.marshal(where_key,where_value)])
+            if check is not None:
+                check()
+            return cur.rowcount
+
     def update_all_agents(self,key,value):
         if key not in self.cols_db.keys():
             raise Exception("Database key %s not in schema: %s"%(key,self.cols_db.keys()))
 
-        with sqlite3.connect(self.db_filename) as conn:
+        self.flush()
+        with self.connection() as conn:
             cur = conn.cursor()
             # marshall back to string if needed
             if key in self.json_cols_db:
                 value = json.dumps(value)
             cur.execute('UPDATE main SET %s = ?'%key,(value,))
-            conn.commit()
         return
 
     def get_agent(self,agent_id):
-        with sqlite3.connect(self.db_filename) as conn:
+        with self.connection() as conn:
             cur = conn.cursor()
             cur.execute('SELECT * from main where agent_id=?',(agent_id,))
             rows = cur.fetchall()
@@ -160,20 +336,59 @@ class KeylimeDB():
                 return None
 
             colnames = [description[0] for description in cur.description]
-            d ={}
-            for i in range(len(colnames)):
-                if colnames[i] in self.json_cols_db:
-                    d[colnames[i]] = json.loads(rows[0][i])
-                else:
-                    d[colnames[i]]=rows[0][i]
-            d = self.add_defaults(d)
-            return d
-
-    def get_agent_ids(self):
-        with sqlite3.connect(self.db_filename) as conn:
+            row = list(rows[0])
+
+        # queued writes are newer than what is on disk
+        with self.pending_lock:
+            pending = dict(self.pending.get(agent_id,{}))
+        for key,value in pending.iteritems():
+            row[colnames.index(key)] = value
+
+        d ={}
+        for i in range(len(colnames)):
+            if colnames[i] in self.json_cols_db:
+                d[colnames[i]] = json.loads(row[i])
+            else:
+                d[colnames[i]]=row[i]
+        d = self.add_defaults(d)
+        return d
+
+    def get_agent_value(self,agent_id,key):
+        """Reads a single column of an agent without unmarshalling the rest of the row.
+        Returns None if the agent does not exist."""
+        if key not in self.cols_db.keys():
+            raise Exception("Database key %s not in schema: %s"%(key,self.cols_db.keys()))
+
+        with self.pending_lock:
+            if agent_id in self.pending and key in self.pending[agent_id]:
+                value = self.pending[agent_id][key]
+                return json.loads(value) if key in self.json_cols_db else value
+
+        with self.connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT %s from main where agent_id=?'%key,(agent_id,))
+            row = cur.fetchone()
+            if row is None:
+                return None
+            if key in self.json_cols_db:
+                return json.loads(row[0])
+            return row[0]
+
+    def get_agent_ids(self,key=None,value=None):
+        """Lists all agents, or the ones whose column key holds value."""
+        if key is not None and key not in self.cols_db.keys():
+            raise Exception("Database key %s not in schema: %s"%(key,self.cols_db.keys()))
+
+        # queued writes never add or remove agents, no need to flush unless filtering
+        if key is not None:
+            self.flush()
+        with self.connection() as conn:
             retval = []
             cur = conn.cursor()
-            cur.execute('SELECT agent_id from main')
+            if key is None:
+                cur.execute('SELECT agent_id from main ORDER BY rowid')
+            else:
+                cur.execute('SELECT agent_id from main where %s = ? ORDER BY rowid'%key,(self.marshal(key,value),))
             rows = cur.fetchall()
             if len(rows)==0:
                 return retval
@@ -181,19 +396,40 @@ class KeylimeDB():
                 retval.append(i[0])
             return retval
 
-    def count_agents(self):
-        return len(self.get_agent_ids())
+    def count_agents(self,key=None,value=None):
+        """Counts all agents, or the ones whose column key holds value."""
+        if key is not None and key not in self.cols_db.keys():
+            raise Exception("Database key %s not in schema: %s"%(key,self.cols_db.keys()))
 
-    def overwrite_agent(self,agent_id,agent):
-        with sqlite3.connect(self.db_filename) as conn:
+        self.flush()
+        with self.connection() as conn:
             cur = conn.cursor()
-            for key in self.cols_db.keys():
-                if key is 'agent_id':
-                    continue
-                if key in self.json_cols_db:
-                    cur.execute('UPDATE main SET %s = ? where agent_id = ?'%(key),(json.dumps(agent[key]),agent_id))
-                else:
-                    cur.execute('UPDATE main SET %s = ? where agent_id = ?'%(key),(agent[key],agent_id))
-            conn.commit()
-        return
+            if key is None:
+                cur.execute('SELECT count(*) from main')
+            else:
+                cur.execute('SELECT count(*) from main where %s = ?'%key,(self.marshal(key,value),))
+            return cur.fetchone()[0]
+
+    def remove_unreferenced(self,key,value,remove):
+        """Calls remove() unless an agent's column key holds value.  Counting and remove()
+        happen under the database write lock, so an agent added or updated with the check 
+        of add_agent() or update_agents() either is counted or sees what remove() did.  
+        Returns the number of agents holding value."""
+        if key not in self.cols_db.keys():
+            raise Exception("Database key %s not in schema: %s"%(key,self.cols_db.keys()))
+
+        self.flush()
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        with conn:
+            cur = conn.cursor()
+            cur.execute('SELECT count(*) from main where %s = ?'%key,(self.marshal(key,value),))
+            count = cur.fetchone()[0]
+            if count == 0:
+                remove()
+            return count
 
+    def overwrite_agent(self,agent_id,agent):
+        self.queue_overwrite(agent_id,agent)
+        self.flush()
+        return
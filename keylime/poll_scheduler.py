@@ -0,0 +1,236 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2019 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+import ConfigParser
+import collections
+import os
+import random
+import threading
+import time
+
+import tornado.ioloop
+
+import common
+import keylime_logging
+
+logger = keylime_logging.init_logging('poll_scheduler')
+
+# setup config
+config = ConfigParser.SafeConfigParser()
+config.read(common.CONFIG_FILE)
+
+# Schedules the verifier's agent polls on a hierarchical timer wheel instead of one
+# IOLoop timeout per agent.  Level 0 has a slot per tick, each level above it covers
+# WHEEL_SLOTS times the span of the one below.  Entries are cascaded down a level each
+# time the level below wraps, so inserting and firing are O(1) however many agents
+# are scheduled.
+#
+# Polls are spread over the quote interval instead of all agents that were added
+# together polling together, and at most max_in_flight polls run at once.  Polls that
+# come due while the budget is used up wait in a backlog until complete() is called
+# for an earlier one.
+
+WHEEL_BITS = 6
+WHEEL_SLOTS = 1 << WHEEL_BITS
+WHEEL_MASK = WHEEL_SLOTS - 1
+WHEEL_LEVELS = 4
+
+
+class _Entry(object):
+    __slots__ = ['key', 'due', 'tick', 'callback', 'cancelled']
+
+    def __init__(self, key, due, tick, callback):
+        self.key = key
+        self.due = due
+        self.tick = tick
+        self.callback = callback
+        self.cancelled = False
+
+
+class PollScheduler(object):
+
+    def __init__(self, tick, max_in_flight, jitter, io_loop=None):
+        self.tick = tick
+        self.max_in_flight = max_in_flight
+        self.jitter = jitter
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.current()
+        self.pid = os.getpid()
+
+        self.wheels = [[[] for _ in range(WHEEL_SLOTS)] for _ in range(WHEEL_LEVELS)]
+        # the next tick to be processed
+        self.start_time = time.time()
+        self.current = 0
+        # key : scheduled _Entry
+        self.entries = {}
+        # keys that have had their first periodic poll spread over the interval
+        self.phased = set()
+        self.backlog = collections.deque()
+        self.in_flight = set()
+        self.timer = None
+
+        # counters
+        self.fired = 0
+        self.deferred = 0
+        self.max_backlog = 0
+
+    def __tick_of(self, when):
+        return int((when - self.start_time)/self.tick)
+
+    def __insert(self, entry):
+        tick = max(entry.tick, self.current)
+        delta = tick - self.current
+        for level in range(WHEEL_LEVELS):
+            if delta < (1 << (WHEEL_BITS*(level+1))) or level == WHEEL_LEVELS-1:
+                self.wheels[level][(tick >> (WHEEL_BITS*level)) & WHEEL_MASK].append(entry)
+                return
+
+    def __cascade(self, level):
+        """Moves the entries of the current slot of a level down to the levels below."""
+        index = (self.current >> (WHEEL_BITS*level)) & WHEEL_MASK
+        entries = self.wheels[level][index]
+        self.wheels[level][index] = []
+        for entry in entries:
+            if not entry.cancelled:
+                self.__insert(entry)
+        return index
+
+    def advance(self, now=None):
+        """Fires everything due up to now.  Called from a periodic timer on the IOLoop."""
+        if now is None:
+            now = time.time()
+        target = self.__tick_of(now)
+        while self.current <= target:
+            if self.current & WHEEL_MASK == 0:
+                for level in range(1, WHEEL_LEVELS):
+                    if self.__cascade(level) != 0:
+                        break
+            index = self.current & WHEEL_MASK
+            due = self.wheels[0][index]
+            self.wheels[0][index] = []
+            self.current += 1
+            for entry in due:
+                if entry.cancelled:
+                    continue
+                if entry.tick >= self.current:
+                    # rounded down from a level above, not due yet
+                    self.__insert(entry)
+                    continue
+                self.__fire(entry)
+
+    def __fire(self, entry):
+        if self.entries.get(entry.key) is entry:
+            del self.entries[entry.key]
+        if len(self.in_flight) >= self.max_in_flight:
+            self.backlog.append(entry)
+            self.deferred += 1
+            self.max_backlog = max(self.max_backlog, len(self.backlog))
+            return
+        self.__run(entry)
+
+    def __run(self, entry):
+        self.fired += 1
+        self.in_flight.add(entry.key)
+        try:
+            entry.callback()
+        except Exception as e:
+            logger.error("Scheduled poll of %s failed: %s"%(entry.key, e))
+            logger.exception(e)
+            self.complete(entry.key)
+
+    def __start(self):
+        if self.timer is None:
+            self.timer = tornado.ioloop.PeriodicCallback(self.advance, self.tick*1000, io_loop=self.io_loop)
+            self.timer.start()
+
+    def schedule(self, key, delay, callback):
+        """Runs callback after delay seconds, subject to the in flight budget.  Replaces
+        anything already scheduled for key."""
+        self.cancel(key, forget=False)
+        due = time.time() + max(0.0, delay)
+        entry = _Entry(key, due, self.__tick_of(due), callback)
+        self.entries[key] = entry
+        self.__insert(entry)
+        self.__start()
+        return entry
+
+    def schedule_poll(self, key, interval, callback):
+        """Schedules the next periodic poll of key.  The first one is placed at a random
+        point in the interval so polls of agents added together are spread out, later
+        ones are interval apart give or take the configured jitter."""
+        if key not in self.phased:
+            self.phased.add(key)
+            delay = random.uniform(0, interval)
+        else:
+            delay = interval * random.uniform(1-self.jitter, 1+self.jitter)
+        return self.schedule(key, delay, callback)
+
+    def cancel(self, key, forget=True):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            entry.cancelled = True
+        for queued in self.backlog:
+            if queued.key == key:
+                queued.cancelled = True
+        if forget:
+            self.phased.discard(key)
+            self.complete(key)
+
+    def complete(self, key):
+        """Marks the poll of key as finished, freeing its slot in the budget."""
+        self.in_flight.discard(key)
+        while len(self.backlog) > 0 and len(self.in_flight) < self.max_in_flight:
+            entry = self.backlog.popleft()
+            if entry.cancelled or entry.key in self.in_flight:
+                continue
+            self.__run(entry)
+
+    def get_schedule(self, limit=100):
+        now = time.time()
+        upcoming = sorted(self.entries.values(), key=lambda e: e.due)[:limit]
+        return {
+            'scheduled': len(self.entries),
+            'in_flight': len(self.in_flight),
+            'max_in_flight': self.max_in_flight,
+            'backlog': len([e for e in self.backlog if not e.cancelled]),
+            'max_backlog': self.max_backlog,
+            'fired': self.fired,
+            'deferred': self.deferred,
+            'next_due': [{'agent_id': e.key, 'due_in': max(0.0, e.due-now)} for e in upcoming],
+            }
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.stop()
+            self.timer = None
+
+
+__scheduler = None
+__scheduler_lock = threading.Lock()
+
+def get_scheduler():
+    """Returns the scheduler for this process, created lazily so that each forked
+    tornado process polls its own agents."""
+    global __scheduler
+    with __scheduler_lock:
+        if __scheduler is None or __scheduler.pid != os.getpid():
+            __scheduler = PollScheduler(config.getfloat('cloud_verifier','poll_tick'),
+                                        config.getint('cloud_verifier','max_in_flight_quotes'),
+                                        config.getfloat('cloud_verifier','poll_jitter'))
+        return __scheduler
@@ -0,0 +1,180 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2019 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+import functools
+import hashlib
+import sys
+
+import tornado.ioloop
+from tornado.concurrent import Future
+
+import keylime_logging
+
+logger = keylime_logging.init_logging('quote_batch')
+
+# Requests for quotes that come in together can be answered with one TPM quote.  The
+# quote is over the root of a Merkle tree of their nonces, and each requester gets the
+# hashes that lead from its nonce to the root, which the checker folds back into the 
+# root to check the quote against.  Leaves and inner nodes are hashed with different 
+# prefixes, so a leaf can't pass for a node.  A node without a sibling moves up a level
+# as it is.
+
+LEAF_PREFIX = '\x00'
+NODE_PREFIX = '\x01'
+
+# deep enough for any batch, bounds the work of checking a proof
+MAX_PROOF_LENGTH = 32
+
+
+def leaf_hash(nonce):
+    return hashlib.sha256(LEAF_PREFIX + nonce).digest()
+
+def node_hash(left, right):
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+def merkle_tree(nonces):
+    """Returns the root of the Merkle tree of nonces and the proof of each of them, a 
+    list of (sibling is left, sibling hash) from the leaf up."""
+    if len(nonces) == 0:
+        raise Exception("no nonces to batch")
+    level = [leaf_hash(nonce) for nonce in nonces]
+    # the nodes each leaf is under on the current level
+    members = [[i] for i in range(len(nonces))]
+    proofs = [[] for _ in nonces]
+    while len(level) > 1:
+        next_level, next_members = [], []
+        for i in range(0, len(level)-1, 2):
+            for leaf in members[i]:
+                proofs[leaf].append((False, level[i+1]))
+            for leaf in members[i+1]:
+                proofs[leaf].append((True, level[i]))
+            next_level.append(node_hash(level[i], level[i+1]))
+            next_members.append(members[i] + members[i+1])
+        if len(level)%2 == 1:
+            next_level.append(level[-1])
+            next_members.append(members[-1])
+        level, members = next_level, next_members
+    return level[0], proofs
+
+def encode_proof(proof):
+    """The proof as it is appended to a quote, e.g. 'l<hex>,r<hex>'."""
+    return ",".join([('r','l')[left] + sibling.encode('hex') for left, sibling in proof])
+
+def decode_proof(encoded):
+    proof = []
+    if encoded == "":
+        # the nonce is the only leaf
+        return proof
+    for item in encoded.split(","):
+        if len(item) != 65 or item[0] not in 'lr':
+            raise Exception("malformed proof entry %r"%item[:80])
+        proof.append((item[0] == 'l', item[1:].decode('hex')))
+    if len(proof) > MAX_PROOF_LENGTH:
+        raise Exception("proof is longer than %d hashes"%MAX_PROOF_LENGTH)
+    return proof
+
+def root_from_proof(nonce, encoded):
+    """The root that the encoded proof leads to from nonce, to check a batched quote 
+    against.  Raises an Exception if the proof is malformed."""
+    node = leaf_hash(nonce)
+    for left, sibling in decode_proof(encoded):
+        if left:
+            node = node_hash(sibling, node)
+        else:
+            node = node_hash(node, sibling)
+    return node
+
+
+class QuoteBatcher(object):
+    """Coalesces requests for the same kind of quote into one quote.
+
+    The first request for a key, e.g. the quote type and PCR masks, opens a batch that
+    collects the requests for that key for window seconds, or until there are
+    max_batch of them.  Then run_batch(key, nonce, args) is called with the Merkle root
+    of their nonces and the list of the args of each request, and returns a Future for
+    a list with a result for each request.  The Future returned by request() resolves 
+    to (result, encoded proof).  A batch of one is quoted over its own nonce and has no
+    proof, so with a window of 0 every request is quoted on its own.  All callbacks run
+    on the IOLoop.
+    """
+
+    def __init__(self, window, max_batch, run_batch, io_loop=None):
+        self.window = window
+        self.max_batch = max(max_batch, 1)
+        self.run_batch = run_batch
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.current()
+        # key -> list of (nonce, args, future)
+        self.pending = {}
+        self.stats = {'requests': 0, 'batches': 0, 'max_batch_size': 0}
+
+    def request(self, key, nonce, args):
+        future = Future()
+        self.stats['requests'] += 1
+        batch = self.pending.get(key)
+        if batch is None:
+            batch = self.pending[key] = []
+            if self.window > 0:
+                self.io_loop.call_later(self.window, self.__flush, key, batch)
+        batch.append((nonce, args, future))
+        if self.window <= 0 or len(batch) >= self.max_batch:
+            self.__flush(key, batch)
+        return future
+
+    def __flush(self, key, batch):
+        if self.pending.get(key) is not batch:
+            # flushed already when it filled up
+            return
+        del self.pending[key]
+        self.stats['batches'] += 1
+        self.stats['max_batch_size'] = max(self.stats['max_batch_size'], len(batch))
+
+        nonces = [nonce for nonce, _, _ in batch]
+        if len(batch) == 1:
+            root, proofs = nonces[0], [None]
+        else:
+            root, tree_proofs = merkle_tree(nonces)
+            proofs = [encode_proof(proof) for proof in tree_proofs]
+            logger.debug("quoting %d requests for %s at once"%(len(batch), key))
+        try:
+            done = self.run_batch(key, root, [args for _, args, _ in batch])
+        except Exception:
+            self.__fail(batch, sys.exc_info())
+            return
+        done.add_done_callback(functools.partial(self.__resolve, batch, proofs))
+
+    def __resolve(self, batch, proofs, done):
+        try:
+            results = done.result()
+        except Exception:
+            self.__fail(batch, sys.exc_info())
+            return
+        for (_, _, future), result, proof in zip(batch, results, proofs):
+            future.set_result((result, proof))
+
+    def __fail(self, batch, exc_info):
+        for _, _, future in batch:
+            future.set_exc_info(exc_info)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['window'] = self.window
+        stats['max_batch'] = self.max_batch
+        stats['avg_batch_size'] = float(stats['requests'])/stats['batches'] if stats['batches'] > 0 else 0.0
+        return stats
@@ -27,6 +27,9 @@ import keylime_logging
 import ssl
 import os
 import logging
+import time
+from tornado import httpclient
+from tornado.concurrent import Future
 
 logger = keylime_logging.init_logging('registrar_client')
 context = None
@@ -90,39 +93,128 @@ def getAIK(registrar_ip,registrar_port,agent_id):
     else:
         return retval['aik']
 
-def getKeys(registrar_ip,registrar_port,agent_id):
-    global context
-    
+def __check_context():
     #make absolutely sure you don't ask for AIKs unauthenticated
     if context is None or context.verify_mode != ssl.CERT_REQUIRED:
         raise Exception("It is unsafe to use this interface to query AIKs with out server authenticated TLS")
+
+def __parse_keys(response):
+    response_body = response.json()
+    
+    if response.status_code != 200:
+        logger.critical("Error: unexpected http response code from Registrar Server: %s"%str(response.status_code))
+        common.log_http_response(logger,logging.CRITICAL,response_body)
+        return None 
+    
+    if "results" not in response_body:
+        logger.critical("Error: unexpected http response body from Registrar Server: %s"%str(response.status_code))
+        return None 
+    
+    if "aik" not in response_body["results"]:
+        logger.critical("Error: did not receive aik from Registrar Server: %s"%str(response.status_code))
+        return None 
+    
+    return response_body["results"]
+
+def __keys_url(registrar_ip,registrar_port,agent_id):
+    url = "http://%s:%s/agents/%s"%(registrar_ip,registrar_port,agent_id)
+    # like tornado_requests.request does
+    if context is not None:
+        url = url.replace('http://','https://',1)
+    return url
+
+def getKeys(registrar_ip,registrar_port,agent_id):
+    __check_context()
     
     try:
         response = tornado_requests.request("GET",
-                                            "http://%s:%s/agents/%s"%(registrar_ip,registrar_port,agent_id),
+                                            __keys_url(registrar_ip,registrar_port,agent_id),
                                             context=context)
-        
-        response_body = response.json()
-        
-        if response.status_code != 200:
-            logger.critical("Error: unexpected http response code from Registrar Server: %s"%str(response.status_code))
-            common.log_http_response(logger,logging.CRITICAL,response_body)
-            return None 
-        
-        if "results" not in response_body:
-            logger.critical("Error: unexpected http response body from Registrar Server: %s"%str(response.status_code))
-            return None 
-        
-        if "aik" not in response_body["results"]:
-            logger.critical("Error: did not receive aik from Registrar Server: %s"%str(response.status_code))
-            return None 
-        
-        return response_body["results"]
+        return __parse_keys(response)
     except Exception as e:
         logger.exception(e)
         
     return None
 
+# the client of this process getKeysAsync fetches with
+async_client = None
+
+def get_async_client(max_clients):
+    """A client of its own for the registrar, so that fetching keys doesn't wait for
+    the slots of the shared AsyncHTTPClient or take them from other requests."""
+    global async_client
+    if async_client is None or async_client[0] != os.getpid():
+        async_client = (os.getpid(),httpclient.AsyncHTTPClient(force_instance=True,max_clients=max_clients))
+    return async_client[1]
+
+def getKeysAsync(registrar_ip,registrar_port,agent_id,max_clients=10):
+    """Non-blocking getKeys for use on an IOLoop.  Returns a Future that resolves to the
+    keys or None.  max_clients limits the requests to the registrar in flight, it only
+    counts when the client is created."""
+    __check_context()
+    
+    future = Future()
+    def on_response(response):
+        try:
+            future.set_result(__parse_keys(tornado_requests.tornado_response(response.code,response.body)))
+        except Exception as e:
+            logger.exception(e)
+            future.set_result(None)
+    
+    request = httpclient.HTTPRequest(url=__keys_url(registrar_ip,registrar_port,agent_id),
+                                     ssl_options=context)
+    get_async_client(max_clients).fetch(request,callback=on_response)
+    return future
+
+class KeyCache():
+    """Registrar keys shared by all agents polled by a verifier process.  An entry is
+    refreshed from the registrar once it is older than ttl seconds or after it has been
+    used for max_uses quotes, whichever comes first."""
+    
+    def __init__(self,ttl,max_uses=common.MAX_STALE_REGISTRAR_CACHE):
+        self.ttl = ttl
+        self.max_uses = max_uses
+        # agent_id : [keys, time fetched, uses]
+        self.entries = {}
+        # agent_id : Future of a fetch in progress
+        self.inflight = {}
+    
+    def get(self,agent_id):
+        entry = self.entries.get(agent_id)
+        if entry is None:
+            return None
+        if time.time()-entry[1]>self.ttl or entry[2]>=self.max_uses:
+            del self.entries[agent_id]
+            return None
+        entry[2]+=1
+        return entry[0]
+    
+    def put(self,agent_id,keys):
+        self.entries[agent_id] = [keys,time.time(),0]
+    
+    def invalidate(self,agent_id):
+        self.entries.pop(agent_id,None)
+    
+    def get_async(self,agent_id,fetch):
+        """Returns a Future for the keys of agent_id.  fetch(agent_id) is called to get a
+        Future from the registrar on a miss, concurrent misses share one fetch."""
+        keys = self.get(agent_id)
+        if keys is not None:
+            future = Future()
+            future.set_result(keys)
+            return future
+        if agent_id in self.inflight:
+            return self.inflight[agent_id]
+        
+        future = fetch(agent_id)
+        self.inflight[agent_id] = future
+        def on_done(f):
+            self.inflight.pop(agent_id,None)
+            if f.exception() is None and f.result() is not None:
+                self.put(agent_id,f.result())
+        future.add_done_callback(on_done)
+        return future
+
 def doRegisterAgent(registrar_ip,registrar_port,agent_id,tpm_version,pub_ek,ekcert,pub_aik,pub_ek_tpm=None,aik_name=None):
     data = {
     'ek': pub_ek,
@@ -387,7 +387,7 @@ class UnprotectedRegistrarServer(ThreadingMixIn, HTTPServer):
 def init_db(dbname):
     # in the form key, SQL type
     cols_db = {
-        'agent_id': 'TEXT PRIMARY_KEY',
+        'agent_id': 'TEXT PRIMARY KEY',
         'key': 'TEXT',
         'aik': 'TEXT',
         'ek': 'TEXT',
@@ -87,6 +87,7 @@ class Tenant():
     vtpm_policy = {}
     metadata = {}
     ima_whitelist = {}
+    tag = ""
     revocation_key = ""
     accept_tpm_hash_algs = []
     accept_tpm_encryption_algs = []
@@ -149,6 +150,35 @@ class Tenant():
         context.check_hostname = config.getboolean('general','tls_check_hostnames')
         return context
     
+    def read_ima_lists(self, args):
+        """Reads the IMA whitelist and exclude list given in args, returns (whitelist lines
+        or None, exclude list lines or None)."""
+        # Read command-line path string IMA whitelist 
+        wl_data = None
+        if "ima_whitelist" in args and args["ima_whitelist"] is not None:
+            
+            if type(args["ima_whitelist"]) in [str,unicode]:
+                if args["ima_whitelist"] == "default":
+                    args["ima_whitelist"] = config.get('tenant', 'ima_whitelist')
+                wl_data = ima.read_whitelist(args["ima_whitelist"])
+            elif type(args["ima_whitelist"]) is list:
+                wl_data = args["ima_whitelist"]
+            else:
+                raise UserError("Invalid whitelist provided")
+        
+        # Read command-line path string IMA exclude list 
+        excl_data = None
+        if "ima_exclude" in args and args["ima_exclude"] is not None:
+            if type(args["ima_exclude"]) in [str,unicode]:
+                if args["ima_exclude"] == "default":
+                    args["ima_exclude"] = config.get('tenant', 'ima_excludelist')
+                excl_data = ima.read_excllist(args["ima_exclude"])
+            elif type(args["ima_exclude"]) is list:
+                excl_data = args["ima_exclude"]
+            else:
+                raise UserError("Invalid exclude list provided")
+        return wl_data,excl_data
+    
     def init_add(self, args):
         # command line options can overwrite config values
         if "agent_ip" in args:
@@ -173,6 +203,9 @@ class Tenant():
         if "ca_dir_pw" not in args: 
             args["ca_dir_pw"] = None
         
+        if "tag" in args and args["tag"] is not None:
+            self.tag = args["tag"]
+        
         # Set up accepted algorithms
         self.accept_tpm_hash_algs = config.get('tenant', 'accept_tpm_hash_algs').split(',')
         self.accept_tpm_encryption_algs = config.get('tenant', 'accept_tpm_encryption_algs').split(',')
@@ -192,33 +225,10 @@ class Tenant():
         logger.info("vTPM PCR Mask from policy is %s"%self.vtpm_policy['mask'])
         
         
-        # Read command-line path string IMA whitelist 
-        wl_data = None
-        if "ima_whitelist" in args and args["ima_whitelist"] is not None:
-            
+        wl_data,excl_data = self.read_ima_lists(args)
+        if wl_data is not None:
             # Auto-enable IMA (or-bit mask)
             self.tpm_policy['mask'] = "0x%X"%(int(self.tpm_policy['mask'],0) + (1 << common.IMA_PCR))
-            
-            if type(args["ima_whitelist"]) in [str,unicode]:
-                if args["ima_whitelist"] == "default":
-                    args["ima_whitelist"] = config.get('tenant', 'ima_whitelist')
-                wl_data = ima.read_whitelist(args["ima_whitelist"])
-            elif type(args["ima_whitelist"]) is list:
-                wl_data = args["ima_whitelist"]
-            else:
-                raise UserError("Invalid whitelist provided")
-        
-        # Read command-line path string IMA exclude list 
-        excl_data = None
-        if "ima_exclude" in args and args["ima_exclude"] is not None:
-            if type(args["ima_exclude"]) in [str,unicode]:
-                if args["ima_exclude"] == "default":
-                    args["ima_exclude"] = config.get('tenant', 'ima_excludelist')
-                excl_data = ima.read_excllist(args["ima_exclude"])
-            elif type(args["ima_exclude"]) is list:
-                excl_data = args["ima_exclude"]
-            else:
-                raise UserError("Invalid exclude list provided")
         
         # Set up IMA 
         if TPM_Utilities.check_mask(self.tpm_policy['mask'],common.IMA_PCR) or \
@@ -447,18 +457,47 @@ class Tenant():
                     logger.debug("ek_check output: %s"%line.strip())
         return True
 
+    def upload_whitelist(self):
+        """Makes sure the verifier has the IMA whitelist, uploading it if it doesn't, and
+        returns the digest agents reference it by."""
+        digest = ima.whitelist_version(self.ima_whitelist)
+        url = "http://%s:%s/whitelists/%s"%(self.cloudverifier_ip,self.cloudverifier_port,digest)
+        response = tornado_requests.request("HEAD",url,context=self.context)
+        if response.status_code == 200:
+            logger.debug("IMA whitelist %s already at CV"%digest)
+            return digest
+        if response.status_code != 404:
+            raise UserError("HEAD command response: %d Unexpected response from Cloud Verifier for whitelist %s"%(response.status_code,digest))
+        
+        response = tornado_requests.request("POST",url,data=json.dumps(self.ima_whitelist),context=self.context)
+        if response.status_code != 200:
+            common.log_http_response(logger,logging.ERROR,response.json())
+            raise UserError("POST command response: %d Unexpected response from Cloud Verifier for whitelist %s"%(response.status_code,digest))
+        logger.info("Uploaded IMA whitelist %s to CV"%digest)
+        return digest
+    
     def do_cv(self):
         """initiaite v, agent_id and ip
         initiate the cloudinit sequence"""
         b64_v = base64.b64encode(self.V)
         logger.debug("b64_v:" + b64_v)
+        
+        # the verifier keeps one copy of a whitelist for all agents using it
+        ima_whitelist = self.ima_whitelist
+        ima_whitelist_ref = ""
+        if 'whitelist' in self.ima_whitelist and config.getboolean('tenant','share_ima_whitelist'):
+            ima_whitelist_ref = self.upload_whitelist()
+            ima_whitelist = {}
+        
         data = {
             'v': b64_v,
             'cloudagent_ip': self.cv_cloudagent_ip,
             'cloudagent_port': self.cloudagent_port,
             'tpm_policy': json.dumps(self.tpm_policy),
             'vtpm_policy':json.dumps(self.vtpm_policy),
-            'ima_whitelist':json.dumps(self.ima_whitelist),
+            'ima_whitelist':json.dumps(ima_whitelist),
+            'ima_whitelist_ref':ima_whitelist_ref,
+            'tag':self.tag,
             'metadata':json.dumps(self.metadata),
             'revocation_key':self.revocation_key,
             'accept_tpm_hash_algs':self.accept_tpm_hash_algs,
@@ -476,6 +515,31 @@ class Tenant():
             raise UserError("POST command response: %d Unexpected response from Cloud Verifier: %s"%(response.status_code,response.body))
 
 
+    def do_cvwhitelist(self, args):
+        """Replaces the IMA whitelist and exclude list of the agent at the verifier, or of
+        all agents with args['tag'] if given, without adding them again."""
+        wl_data,excl_data = self.read_ima_lists(args)
+        if wl_data is None:
+            raise UserError("You must specify a whitelist with --whitelist")
+        self.ima_whitelist = ima.process_whitelists(wl_data,excl_data)
+        
+        if config.getboolean('tenant','share_ima_whitelist'):
+            data = {'ima_whitelist_ref':self.upload_whitelist()}
+        else:
+            data = {'ima_whitelist':self.ima_whitelist}
+        
+        params = None
+        agent_id = self.agent_uuid
+        if args.get("tag") is not None:
+            params = {'tag':args["tag"]}
+            agent_id = '*'
+        url = "http://%s:%s/agents/%s/ima_whitelist"%(self.cloudverifier_ip,self.cloudverifier_port,agent_id)
+        response = tornado_requests.request("PUT",url,params=params,data=json.dumps(data),context=self.context)
+        if response.status_code != 200:
+            common.log_http_response(logger,logging.ERROR,response.json())
+            raise UserError("Whitelist command response: %d Unexpected response from Cloud Verifier."%response.status_code)
+        logger.info("IMA whitelist of %d agents updated"%response.json()['results']['updated'])
+    
     def do_cvstatus(self,listing=False):
         """initiaite v, agent_id and ip
         initiate the cloudinit sequence"""
@@ -670,7 +734,7 @@ class Tenant():
 
 def main(argv=sys.argv):    
     parser = argparse.ArgumentParser(argv[0])
-    parser.add_argument('-c', '--command',action='store',dest='command',default='add',help="valid commands are add,delete,update,status,reactivate,regdelete. defaults to add")
+    parser.add_argument('-c', '--command',action='store',dest='command',default='add',help="valid commands are add,delete,update,status,reactivate,regdelete,whitelist. defaults to add")
     parser.add_argument('-t', '--targethost',action='store',dest='agent_ip',help="the IP address of the host to provision")
     parser.add_argument('--cv_targethost',action='store',default=None,dest='cv_agent_ip',help='the IP address of the host to provision that the verifier will use (optional).  Use only if different than argument to option -t/--targethost')
     parser.add_argument('-v', '--cv',action='store',dest='verifier_ip',help="the IP address of the cloud verifier")
@@ -682,6 +746,7 @@ def main(argv=sys.argv):
     parser.add_argument('--include',action='store',dest='incl_dir',default=None,help="Include additional files in provided directory in certificate zip file.  Must be specified with --cert")
     parser.add_argument('--whitelist',action='store',dest='ima_whitelist',default=None,help="Specify the location of an IMA whitelist")
     parser.add_argument('--exclude',action='store',dest='ima_exclude',default=None,help="Specify the location of an IMA exclude list")
+    parser.add_argument('--tag',action='store',dest='tag',default=None,help="Tag the agent at the verifier with add, or update the whitelist of all agents with this tag with whitelist")
     parser.add_argument('--tpm_policy',action='store',dest='tpm_policy',default=None,help="Specify a TPM policy in JSON format. e.g., {\"15\":\"0000000000000000000000000000000000000000\"}")
     parser.add_argument('--vtpm_policy',action='store',dest='vtpm_policy',default=None,help="Specify a vTPM policy in JSON format")
     parser.add_argument('--verify',action='store_true',default=False,help='Block on cryptographically checked key derivation confirmation from the agent once it has been provisioned')
@@ -702,7 +767,7 @@ def main(argv=sys.argv):
     
     mytenant = Tenant()
     
-    if args.command not in ['list','regdelete'] and args.agent_ip is None:
+    if args.command not in ['list','regdelete','whitelist'] and args.agent_ip is None:
         raise UserError("-t/--targethost is required for command %s"%args.command)
         
     if args.agent_uuid is not None:
@@ -763,6 +828,8 @@ def main(argv=sys.argv):
         mytenant.do_cvreactivate()
     elif args.command=='regdelete':
         mytenant.do_regdelete()
+    elif args.command=='whitelist':
+        mytenant.do_cvwhitelist(vars(args))
     else:
         raise UserError("Invalid command specified: %s"%(args.command))
     
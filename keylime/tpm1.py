@@ -38,6 +38,7 @@ import sys
 import tempfile
 import threading
 import time
+import tpm1_quote
 from tpm_abstract import *
 from tpm_ek_ca import *
 
@@ -650,48 +651,20 @@ class tpm1(AbstractTPM):
         retDict = self.__run(cmd,lock=False)
         return retDict['retout']
 
-    def check_deep_quote(self,nonce,data,quote,vAIK,hAIK,vtpm_policy={},tpm_policy={},ima_measurement_list=None,ima_whitelist={}):
-        quoteFile=None
-        vAIKFile=None
-        hAIKFile=None
-            
+    def check_deep_quote(self,nonce,data,quote,vAIK,hAIK,vtpm_policy={},tpm_policy={},ima_measurement_list=None,ima_whitelist={},ima_state=None):
         if quote[0]!='d':
             raise Exception("Invalid deep quote type %s"%quote[0])
         quote = quote[1:]
         
+        # the hardware TPM signature is over a structure of the vTPM manager's making,
+        # so deep quotes are always checked by checkdeepquote
         try:
-            # write out quote
-            qfd, qtemp = tempfile.mkstemp()
-            quoteFile = open(qtemp,"wb")
-            quoteFile.write(base64.b64decode(quote).decode("zlib"))
-            quoteFile.close()
-            os.close(qfd)
-
-            afd, atemp = tempfile.mkstemp()
-            vAIKFile = open(atemp,"w")
-            vAIKFile.write(vAIK)
-            vAIKFile.close()
-            os.close(afd)
-            
-            afd, atemp = tempfile.mkstemp()
-            hAIKFile = open(atemp,"w")
-            hAIKFile.write(hAIK)
-            hAIKFile.close()
-            os.close(afd)
-
-            retout = self.__checkdeepquote_c(hAIKFile.name, vAIKFile.name, quoteFile.name, nonce)
+            with cmd_exec.MemFile(base64.b64decode(quote).decode("zlib")) as quoteFile, cmd_exec.MemFile(vAIK) as vAIKFile, cmd_exec.MemFile(hAIK) as hAIKFile:
+                retout = self.__checkdeepquote_c(hAIKFile.name, vAIKFile.name, quoteFile.name, nonce)
         except Exception as e:
             logger.error("Error verifying quote: %s"%(e))
             logger.exception(e)
             return False
-        finally:
-            if vAIKFile is not None:
-                os.remove(vAIKFile.name)
-            if hAIKFile is not None:
-                os.remove(hAIKFile.name)
-            if quoteFile is not None:
-                os.remove(quoteFile.name)
-            pass
         
         if len(retout)<1:
             return False
@@ -718,7 +691,7 @@ class tpm1(AbstractTPM):
                 pcrs.append(line)
         
         # don't pass in data to check pcrs for physical quote 
-        return self.check_pcrs(tpm_policy,pcrs,None,False,None,None) and self.check_pcrs(vtpm_policy, vpcrs, data, True,ima_measurement_list,ima_whitelist)
+        return self.check_pcrs(tpm_policy,pcrs,None,False,None,None) and self.check_pcrs(vtpm_policy, vpcrs, data, True,ima_measurement_list,ima_whitelist,ima_state)
 
     def __check_quote_c(self, aikFile, quoteFile, extData):
         os.putenv('TPM_SERVER_PORT', '9999')
@@ -744,7 +717,19 @@ class tpm1(AbstractTPM):
             retDict = self.__run("checkquote -aik %s -quote %s -nonce %s"%(aikFile, quoteFile, extData),lock=False)
             return retDict['retout']
 
-    def check_quote(self,nonce,data,quote,aikFromRegistrar,tpm_policy={},ima_measurement_list=None,ima_whitelist={},hash_alg=None):
+    def __check_quote_native(self, aik, quoteblob, extData):
+        """In process replacement for __check_quote_c.  Returns the PCR lines from the 
+        quote or None if it does not verify."""
+        if common.STUB_TPM and common.TPM_CANNED_VALUES is not None:
+            jsonIn = common.TPM_CANNED_VALUES
+            if 'tpmquote' in jsonIn and 'nonce' in jsonIn['tpmquote']:
+                extData = str(jsonIn['tpmquote']['nonce'])
+            else:
+                raise Exception("Could not get quote nonce from canned JSON!")
+        
+        return tpm1_quote.check_quote(extData, aik, quoteblob)
+    
+    def check_quote(self,nonce,data,quote,aikFromRegistrar,tpm_policy={},ima_measurement_list=None,ima_whitelist={},hash_alg=None,ima_state=None):
         quoteFile=None
         aikFile=None
 
@@ -752,6 +737,16 @@ class tpm1(AbstractTPM):
             raise Exception("Invalid quote type %s"%quote[0])
         quote = quote[1:]
         
+        if config.getboolean('general','tpm1_native_quote_check'):
+            try:
+                pcrs = self.__check_quote_native(aikFromRegistrar, base64.b64decode(quote).decode("zlib"), nonce)
+            except Exception as e:
+                logger.warning("Unable to check quote natively, falling back to checkquote: %s"%e)
+            else:
+                if pcrs is None:
+                    return False
+                return self.check_pcrs(tpm_policy,pcrs,data,False,ima_measurement_list,ima_whitelist,ima_state)
+        
         try:
             # write out quote
             qfd, qtemp = tempfile.mkstemp()
@@ -796,7 +791,7 @@ class tpm1(AbstractTPM):
             if pcrs is not None:
                 pcrs.append(line)    
 
-        return self.check_pcrs(tpm_policy,pcrs,data,False,ima_measurement_list,ima_whitelist)
+        return self.check_pcrs(tpm_policy,pcrs,data,False,ima_measurement_list,ima_whitelist,ima_state)
 
     def extendPCR(self,pcrval,hashval,hash_alg=None,lock=True):
         if hash_alg is None:
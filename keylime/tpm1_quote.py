@@ -0,0 +1,104 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2019 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+import hashlib
+import struct
+
+import crypto
+import keylime_logging
+
+logger = keylime_logging.init_logging('tpm1_quote')
+
+# In process parsing and verification of the quote files written by the tpmquote tool,
+# replacing checkquote.  Deep quotes are still checked by checkdeepquote.
+#
+# tpmquote file layout (host byte order, these are libtpm structures dumped from memory):
+#   struct tpm_buffer { u32 size; u32 used; u32 flags; } followed by used bytes of signature
+#   TPM_PCR_COMPOSITE { u16 sizeOfSelect; u8 pcrSelect[4]; u32 valueSize; pointer } (24 bytes)
+#   valueSize bytes of PCR values
+
+TPM_QUOTE_INFO_HEADER = '\x01\x01\x00\x00QUOT'
+SHA1_LEN = 20
+TPM_NUM_PCR = 24
+TPM_BUFFER_HEADER_LEN = 12
+PCR_COMPOSITE_HEADER_LEN = 24
+
+
+def _selection_to_pcrs(select):
+    pcrs = []
+    for i in range(len(select)*8):
+        if ord(select[i/8]) & (1 << (i%8)):
+            pcrs.append(i)
+    return pcrs
+
+def _pcr_lines(pcrs, values):
+    if len(values) != len(pcrs)*SHA1_LEN:
+        raise Exception("Quote has %d bytes of PCR values for %d PCRs"%(len(values),len(pcrs)))
+    lines = []
+    for i, pcr in enumerate(pcrs):
+        lines.append("PCR %d %s\n"%(pcr, values[i*SHA1_LEN:(i+1)*SHA1_LEN].encode('hex')))
+    return lines
+
+def pcr_composite(select, values):
+    """Marshals a TPM_PCR_COMPOSITE the way the TPM hashes it."""
+    return struct.pack(">H", len(select)) + select + struct.pack(">I", len(values)) + values
+
+def parse_quote(blob, offset=0):
+    """Parses a tpmquote file.  Returns a dict with the signature, PCR select bitmap and
+    the raw PCR values, and the offset just past the quote."""
+    if len(blob) < offset+TPM_BUFFER_HEADER_LEN:
+        raise Exception("Quote truncated")
+    sig_len = struct.unpack_from("<I", blob, offset+4)[0]
+    offset += TPM_BUFFER_HEADER_LEN
+    if len(blob) < offset+sig_len+PCR_COMPOSITE_HEADER_LEN:
+        raise Exception("Quote truncated, expected %d byte signature"%sig_len)
+    quote = {'sig': blob[offset:offset+sig_len]}
+    offset += sig_len
+
+    size_of_select = struct.unpack_from("<H", blob, offset)[0]
+    value_size = struct.unpack_from("<I", blob, offset+8)[0]
+    if size_of_select > 4 or value_size > TPM_NUM_PCR*SHA1_LEN:
+        raise Exception("Invalid PCR composite in quote")
+    quote['select'] = blob[offset+2:offset+2+size_of_select]
+    offset += PCR_COMPOSITE_HEADER_LEN
+
+    if len(blob) < offset+value_size:
+        raise Exception("Quote truncated, expected %d bytes of PCR values"%value_size)
+    quote['values'] = blob[offset:offset+value_size]
+    quote['pcrs'] = _selection_to_pcrs(quote['select'])
+    return quote, offset+value_size
+
+def verify_quote(quote, nonce, aik_pem):
+    """Checks the TPM_QUOTE_INFO signature of a parsed quote.  tpmquote hashes the nonce
+    string to get the 20 byte externalData."""
+    composite = pcr_composite(quote['select'], quote['values'])
+    quote_info = TPM_QUOTE_INFO_HEADER + hashlib.sha1(composite).digest() + hashlib.sha1(nonce).digest()
+    return crypto.rsa_verify_sha1_pkcs1(crypto.rsa_import_pubkey(aik_pem), quote_info, quote['sig'])
+
+def check_quote(nonce, aik_pem, blob):
+    """Verifies a tpmquote file.  Returns the PCR lines that checkquote prints after
+    "PCR contents from quote:" or None if the signature does not verify."""
+    quote, offset = parse_quote(blob)
+    if offset != len(blob):
+        raise Exception("Unexpected trailing data in quote")
+    if not verify_quote(quote, nonce, aik_pem):
+        logger.error("Quote signature does not verify against the AIK and nonce")
+        return None
+    return _pcr_lines(quote['pcrs'], quote['values'])
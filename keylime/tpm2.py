@@ -27,7 +27,6 @@ import os
 import re
 from sets import Set
 import sys
-import tempfile
 import threading
 import time
 
@@ -37,7 +36,8 @@ from M2Crypto import m2
 import cmd_exec
 import common
 import keylime_logging
-import secure_mount
+import quote_batch
+import tpm2_quote
 from tpm_abstract import Hash_Algorithms, Encrypt_Algorithms, Sign_Algorithms, AbstractTPM, TPM_Utilities
 from tpm_ek_ca import atmel_trusted_keys, trusted_certs
 
@@ -363,7 +363,7 @@ class tpm2(AbstractTPM):
         ek_pw = TPM_Utilities.random_password(20)
         
         # create a new ek 
-        with tempfile.NamedTemporaryFile() as tmppath:
+        with cmd_exec.MemFile() as tmppath:
             cmdargs = {
                 'asymalg': asym_alg,
                 'ekpubfile': tmppath.name,
@@ -434,8 +434,8 @@ class tpm2(AbstractTPM):
         handle = self.get_tpm_metadata('ek_handle')
         if handle is None:
             raise Exception("create_ek has not been run yet?")
-        #make a temp file for the output 
-        with tempfile.NamedTemporaryFile() as tmppath:
+        #make a memory file for the output 
+        with cmd_exec.MemFile() as tmppath:
             # generates pubek.pem
             if legacy_tools:
                 retDict = self.__run("tpm2_readpublic -H %s -o %s -f pem"%(hex(handle), tmppath.name), raiseOnError=False, outputpaths=tmppath.name)
@@ -467,8 +467,8 @@ class tpm2(AbstractTPM):
         handle = self.get_tpm_metadata('aik_handle')
         if handle is None:
             raise Exception("tpm2_getpubak has not been run yet?")
-        #make a temp file for the output 
-        with tempfile.NamedTemporaryFile() as akpubfile:
+        #make a memory file for the output 
+        with cmd_exec.MemFile() as akpubfile:
             # generates pubak.pem
             retDict = self.__run("tpm2_readpublic -H %s -o %s -f pem"%(hex(handle), akpubfile.name), raiseOnError=False, outputpaths=akpubfile.name)
             output = retDict['retout']
@@ -537,8 +537,8 @@ class tpm2(AbstractTPM):
             raise Exception("Failed to create AIK, since EK has not yet been created!")
         
         aik_pw = TPM_Utilities.random_password(20)
-        #make a temp file for the output
-        with tempfile.NamedTemporaryFile() as akpubfile:
+        #make a memory file for the output
+        with cmd_exec.MemFile() as akpubfile:
             cmdargs = {
                 'ekhandle': hex(ek_handle),
                 'akpubfile': akpubfile.name,
@@ -615,53 +615,32 @@ class tpm2(AbstractTPM):
 
     def encryptAIK(self, uuid, pubaik, pubek, ek_tpm, aik_name):
         pubaikFile = None
-        pubekFile = None
-        challengeFile = None
         keyblob = None
-        blobpath = None
         
         if ek_tpm is None or aik_name is None:
             logger.error("Missing parameters for encryptAIK")
             return None
         
         try:
-            # write out the public EK
-            efd, etemp = tempfile.mkstemp()
-            pubekFile = open(etemp, "wb")
-            pubekFile.write(base64.b64decode(ek_tpm))
-            pubekFile.close()
-            os.close(efd)
-            
-            # write out the challenge
+            # the public EK and the challenge for the tool, and the blob it makes
             challenge = TPM_Utilities.random_password(32)
-            keyfd, keypath = tempfile.mkstemp()
-            challengeFile = open(keypath, "wb")
-            challengeFile.write(challenge)
-            challengeFile.close()
-            os.close(keyfd)
-            
-            # create temp file for the blob
-            blobfd, blobpath = tempfile.mkstemp()
-            
-            cmdargs = {
-                'akname': aik_name,
-                'ekpub': pubekFile.name,
-                'blobout': blobpath,
-                'challenge': challengeFile.name
-            }
-            if legacy_tools:
-                command = "tpm2_makecredential -T none -e {ekpub} -s {challenge} -n {akname} -o {blobout}".format(**cmdargs)
-            else:
-                command = "tpm2_makecredential -e {ekpub} -s {challenge} -n {akname} -o {blobout} --no-tpm".format(**cmdargs)
-            self.__run(command, lock=False)
-            
-            logger.info("Encrypting AIK for UUID %s"%uuid)
-            
-            # read in the blob
-            f = open(blobpath, "rb")
-            keyblob = base64.b64encode(f.read())
-            f.close()
-            os.close(blobfd)
+            with cmd_exec.MemFile(base64.b64decode(ek_tpm)) as pubekFile, cmd_exec.MemFile(challenge) as challengeFile, cmd_exec.MemFile() as blobFile:
+                cmdargs = {
+                    'akname': aik_name,
+                    'ekpub': pubekFile.name,
+                    'blobout': blobFile.name,
+                    'challenge': challengeFile.name
+                }
+                if legacy_tools:
+                    command = "tpm2_makecredential -T none -e {ekpub} -s {challenge} -n {akname} -o {blobout}".format(**cmdargs)
+                else:
+                    command = "tpm2_makecredential -e {ekpub} -s {challenge} -n {akname} -o {blobout} --no-tpm".format(**cmdargs)
+                self.__run(command, lock=False)
+                
+                logger.info("Encrypting AIK for UUID %s"%uuid)
+                
+                # read in the blob
+                keyblob = base64.b64encode(blobFile.read())
             
             # read in the aes key
             key = base64.b64encode(challenge)
@@ -670,13 +649,6 @@ class tpm2(AbstractTPM):
             logger.error("Error encrypting AIK: "+str(e))
             logger.exception(e)
             return None
-        finally:
-            if pubekFile is not None:
-                os.remove(pubekFile.name)
-            if challengeFile is not None:
-                os.remove(challengeFile.name)
-            if blobpath is not None:
-                os.remove(blobpath)
         return (keyblob, key)
 
     def activate_identity(self, keyblob):
@@ -684,52 +656,33 @@ class tpm2(AbstractTPM):
         aik_keyhandle = self.get_tpm_metadata('aik_handle')
         ek_keyhandle = self.get_tpm_metadata('ek_handle')
         
-        keyblobFile = None
-        secpath = None
         try:
-            # write out key blob
-            kfd, ktemp = tempfile.mkstemp()
-            keyblobFile = open(ktemp, "wb")
-            keyblobFile.write(base64.b64decode(keyblob))
-            keyblobFile.close()
-            os.close(kfd)
-            
-            # ok lets write out the key now
-            secdir = secure_mount.mount() # confirm that storage is still securely mounted
-                
-            secfd, secpath = tempfile.mkstemp(dir=secdir)
-            
-            cmdargs = {
-                'akhandle': hex(aik_keyhandle),
-                'ekhandle': hex(ek_keyhandle),
-                'keyblobfile': keyblobFile.name,
-                'credfile': secpath,
-                'apw': self.get_tpm_metadata('aik_pw'),
-                'epw': owner_pw
-            }
-            if legacy_tools:
-                command = "tpm2_activatecredential -H {akhandle} -k {ekhandle} -f {keyblobfile} -o {credfile} -P {apw} -e {epw}".format(**cmdargs)
-            else:
-                command = "tpm2_activatecredential -c {akhandle} -C {ekhandle} -f {keyblobfile} -o {credfile} -P {apw} -E {epw}".format(**cmdargs)
-            retDict = self.__run(command, outputpaths=secpath)
-            retout = retDict['retout']
-            code = retDict['code']
-            fileout = retDict['fileouts'][secpath]
-            logger.info("AIK activated.")
+            # the key blob for the tool, and the key it recovers, which never goes to disk
+            with cmd_exec.MemFile(base64.b64decode(keyblob)) as keyblobFile, cmd_exec.MemFile() as secFile:
+                cmdargs = {
+                    'akhandle': hex(aik_keyhandle),
+                    'ekhandle': hex(ek_keyhandle),
+                    'keyblobfile': keyblobFile.name,
+                    'credfile': secFile.name,
+                    'apw': self.get_tpm_metadata('aik_pw'),
+                    'epw': owner_pw
+                }
+                if legacy_tools:
+                    command = "tpm2_activatecredential -H {akhandle} -k {ekhandle} -f {keyblobfile} -o {credfile} -P {apw} -e {epw}".format(**cmdargs)
+                else:
+                    command = "tpm2_activatecredential -c {akhandle} -C {ekhandle} -f {keyblobfile} -o {credfile} -P {apw} -E {epw}".format(**cmdargs)
+                retDict = self.__run(command, outputpaths=secFile.name)
+                retout = retDict['retout']
+                code = retDict['code']
+                fileout = retDict['fileouts'][secFile.name]
+                logger.info("AIK activated.")
             
             key = base64.b64encode(fileout)
-            os.close(secfd)
-            os.remove(secpath)
             
         except Exception as e:
             logger.error("Error decrypting AIK: "+str(e))
             logger.exception(e)
             return False
-        finally:
-            if keyblobFile is not None:
-                os.remove(keyblobFile.name)
-            if secpath is not None and os.path.exists(secpath):
-                os.remove(secpath)
         return key
 
     def verify_ek(self, ekcert, ekpem):
@@ -824,9 +777,9 @@ class tpm2(AbstractTPM):
             hash_alg = self.defaults['hash']
         
         quote = ""
-        with tempfile.NamedTemporaryFile() as quotepath:
-            with tempfile.NamedTemporaryFile() as sigpath:
-                with tempfile.NamedTemporaryFile() as pcrpath:
+        with cmd_exec.MemFile() as quotepath:
+            with cmd_exec.MemFile() as sigpath:
+                with cmd_exec.MemFile() as pcrpath:
                     keyhandle = self.get_tpm_metadata('aik_handle')
                     aik_pw = self.get_tpm_metadata('aik_pw')
                     
@@ -866,7 +819,7 @@ class tpm2(AbstractTPM):
     def __checkdeepquote_c(self, hAIK, vAIK, deepquoteFile, nonce):
         raise Exception("vTPM support and deep quotes not yet implemented with TPM 2.0!")
 
-    def check_deep_quote(self, nonce, data, quote, vAIK, hAIK, vtpm_policy={}, tpm_policy={}, ima_measurement_list=None, ima_whitelist={}):
+    def check_deep_quote(self, nonce, data, quote, vAIK, hAIK, vtpm_policy={}, tpm_policy={}, ima_measurement_list=None, ima_whitelist={}, ima_state=None):
         raise Exception("vTPM support and deep quotes not yet implemented with TPM 2.0!")
 
     def __check_quote_c(self, pubaik, nonce, quoteFile, sigFile, pcrFile, hash_alg):
@@ -891,15 +844,34 @@ class tpm2(AbstractTPM):
         retDict = self.__run(command.format(**cmdargs), lock=False)
         return retDict
 
-    def check_quote(self, nonce, data, quote, aikFromRegistrar, tpm_policy={}, ima_measurement_list=None, ima_whitelist={}, hash_alg=None):
+    def __check_quote_native(self, pubaik, nonce, quoteblob, sigblob, pcrblob, hash_alg):
+        """In process replacement for __check_quote_c.  Returns a {pcr number: hex value} 
+        map for check_pcrs or None if the quote does not verify."""
+        if common.STUB_TPM and common.TPM_CANNED_VALUES is not None:
+            jsonIn = common.TPM_CANNED_VALUES
+            if 'tpm2_deluxequote' in jsonIn and 'nonce' in jsonIn['tpm2_deluxequote']:
+                nonce = str(jsonIn['tpm2_deluxequote']['nonce'])
+            else:
+                raise Exception("Could not get quote nonce from canned JSON!")
+        
+        pcr_banks = tpm2_quote.check_quote(nonce, pubaik, quoteblob, sigblob, pcrblob, hash_alg)
+        if pcr_banks is None:
+            logger.error("Failed to validate quote signature, nonce or PCR digest")
+            return None
+        
+        pcrs = dict(pcr_banks.get(hash_alg, {}))
+        # IMA is always in SHA1 format, so don't leave it behind!
+        if hash_alg != Hash_Algorithms.SHA1 and common.IMA_PCR in pcr_banks.get(Hash_Algorithms.SHA1, {}):
+            pcrs[common.IMA_PCR] = pcr_banks[Hash_Algorithms.SHA1][common.IMA_PCR]
+        
+        if len(pcrs) == 0:
+            return None
+        return pcrs
+
+    def check_quote(self, nonce, data, quote, aikFromRegistrar, tpm_policy={}, ima_measurement_list=None, ima_whitelist={}, hash_alg=None, ima_state=None):
         if hash_alg is None:
             hash_alg = self.defaults['hash']
         
-        quoteFile = None
-        aikFile = None
-        sigFile = None
-        pcrFile = None
-
         if quote[0] != 'r':
             raise Exception("Invalid quote type %s"%quote[0])
         quote = quote[1:]
@@ -908,54 +880,39 @@ class tpm2(AbstractTPM):
         if len(quote_tokens) < 3:
             raise Exception("Quote is not compound! %s"%quote)
         
+        # a quote over the nonces of several requests, check it against the root that
+        # the proof leads to from ours
+        if len(quote_tokens) > 3:
+            try:
+                nonce = quote_batch.root_from_proof(nonce, quote_tokens[3])
+            except Exception as e:
+                logger.error("Invalid nonce proof in batched quote: %s"%e)
+                return False
+        
         quoteblob = base64.b64decode(quote_tokens[0]).decode("zlib")
         sigblob = base64.b64decode(quote_tokens[1]).decode("zlib")
         pcrblob = base64.b64decode(quote_tokens[2]).decode("zlib")
         
+        # legacy tpm2-tools write the pcr values in a different format, leave those to tpm2_checkquote
+        if config.getboolean('general','tpm2_native_quote_check') and not legacy_tools:
+            try:
+                pcrs = self.__check_quote_native(aikFromRegistrar, nonce, quoteblob, sigblob, pcrblob, hash_alg)
+            except Exception as e:
+                logger.warning("Unable to check quote natively, falling back to tpm2_checkquote: %s"%e)
+            else:
+                if pcrs is None:
+                    return False
+                return self.check_pcrs(tpm_policy, pcrs, data, False, ima_measurement_list, ima_whitelist, ima_state)
+        
         try:
-            # write out quote
-            qfd, qtemp = tempfile.mkstemp()
-            quoteFile = open(qtemp, "wb")
-            quoteFile.write(quoteblob)
-            quoteFile.close()
-            os.close(qfd)
-
-            # write out sig
-            sfd, stemp = tempfile.mkstemp()
-            sigFile = open(stemp, "wb")
-            sigFile.write(sigblob)
-            sigFile.close()
-            os.close(sfd)
-
-            # write out pcr
-            pfd, ptemp = tempfile.mkstemp()
-            pcrFile = open(ptemp, "wb")
-            pcrFile.write(pcrblob)
-            pcrFile.close()
-            os.close(pfd)
-
-            afd, atemp = tempfile.mkstemp()
-            aikFile = open(atemp, "w")
-            aikFile.write(aikFromRegistrar)
-            aikFile.close()
-            os.close(afd)
-
-            retDict = self.__check_quote_c(aikFile.name, nonce, quoteFile.name, sigFile.name, pcrFile.name, hash_alg)
+            with cmd_exec.MemFile(quoteblob) as quoteFile, cmd_exec.MemFile(sigblob) as sigFile, cmd_exec.MemFile(pcrblob) as pcrFile, cmd_exec.MemFile(aikFromRegistrar) as aikFile:
+                retDict = self.__check_quote_c(aikFile.name, nonce, quoteFile.name, sigFile.name, pcrFile.name, hash_alg)
             retout = retDict['retout']
             code = retDict['code']
         except Exception as e:
             logger.error("Error verifying quote: "+str(e))
             logger.exception(e)
             return False
-        finally:
-            if aikFile is not None:
-                os.remove(aikFile.name)
-            if quoteFile is not None:
-                os.remove(quoteFile.name)
-            if sigFile is not None:
-                os.remove(sigFile.name)
-            if pcrFile is not None:
-                os.remove(pcrFile.name)
 
         if len(retout) < 1 or code != AbstractTPM.EXIT_SUCESS:
             logger.error("Failed to validate signature, output: %s"%retout)
@@ -978,7 +935,7 @@ class tpm2(AbstractTPM):
         if len(pcrs) == 0:
             pcrs = None
 
-        return self.check_pcrs(tpm_policy, pcrs, data, False, ima_measurement_list, ima_whitelist)
+        return self.check_pcrs(tpm_policy, pcrs, data, False, ima_measurement_list, ima_whitelist, ima_state)
 
     def extendPCR(self, pcrval, hashval, hash_alg=None, lock=True):
         if hash_alg is None:
@@ -1002,9 +959,9 @@ class tpm2(AbstractTPM):
 
     #tpm_random
     def _get_tpm_rand_block(self, size=4096):
-        #make a temp file for the output 
+        #make a memory file for the output 
         rand = None
-        with tempfile.NamedTemporaryFile() as randpath:
+        with cmd_exec.MemFile() as randpath:
             try:
                 command = "tpm2_getrandom -o %s %d" % (randpath.name, size)
                 retDict = self.__run(command, outputpaths=randpath.name)
@@ -1024,7 +981,7 @@ class tpm2(AbstractTPM):
         owner_pw = self.get_tpm_metadata('owner_pw')
         
         # write out quote
-        with tempfile.NamedTemporaryFile() as keyFile:
+        with cmd_exec.MemFile() as keyFile:
             keyFile.write(key)
             keyFile.flush()
             
@@ -1038,8 +995,8 @@ class tpm2(AbstractTPM):
         return
 
     def read_ekcert_nvram(self):
-        #make a temp file for the quote 
-        with tempfile.NamedTemporaryFile() as nvpath:
+        #make a memory file for the ekcert 
+        with cmd_exec.MemFile() as nvpath:
 
             # Check for RSA EK cert in NVRAM (and get length)
             retDict = self.__run("tpm2_nvlist", raiseOnError=False)
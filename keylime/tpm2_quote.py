@@ -0,0 +1,252 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2019 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+import struct
+
+from Cryptodome.Hash import SHA1, SHA256, SHA384, SHA512
+from Cryptodome.PublicKey import RSA, ECC
+from Cryptodome.Signature import pkcs1_15, pss, DSS
+
+import keylime_logging
+
+logger = keylime_logging.init_logging('tpm2_quote')
+
+# In process verification of the quotes produced by tpm2.create_quote().  This does
+# the same job as tpm2_checkquote without writing anything to disk.
+
+TPM_GENERATED_VALUE = 0xff544347
+TPM_ST_ATTEST_QUOTE = 0x8018
+
+TPM_ALG_RSASSA = 0x0014
+TPM_ALG_RSAPSS = 0x0016
+TPM_ALG_ECDSA = 0x0018
+
+# TPM_ALG_ID to (keylime hash name, Cryptodome hash module)
+HASH_ALGS = {
+    0x0004: ('sha1', SHA1),
+    0x000B: ('sha256', SHA256),
+    0x000C: ('sha384', SHA384),
+    0x000D: ('sha512', SHA512),
+    }
+
+# the pcr file written by tpm2-tools is a raw dump of the host (little endian)
+# TPML_PCR_SELECTION and TPML_DIGEST structures, including their padding
+TPM2_NUM_PCR_BANKS = 16
+TPMS_PCR_SELECTION_SIZE = 8
+TPML_PCR_SELECTION_SIZE = 4 + TPM2_NUM_PCR_BANKS*TPMS_PCR_SELECTION_SIZE
+TPM2B_DIGEST_SIZE = 2 + 64
+TPML_DIGEST_SIZE = 4 + 8*TPM2B_DIGEST_SIZE
+
+
+def get_hash_name(alg_id):
+    if alg_id not in HASH_ALGS:
+        raise Exception("Unsupported TPM hash algorithm 0x%04x"%alg_id)
+    return HASH_ALGS[alg_id][0]
+
+def get_hash_module(alg_id):
+    if alg_id not in HASH_ALGS:
+        raise Exception("Unsupported TPM hash algorithm 0x%04x"%alg_id)
+    return HASH_ALGS[alg_id][1]
+
+
+class _Reader(object):
+    """Big endian reader for marshalled TPM structures."""
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, size):
+        if self.offset+size > len(self.data):
+            raise Exception("TPM structure truncated at offset %d"%self.offset)
+        out = self.data[self.offset:self.offset+size]
+        self.offset += size
+        return out
+
+    def unpack(self, fmt):
+        return struct.unpack(fmt, self.read(struct.calcsize(fmt)))
+
+    def u8(self):
+        return self.unpack(">B")[0]
+
+    def u16(self):
+        return self.unpack(">H")[0]
+
+    def u32(self):
+        return self.unpack(">I")[0]
+
+    def tpm2b(self):
+        return self.read(self.u16())
+
+
+def _selection_to_pcrs(select):
+    pcrs = []
+    for i in range(len(select)*8):
+        if ord(select[i/8]) & (1 << (i%8)):
+            pcrs.append(i)
+    return pcrs
+
+
+def parse_attest(quoteblob):
+    """Parses a marshalled TPMS_ATTEST holding a TPMS_QUOTE_INFO.
+
+    Returns a dict with the nonce (extraData), the list of (hash_alg_id, [pcr numbers])
+    selections and the pcrDigest.
+    """
+    r = _Reader(quoteblob)
+    magic = r.u32()
+    if magic != TPM_GENERATED_VALUE:
+        raise Exception("Quote was not generated by a TPM, magic 0x%08x"%magic)
+    attest_type = r.u16()
+    if attest_type != TPM_ST_ATTEST_QUOTE:
+        raise Exception("Attestation structure is not a quote, type 0x%04x"%attest_type)
+
+    attest = {}
+    attest['qualified_signer'] = r.tpm2b()
+    attest['extra_data'] = r.tpm2b()
+    (attest['clock'], attest['reset_count'], attest['restart_count'], attest['safe']) = r.unpack(">QIIB")
+    attest['firmware_version'] = r.unpack(">Q")[0]
+
+    selections = []
+    for _ in range(r.u32()):
+        alg = r.u16()
+        select = r.read(r.u8())
+        selections.append((alg, _selection_to_pcrs(select)))
+    attest['selections'] = selections
+    attest['pcr_digest'] = r.tpm2b()
+    return attest
+
+
+def parse_signature(sigblob):
+    """Parses a marshalled TPMT_SIGNATURE into (sig_alg, hash_alg, signature).
+
+    For ECDSA the signature is returned as the concatenated r and s values.
+    """
+    r = _Reader(sigblob)
+    sig_alg = r.u16()
+    hash_alg = r.u16()
+    if sig_alg in (TPM_ALG_RSASSA, TPM_ALG_RSAPSS):
+        sig = r.tpm2b()
+    elif sig_alg == TPM_ALG_ECDSA:
+        sig_r = r.tpm2b()
+        sig_s = r.tpm2b()
+        size = max(len(sig_r), len(sig_s))
+        sig = sig_r.rjust(size, '\0') + sig_s.rjust(size, '\0')
+    else:
+        raise Exception("Unsupported quote signature algorithm 0x%04x"%sig_alg)
+    return sig_alg, hash_alg, sig
+
+
+def parse_pcr_blob(pcrblob):
+    """Parses the pcr output file of tpm2_quote into a list of (hash_alg_id, pcr, value)
+    in the order they were selected, which is also the order they are digested in."""
+    if len(pcrblob) < TPML_PCR_SELECTION_SIZE+4:
+        raise Exception("PCR blob too short: %d bytes"%len(pcrblob))
+
+    selections = []
+    count = struct.unpack_from("<I", pcrblob, 0)[0]
+    if count > TPM2_NUM_PCR_BANKS:
+        raise Exception("Invalid number of PCR selections %d"%count)
+    for i in range(count):
+        offset = 4 + i*TPMS_PCR_SELECTION_SIZE
+        alg, size = struct.unpack_from("<HB", pcrblob, offset)
+        if size > 4:
+            raise Exception("Invalid PCR selection size %d"%size)
+        selections.append((alg, _selection_to_pcrs(pcrblob[offset+3:offset+3+size])))
+
+    offset = TPML_PCR_SELECTION_SIZE
+    num_digests = struct.unpack_from("<I", pcrblob, offset)[0]
+    offset += 4
+    if len(pcrblob) < offset + num_digests*TPML_DIGEST_SIZE:
+        raise Exception("PCR blob truncated, expected %d digest lists"%num_digests)
+
+    values = []
+    for i in range(num_digests):
+        base = offset + i*TPML_DIGEST_SIZE
+        n = struct.unpack_from("<I", pcrblob, base)[0]
+        if n > 8:
+            raise Exception("Invalid number of PCR digests %d"%n)
+        for j in range(n):
+            dbase = base + 4 + j*TPM2B_DIGEST_SIZE
+            size = struct.unpack_from("<H", pcrblob, dbase)[0]
+            if size > 64:
+                raise Exception("Invalid PCR digest size %d"%size)
+            values.append(pcrblob[dbase+2:dbase+2+size])
+
+    pcrs = []
+    for alg, pcr_nums in selections:
+        for pcr in pcr_nums:
+            if len(values) == 0:
+                raise Exception("PCR blob has fewer values than selected PCRs")
+            pcrs.append((alg, pcr, values.pop(0)))
+    return selections, pcrs
+
+
+def verify_signature(aik_pem, sig_alg, hash_alg, sig, message):
+    hash_obj = get_hash_module(hash_alg).new(message)
+    try:
+        if sig_alg == TPM_ALG_RSASSA:
+            pkcs1_15.new(RSA.importKey(aik_pem)).verify(hash_obj, sig)
+        elif sig_alg == TPM_ALG_RSAPSS:
+            pss.new(RSA.importKey(aik_pem)).verify(hash_obj, sig)
+        elif sig_alg == TPM_ALG_ECDSA:
+            DSS.new(ECC.import_key(aik_pem), 'fips-186-3').verify(hash_obj, sig)
+        else:
+            return False
+    except (ValueError, TypeError):
+        return False
+    return True
+
+
+def check_quote(nonce, aik_pem, quoteblob, sigblob, pcrblob, hash_alg):
+    """Checks a TPM 2.0 quote against the AIK and nonce.
+
+    Returns a dict of hash name to {pcr number: hex value} on success or None if the
+    quote could not be verified.  This is the in process equivalent of tpm2_checkquote.
+    """
+    attest = parse_attest(quoteblob)
+    sig_alg, sig_hash_alg, sig = parse_signature(sigblob)
+
+    if get_hash_name(sig_hash_alg) != hash_alg:
+        logger.error("Quote signature uses hash %s, expected %s"%(get_hash_name(sig_hash_alg), hash_alg))
+        return None
+
+    if not verify_signature(aik_pem, sig_alg, sig_hash_alg, sig, quoteblob):
+        logger.error("Quote signature does not verify against the AIK")
+        return None
+
+    if attest['extra_data'] != nonce:
+        logger.error("Quote nonce does not match expected value")
+        return None
+
+    selections, pcrs = parse_pcr_blob(pcrblob)
+    if selections != attest['selections']:
+        logger.error("PCR selection in quote does not match the provided PCR values")
+        return None
+
+    digest = get_hash_module(sig_hash_alg).new("".join([val for _, _, val in pcrs])).digest()
+    if digest != attest['pcr_digest']:
+        logger.error("Digest of the provided PCR values does not match the quote")
+        return None
+
+    pcr_map = {}
+    for alg, pcr, val in pcrs:
+        pcr_map.setdefault(get_hash_name(alg), {})[pcr] = val.encode('hex')
+    return pcr_map
@@ -286,11 +286,11 @@ class AbstractTPM(object):
             raise Exception("Invalid quote type %s"%quote[0])
 
     @abstractmethod
-    def check_deep_quote(self, nonce, data, quote, vAIK, hAIK, vtpm_policy={}, tpm_policy={}, ima_measurement_list=None, ima_whitelist={}):
+    def check_deep_quote(self, nonce, data, quote, vAIK, hAIK, vtpm_policy={}, tpm_policy={}, ima_measurement_list=None, ima_whitelist={}, ima_state=None):
         pass
 
     @abstractmethod
-    def check_quote(self, nonce, data, quote, aikFromRegistrar, tpm_policy={}, ima_measurement_list=None, ima_whitelist={}, hash_alg=None):
+    def check_quote(self, nonce, data, quote, aikFromRegistrar, tpm_policy={}, ima_measurement_list=None, ima_whitelist={}, hash_alg=None, ima_state=None):
         pass
 
     def hashdigest(self, payload, algorithm=None):
@@ -317,25 +317,86 @@ class AbstractTPM(object):
     def readPCR(self, pcrval, hash_alg=None):
         pass
 
-    def __check_ima(self, pcrval, ima_measurement_list, ima_whitelist):
+    def __check_ima(self, pcrval, ima_measurement_list, ima_whitelist, ima_state=None):
+        """Checks the measurement list against the IMA PCR value.
+        
+        ima_state, if given, is an ima.new_state() describing the entries already 
+        verified for this agent.  A full list that still starts with them is only checked 
+        from there on, and is checked in full if that doesn't add up to the PCR value.  A 
+        partial list that doesn't add up sets ima_state['resync'] so a full list can be 
+        requested.  On success ima_state is advanced past the list, otherwise
+        ima_state['failures'] is set to the ima.FailureSummary of the list as a dict.
+        
+        A list to check that ima.split_measurement_list() splits into ima_state['chunks']
+        pieces is not checked here.  ima_state['pieces'] is set to {'offset': where the
+        list to check starts, 'pieces': the pieces} instead, so the caller can have them
+        checked in parallel and check the quote again with ima_state['checked'] set to 
+        the same offset and the ima.check_piece() results of the pieces.  Nothing is 
+        compared against the PCR, or logged as failed, until then."""
         logger.info("Checking IMA measurement list...")
-        ex_value = ima.process_measurement_list(ima_measurement_list.split('\n'), ima_whitelist)
+        full_list = ima_measurement_list
+        start_hash = ima.START_HASH
+        binary = ima_state is not None and ima_state['binary']
+        resume = ima_state is not None and ima_state['entry'] > 0
+        if resume and not ima_state['partial']:
+            if ima.starts_with(ima_measurement_list, ima_state['offset'], ima_state['last'], binary):
+                logger.debug("IMA measurement list starts with %d verified entries"%ima_state['entry'])
+                ima_measurement_list = ima_measurement_list[ima_state['offset']:]
+            else:
+                ima.reset_state(ima_state)
+                resume = False
+        if resume:
+            start_hash = ima_state['hash'].decode('hex')
+        
+        failures = ima.FailureSummary()
+        offset = len(full_list) - len(ima_measurement_list)
+        checked = ima_state.get('checked') if ima_state is not None else None
+        pieces = None
+        if ima_state is not None and checked is None:
+            pieces = ima.split_measurement_list(ima_measurement_list, ima_state.get('chunks', 0), binary)
+        if pieces is not None:
+            logger.debug("IMA measurement list of %d bytes split into %d pieces"%(len(ima_measurement_list), len(pieces)))
+            ima_state['pieces'] = {'offset': offset, 'pieces': pieces}
+            return False
+        if checked is not None and checked['offset'] == offset:
+            ex_value = ima.combine_pieces(checked['pieces'], start_hash, failures)
+        else:
+            ex_value = ima.check_measurement_list(ima_measurement_list, ima_whitelist, start_hash, binary, failures)
         if ex_value is None:
+            if ima_state is not None:
+                ima_state['failures'] = failures.to_dict()
             return False
         
         if pcrval != ex_value and not common.STUB_IMA:
+            if resume and ima_state['partial']:
+                logger.warning("IMA measurement list from entry %d does not extend to TPM PCR %s, a full list is needed"%(ima_state['entry'], pcrval))
+                ima_state['resync'] = True
+                return False
+            if resume:
+                logger.info("IMA measurement list does not extend the %d verified entries to TPM PCR %s, checking all of it"%(ima_state['entry'], pcrval))
+                ima.reset_state(ima_state)
+                return self.__check_ima(pcrval, full_list, ima_whitelist, ima_state)
             logger.error("IMA measurement list expected pcr value %s does not match TPM PCR %s"%(ex_value, pcrval))
             return False
+        
+        if ima_state is not None:
+            count, last = ima.count_entries(ima_measurement_list, binary)
+            ima_state['entry'] += count
+            ima_state['offset'] += len(ima_measurement_list)
+            ima_state['hash'] = ex_value
+            if count > 0:
+                ima_state['last'] = last
         logger.debug("IMA measurement list validated")
         return True
 
-    def check_pcrs(self, tpm_policy, pcrs, data, virtual, ima_measurement_list, ima_whitelist):
-        pcrWhiteList = tpm_policy.copy()
-        if 'mask' in pcrWhiteList: del pcrWhiteList['mask']
-        # convert all pcr num keys to integers
-        pcrWhiteList = {int(k):v for k, v in pcrWhiteList.items()}
+    def __pcr_values(self, pcrs, virtual):
+        """Yields (pcr number, lower case hex value) from either a {pcr number: hex value}
+        map or a list of "PCR <num> <value>" lines as printed by the TPM tools."""
+        if isinstance(pcrs, dict):
+            for pcrnum, pcrval in sorted(pcrs.items()):
+                yield int(pcrnum), pcrval.lower()
+            return
         
-        pcrsInQuote = sets.Set()
         for line in pcrs:
             tokens = line.split()
             if len(tokens) < 3:
@@ -349,7 +410,19 @@ class AbstractTPM(object):
                 pcrnum = int(tokens[1])
             except Exception:
                 logger.error("Invalide PCR number %s"%tokens[1])
+                continue
             
+            yield pcrnum, pcrval
+    
+    def check_pcrs(self, tpm_policy, pcrs, data, virtual, ima_measurement_list, ima_whitelist, ima_state=None):
+        pcrWhiteList = tpm_policy.copy()
+        if 'mask' in pcrWhiteList: del pcrWhiteList['mask']
+        # convert all pcr num keys to integers
+        pcrWhiteList = {int(k):v for k, v in pcrWhiteList.items()}
+        
+        pcrsInQuote = sets.Set()
+        ima_pcrval = None
+        for pcrnum, pcrval in self.__pcr_values(pcrs, virtual):
             if pcrnum == common.TPM_DATA_PCR and data is not None:
                 # compute expected value  H(0|H(string(H(data))))
                 # confused yet?  pcrextend will hash the string of the original hash again
@@ -365,11 +438,10 @@ class AbstractTPM(object):
                     logger.error("IMA PCR in policy, but no measurement list provided")
                     return False
                 
-                if self.__check_ima(pcrval, ima_measurement_list, ima_whitelist):
-                    pcrsInQuote.add(pcrnum)
-                    continue
-                else:
-                    return False
+                # checked last, see below
+                ima_pcrval = pcrval
+                pcrsInQuote.add(pcrnum)
+                continue
                     
             if pcrnum not in pcrWhiteList.keys():
                 if not common.STUB_TPM and len(tpm_policy.keys()) > 0:
@@ -388,6 +460,11 @@ class AbstractTPM(object):
         if len(missing) > 0:
             logger.error("%sPCRs specified in policy not in quote: %s"%(("", "v")[virtual], missing))
             return False
+        
+        # the measurement list may come back split into pieces that are checked before 
+        # the quote is checked again, only the other PCRs are known to be good then
+        if ima_pcrval is not None:
+            return self.__check_ima(ima_pcrval, ima_measurement_list, ima_whitelist, ima_state)
         return True
 
 
@@ -0,0 +1,216 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2019 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+import ConfigParser
+import itertools
+import os
+import Queue
+import threading
+import time
+import traceback
+
+import tornado.ioloop
+from tornado.concurrent import Future
+
+import common
+import keylime_logging
+
+logger = keylime_logging.init_logging('tpm_executor')
+
+# setup config
+config = ConfigParser.SafeConfigParser()
+config.read(common.CONFIG_FILE)
+
+# classes of TPM work, waiting jobs of a lower class are run first
+INTEGRITY = 0   # integrity quotes for verifiers
+IDENTITY = 1    # identity quotes for tenants
+KEYS = 2        # storing the derived key and measuring the payload
+CLASS_NAMES = ['integrity', 'identity', 'keys']
+
+# sorts after all jobs, tells a worker to exit
+_STOP = len(CLASS_NAMES)
+
+
+class QueueFull(Exception):
+    """Raised by TPMExecutor.try_submit() when the queue of a class of jobs is full."""
+    pass
+
+
+def _invoke(func, args, submitted_at):
+    t0 = time.time()
+    try:
+        return (True, func(*args), t0-submitted_at, time.time()-t0)
+    except Exception as e:
+        return (False, "%s\n%s"%(e, traceback.format_exc()), t0-submitted_at, time.time()-t0)
+
+
+class TPMExecutor(object):
+    """Runs TPM bound work for the cloud agent off of the tornado IOLoop.
+
+    Jobs are run by a fixed number of worker threads, which mostly wait on the TPM
+    tools, and a tornado Future is returned that resolves on the IOLoop once the job
+    is done.  Each job has a class, and waiting jobs are run in the order of their
+    classes and then in the order they came in, so integrity quotes for verifiers 
+    don't wait behind a burst of tenant requests.  Requests that can be turned away 
+    are submitted with try_submit(), which refuses jobs once max_queue[class] jobs of
+    their class are waiting, so they are answered quickly instead of piling up.
+    """
+
+    def __init__(self, num_workers, max_queue, io_loop=None):
+        self.num_workers = num_workers
+        self.max_queue = max_queue
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.current()
+        self.pid = os.getpid()
+        self.jobs = Queue.PriorityQueue()
+        # keeps jobs of a class in order
+        self.sequence = itertools.count()
+
+        # counters per class, only touched from the IOLoop thread
+        self.stats = []
+        for _ in CLASS_NAMES:
+            self.stats.append({
+                'submitted': 0,
+                'completed': 0,
+                'failed': 0,
+                'rejected': 0,
+                'max_queue_depth': 0,
+                'total_wait': 0.0,
+                'max_wait': 0.0,
+                'last_wait': 0.0,
+                'total_exec_time': 0.0,
+                })
+
+        self.workers = []
+        for _ in range(num_workers):
+            worker = threading.Thread(target=self.__work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        logger.info("Started TPM executor with %d workers, at most %s queued jobs"%(num_workers, 
+            ", ".join(["%d %s"%(limit, name) for name, limit in zip(CLASS_NAMES, max_queue) if limit is not None])))
+
+    def queue_depth(self, job_class=None):
+        """Jobs of job_class, or of all classes, submitted and not done yet, including
+        the ones running."""
+        if job_class is None:
+            return sum([self.queue_depth(c) for c in range(len(CLASS_NAMES))])
+        stats = self.stats[job_class]
+        return stats['submitted'] - stats['completed'] - stats['failed']
+
+    def try_submit(self, job_class, func, *args):
+        """Like submit(), but raises QueueFull instead if max_queue[job_class] jobs of
+        the class are waiting."""
+        limit = self.max_queue[job_class]
+        if limit is not None and self.queue_depth(job_class) >= limit:
+            self.stats[job_class]['rejected'] += 1
+            raise QueueFull("%d TPM %s jobs already queued"%(self.queue_depth(job_class), CLASS_NAMES[job_class]))
+        return self.submit(job_class, func, *args)
+
+    def submit(self, job_class, func, *args):
+        """Schedule func(*args) on a worker thread as a job of job_class and return a
+        Future for its result."""
+        future = Future()
+        stats = self.stats[job_class]
+        stats['submitted'] += 1
+        stats['max_queue_depth'] = max(stats['max_queue_depth'], self.queue_depth(job_class))
+        self.jobs.put((job_class, next(self.sequence), func, args, future, time.time()))
+        return future
+
+    def __work(self):
+        while True:
+            job_class, _, func, args, future, submitted_at = self.jobs.get()
+            if job_class == _STOP:
+                return
+            outcome = _invoke(func, args, submitted_at)
+            self.io_loop.add_callback(self.__complete, job_class, future, outcome)
+
+    def __complete(self, job_class, future, outcome):
+        ok, result, wait, exec_time = outcome
+        stats = self.stats[job_class]
+        stats['total_wait'] += wait
+        stats['max_wait'] = max(stats['max_wait'], wait)
+        stats['last_wait'] = wait
+        stats['total_exec_time'] += exec_time
+        if ok:
+            stats['completed'] += 1
+            future.set_result(result)
+        else:
+            stats['failed'] += 1
+            future.set_exception(Exception("TPM job failed: %s"%result))
+
+    def __avg_exec_time(self):
+        done = sum([s['completed'] + s['failed'] for s in self.stats])
+        if done == 0:
+            return 0.0
+        return sum([s['total_exec_time'] for s in self.stats])/done
+
+    def wait_estimate(self, job_class):
+        """About how many seconds a job of job_class submitted now would wait for a 
+        worker, behind the jobs of its own and more urgent classes."""
+        ahead = sum([self.queue_depth(c) for c in range(job_class+1)])
+        return ahead*self.__avg_exec_time()/max(self.num_workers, 1)
+
+    def get_stats(self):
+        """Counters and wait times of each class of jobs, and of all of them."""
+        classes = {}
+        for job_class, name in enumerate(CLASS_NAMES):
+            stats = self.stats[job_class]
+            done = stats['completed'] + stats['failed']
+            classes[name] = {
+                'max_queue': self.max_queue[job_class],
+                'submitted': stats['submitted'],
+                'completed': stats['completed'],
+                'failed': stats['failed'],
+                'rejected': stats['rejected'],
+                'queue_depth': self.queue_depth(job_class),
+                'max_queue_depth': stats['max_queue_depth'],
+                'last_wait': stats['last_wait'],
+                'max_wait': stats['max_wait'],
+                'avg_wait': stats['total_wait']/done if done > 0 else 0.0,
+                'avg_exec_time': stats['total_exec_time']/done if done > 0 else 0.0,
+                }
+        return {
+            'workers': self.num_workers,
+            'queue_depth': self.queue_depth(),
+            'avg_exec_time': self.__avg_exec_time(),
+            'classes': classes,
+            }
+
+    def shutdown(self):
+        """Lets the workers finish the queued jobs and exit."""
+        for _ in self.workers:
+            self.jobs.put((_STOP, next(self.sequence), None, None, None, None))
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+
+__executor = None
+__executor_lock = threading.Lock()
+
+def get_executor():
+    """Returns the TPM executor for this process."""
+    global __executor
+    with __executor_lock:
+        if __executor is None or __executor.pid != os.getpid():
+            # key jobs must not be turned away
+            max_queue = [config.getint('cloud_agent','tpm_max_queue_integrity'), config.getint('cloud_agent','tpm_max_queue_identity'), None]
+            __executor = TPMExecutor(config.getint('cloud_agent','tpm_workers'), max_queue)
+        return __executor
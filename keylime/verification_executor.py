@@ -0,0 +1,219 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2019 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+import ConfigParser
+import itertools
+import multiprocessing
+import multiprocessing.queues
+import os
+import threading
+import time
+import traceback
+
+import tornado.ioloop
+from tornado.concurrent import Future
+
+import common
+import keylime_logging
+
+logger = keylime_logging.init_logging('verification_executor')
+
+# setup config
+config = ConfigParser.SafeConfigParser()
+config.read(common.CONFIG_FILE)
+
+# how often, in seconds, to look for pool workers that died
+WATCHDOG_INTERVAL = 5.0
+
+# how often a job whose worker died is run again, it may be what killed the worker
+MAX_JOB_RETRIES = 1
+
+# in pool workers, where _invoke() reports the jobs it starts
+_started = None
+
+def _init_worker(started):
+    global _started
+    _started = started
+
+def _invoke(job_id, func, args):
+    """Runs inside a pool worker.  Exceptions don't survive apply_async callbacks
+    in python 2, so package them up with the result and re-raise on the IOLoop."""
+    if _started is not None:
+        # written before the job runs, a SimpleQueue has no feeder thread to lose
+        _started.put((job_id, os.getpid()))
+    t0 = time.time()
+    try:
+        return (True, func(*args), time.time()-t0)
+    except Exception as e:
+        return (False, "%s\n%s"%(e, traceback.format_exc()), time.time()-t0)
+
+
+class VerificationExecutor(object):
+    """Runs CPU and subprocess bound quote checks off of the tornado IOLoop.
+
+    Jobs are handed to a fixed size process pool and a tornado Future is returned
+    that resolves on the IOLoop once the worker is done.  With zero workers jobs
+    are run inline, which is the old blocking behavior.
+
+    The pool replaces workers that die, e.g. killed for running out of memory, but
+    the jobs they were running are lost and their results never come back.  Workers
+    report which job they start, and a watchdog submits the jobs of workers that
+    are gone again, or fails them after MAX_JOB_RETRIES.  Results of failed jobs
+    that still come in are dropped.
+    """
+
+    def __init__(self, num_workers, io_loop=None, watchdog_interval=WATCHDOG_INTERVAL):
+        self.num_workers = num_workers
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.current()
+        self.pool = None
+        self.watchdog = None
+        self.pid = os.getpid()
+        # job id : [future, submitted_at, func, args, retries] of the jobs that 
+        # haven't come back
+        self.pending = {}
+        # job id : pid of the worker running it, as far as the watchdog has seen
+        self.running = {}
+        self.job_ids = itertools.count()
+        self.started = None
+
+        # counters, only touched from the IOLoop thread
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.max_queue_depth = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.last_latency = 0.0
+        self.total_exec_time = 0.0
+        self.retried = 0
+
+        if self.num_workers > 0:
+            self.started = multiprocessing.queues.SimpleQueue()
+            self.pool = multiprocessing.Pool(processes=self.num_workers, initializer=_init_worker, initargs=(self.started,))
+            self.watchdog = tornado.ioloop.PeriodicCallback(self.check_workers, watchdog_interval*1000, io_loop=self.io_loop)
+            self.watchdog.start()
+            logger.info("Started quote verification pool with %d workers"%self.num_workers)
+
+    def queue_depth(self):
+        return self.submitted - self.completed - self.failed
+
+    def submit(self, func, *args):
+        """Schedule func(*args) and return a Future for its result.  func must be
+        a module level function so that it can be pickled to the workers."""
+        future = Future()
+        job_id = next(self.job_ids)
+        self.pending[job_id] = [future, time.time(), func, args, 0]
+        self.submitted += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth())
+
+        if self.pool is None:
+            self._complete(job_id, _invoke(job_id, func, args))
+            return future
+
+        self.__apply(job_id, func, args)
+        return future
+
+    def __apply(self, job_id, func, args):
+        # the pool result handler runs in its own thread, bounce back to the IOLoop
+        def on_done(outcome):
+            self.io_loop.add_callback(self._complete, job_id, outcome)
+        self.pool.apply_async(_invoke, (job_id, func, args), callback=on_done)
+
+    def check_workers(self):
+        """Submits the jobs of workers that died again, or fails them if they were
+        retried often enough."""
+        if self.pool is None:
+            return
+        while not self.started.empty():
+            job_id, pid = self.started.get()
+            if job_id in self.pending:
+                self.running[job_id] = pid
+        # this also reaps exited workers, a dead one is never mistaken for alive
+        alive = set([child.pid for child in multiprocessing.active_children()])
+        for job_id, pid in self.running.items():
+            if pid in alive:
+                continue
+            del self.running[job_id]
+            job = self.pending[job_id]
+            if job[4] >= MAX_JOB_RETRIES:
+                logger.error("quote verification worker %d died running job %d, failing it"%(pid, job_id))
+                self._complete(job_id, (False, "verification worker died", 0.0))
+                continue
+            logger.warning("quote verification worker %d died running job %d, retrying it"%(pid, job_id))
+            job[4] += 1
+            self.retried += 1
+            self.__apply(job_id, job[2], job[3])
+
+    def _complete(self, job_id, outcome):
+        if job_id not in self.pending:
+            # failed by the watchdog already
+            return
+        self.running.pop(job_id, None)
+        future, submitted_at = self.pending.pop(job_id)[:2]
+        ok, result, exec_time = outcome
+        latency = time.time() - submitted_at
+        self.total_latency += latency
+        self.total_exec_time += exec_time
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        if ok:
+            self.completed += 1
+            future.set_result(result)
+        else:
+            self.failed += 1
+            future.set_exception(Exception("Verification job failed: %s"%result))
+
+    def get_stats(self):
+        done = self.completed + self.failed
+        return {
+            'workers': self.num_workers,
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'retried': self.retried,
+            'queue_depth': self.queue_depth(),
+            'max_queue_depth': self.max_queue_depth,
+            'last_latency': self.last_latency,
+            'max_latency': self.max_latency,
+            'avg_latency': self.total_latency/done if done > 0 else 0.0,
+            'avg_exec_time': self.total_exec_time/done if done > 0 else 0.0,
+            }
+
+    def shutdown(self):
+        if self.watchdog is not None:
+            self.watchdog.stop()
+            self.watchdog = None
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+
+__executor = None
+__executor_lock = threading.Lock()
+
+def get_executor():
+    """Returns the executor for this process.  The pool is created lazily so that
+    each forked tornado process ends up with its own workers."""
+    global __executor
+    with __executor_lock:
+        if __executor is None or __executor.pid != os.getpid():
+            __executor = VerificationExecutor(config.getint('cloud_verifier','verification_pool_num_workers'))
+        return __executor
@@ -0,0 +1,218 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2019 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+import collections
+import ConfigParser
+import json
+import os
+import re
+
+import common
+import keylime_logging
+import ima
+import ima_whitelist
+
+logger = keylime_logging.init_logging('whitelist_store')
+
+# setup config
+config = ConfigParser.SafeConfigParser()
+config.read(common.CONFIG_FILE)
+
+# IMA whitelists (with their exclude lists) uploaded to the verifier, addressed by
+# their ima.whitelist_version() digest, so a fleet of identical hosts can share one.
+#
+# Each whitelist is kept on disk as uploaded (<digest>.json), compiled
+# (<digest>.klwl, see ima_whitelist.CompiledWhitelist) and its exclude list
+# (<digest>.exclude, one pattern per line).  The compiled file is memory mapped, so
+# the verifier processes share its pages.  Every verifier process keeps one compiled
+# copy of each whitelist its agents use, counting the agents using it.  Whitelists no
+# agent uses are kept around for a while in case one comes back, the least recently
+# used ones are dropped once there are more than cache_size of them.
+#
+# Whitelists sent along with an agent are kept the same way in the inline
+# subdirectory, so the verification workers get them by digest too.  They aren't
+# listed or served as uploaded whitelists, and are removed once no agent has them.
+
+DIGEST_RE = re.compile(r'^[0-9a-f]{40}$')
+
+def valid_digest(digest):
+    return digest is not None and DIGEST_RE.match(digest) is not None
+
+def check_lists(lists):
+    """Raises an Exception unless lists looks like ima.process_whitelists() output."""
+    if not isinstance(lists,dict) or not isinstance(lists.get('whitelist'),dict) or not isinstance(lists.get('exclude'),list):
+        raise Exception("whitelist must have a 'whitelist' map and an 'exclude' list")
+    for path,digests in lists['whitelist'].iteritems():
+        if not isinstance(digests,list):
+            raise Exception("whitelist entry for %s is not a list of digests"%path)
+
+def compile_lists(lists):
+    """The lists checked against, compiled."""
+    compiled = ima_whitelist.CompiledWhitelist.from_dict(lists['whitelist'])
+    return {'whitelist': compiled, 'exclude': ima_whitelist.ExcludeMatcher(lists['exclude'])}
+
+
+class WhitelistStore(object):
+
+    def __init__(self, directory, cache_size):
+        self.directory = directory
+        self.inline_directory = os.path.join(directory,'inline')
+        self.cache_size = cache_size
+        # digest : [compiled lists, number of agents using them]
+        self.entries = {}
+        # digests of entries no agent uses, least recently used first
+        self.unused = collections.OrderedDict()
+        if not os.path.exists(self.inline_directory):
+            os.makedirs(self.inline_directory,0o700)
+
+    def __path(self, digest, ext, inline=False):
+        if not valid_digest(digest):
+            raise Exception("invalid whitelist digest %s"%digest)
+        return os.path.join(self.inline_directory if inline else self.directory,"%s.%s"%(digest,ext))
+
+    def __write(self, filename, data):
+        # readers in other processes never see a partial file
+        tmp = "%s.%d.tmp"%(filename,os.getpid())
+        with open(tmp,'wb') as f:
+            f.write(data)
+        os.rename(tmp,filename)
+
+    def exists(self, digest, inline=False):
+        if not valid_digest(digest):
+            return False
+        return os.path.exists(self.__path(digest,'json',inline))
+
+    def add(self, lists, digest=None, inline=False):
+        """Stores lists and returns their digest.  If digest is given it has to be the
+        digest of lists.  inline stores the whitelist of an agent, see the top."""
+        check_lists(lists)
+        actual = ima.whitelist_version(lists)
+        if digest is not None and digest != actual:
+            raise Exception("whitelist digest is %s, not %s"%(actual,digest))
+        if self.exists(actual,inline):
+            return actual
+        compiled = compile_lists(lists)
+        self.__write(self.__path(actual,'exclude',inline),''.join(["%s\n"%pattern for pattern in lists['exclude']]))
+        self.__write(self.__path(actual,'klwl',inline),compiled['whitelist'].buf)
+        # last, it is what exists() looks for
+        self.__write(self.__path(actual,'json',inline),json.dumps(lists))
+        logger.info("stored %swhitelist %s with %d paths"%("inline " if inline else "",actual,len(compiled['whitelist'])))
+        return actual
+
+    def read(self, digest):
+        """The lists as they were uploaded, as JSON, or None."""
+        if not self.exists(digest):
+            return None
+        with open(self.__path(digest,'json'),'rb') as f:
+            return f.read()
+
+    def remove(self, digest, inline=False):
+        """Deletes the whitelist from disk.  Returns False if it wasn't there."""
+        if not self.exists(digest,inline):
+            return False
+        os.remove(self.__path(digest,'json',inline))
+        for ext in ['klwl','exclude']:
+            if os.path.exists(self.__path(digest,ext,inline)):
+                os.remove(self.__path(digest,ext,inline))
+        if digest in self.unused:
+            del self.unused[digest]
+            del self.entries[digest]
+        return True
+
+    def count_paths(self, digest):
+        """The number of paths in the whitelist, or None if there is no such whitelist."""
+        entry = self.entries.get(digest)
+        if entry is not None:
+            return len(entry[0]['whitelist'])
+        if not self.exists(digest):
+            return None
+        # only the header is read
+        return len(ima_whitelist.CompiledWhitelist.load(self.__path(digest,'klwl')))
+
+    def digests(self):
+        return sorted([name[:-len('.json')] for name in os.listdir(self.directory) if name.endswith('.json') and valid_digest(name[:-len('.json')])])
+
+    def __load(self, digest):
+        if self.exists(digest):
+            inline = False
+        elif self.exists(digest,True):
+            inline = True
+        else:
+            return None
+        with open(self.__path(digest,'exclude',inline),'rb') as f:
+            exclude = f.read().splitlines()
+        compiled = ima_whitelist.CompiledWhitelist.load(self.__path(digest,'klwl',inline))
+        return {'whitelist': compiled, 'exclude': ima_whitelist.ExcludeMatcher(exclude)}
+
+    def acquire(self, digest, lists=None):
+        """Returns the compiled lists with this digest for an agent to use, or None if 
+        there is no such whitelist, uploaded or inline.  Lists that aren't in the store 
+        can be passed in, they are kept in memory only.  Every acquire() needs a 
+        release()."""
+        entry = self.entries.get(digest)
+        if entry is None:
+            if lists is not None:
+                compiled = compile_lists(lists)
+            else:
+                compiled = self.__load(digest)
+                if compiled is None:
+                    return None
+            stats = compiled['whitelist'].get_stats()
+            logger.info("compiled whitelist %s: %d paths, %d digests, %.1f bytes per entry"%(digest,stats['paths'],stats['digests'],stats['bytes_per_entry']))
+            entry = [compiled,0]
+            self.entries[digest] = entry
+        self.unused.pop(digest,None)
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, digest):
+        entry = self.entries.get(digest)
+        if entry is None or entry[1] == 0:
+            logger.warning("whitelist %s released more often than it was acquired"%digest)
+            return
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+        self.unused[digest] = True
+        while len(self.unused) > self.cache_size:
+            evicted,_ = self.unused.popitem(last=False)
+            del self.entries[evicted]
+            logger.debug("evicted whitelist %s"%evicted)
+
+    def get_stats(self):
+        return {
+            'compiled': len(self.entries),
+            'in_use': len(self.entries)-len(self.unused),
+            'unused': len(self.unused),
+            'refs': sum([entry[1] for entry in self.entries.values()]),
+            }
+
+
+__store = None
+
+def get_store():
+    """Returns the whitelist store of this process."""
+    global __store
+    if __store is None or __store[0] != os.getpid():
+        directory = config.get('cloud_verifier','whitelist_dir')
+        if not os.path.isabs(directory):
+            directory = os.path.join(common.WORK_DIR,directory)
+        __store = (os.getpid(),WhitelistStore(directory,config.getint('cloud_verifier','whitelist_cache_size')))
+    return __store[1]
@@ -0,0 +1,185 @@
+import unittest
+import os
+import sys
+import threading
+
+# Useful constants for the test
+KEYLIME_DIR=os.getcwdu()+"/../keylime/"
+
+# Custom imports
+sys.path.insert(0, KEYLIME_DIR)
+import tornado.ioloop
+import tornado.web
+import tornado.httpserver
+import tornado.testing
+import tornado.httpclient
+import tornado.httputil
+from tornado import gen
+import json
+import zlib
+import common
+import agent_http_client
+from agent_http_client import AgentHTTPClient
+
+DELAY = 0.2
+
+
+class SlowHandler(tornado.web.RequestHandler):
+    @tornado.web.asynchronous
+    def get(self):
+        tornado.ioloop.IOLoop.current().call_later(DELAY, self.done)
+
+    def done(self):
+        self.write("ok")
+        self.finish()
+
+
+LINES = ["10 %s ima-ng sha1:%s /usr/lib/file%d\n"%('ab'*20, 'cd'*20, i) for i in range(2000)]
+
+
+class StreamHandler(tornado.web.RequestHandler):
+    @gen.coroutine
+    def get(self):
+        chunks = [''.join(LINES[i:i+100]) for i in range(0, len(LINES), 100)]
+        yield common.echo_json_response_stream(self, 200, "Success", {'quote': 'q'}, 'ima_measurement_list', iter(chunks))
+
+
+# the threads the chunks of ThreadedStreamHandler were read on
+READERS = []
+
+class ThreadedStreamHandler(tornado.web.RequestHandler):
+    def chunks(self):
+        for i in range(0, len(LINES), 100):
+            READERS.append(threading.current_thread())
+            yield ''.join(LINES[i:i+100])
+
+    @gen.coroutine
+    def get(self):
+        yield common.echo_json_response_stream(self, 200, "Success", {'quote': 'q'}, 'ima_measurement_list', self.chunks(), common.read_chunk)
+
+
+class AgentHTTPClient_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = tornado.ioloop.IOLoop()
+        self.io_loop.make_current()
+        sock, self.port = tornado.testing.bind_unused_port()
+        self.server = tornado.httpserver.HTTPServer(tornado.web.Application([(r".*", SlowHandler)]), io_loop=self.io_loop)
+        self.server.add_sockets([sock])
+
+    def tearDown(self):
+        self.server.stop()
+        self.io_loop.clear_current()
+        self.io_loop.close(all_fds=True)
+
+    def fetch_all(self, client, count):
+        responses = []
+        def on_response(response):
+            responses.append(response)
+            if len(responses) == count:
+                self.io_loop.stop()
+        for _ in range(count):
+            client.fetch("http://127.0.0.1:%d/"%self.port, on_response)
+        self.io_loop.call_later(30, self.io_loop.stop)
+        self.io_loop.start()
+        return responses
+
+    def test_queue_time(self):
+        client = AgentHTTPClient(1, 5, 5, use_curl=False, io_loop=self.io_loop)
+        responses = self.fetch_all(client, 2)
+        self.assertEqual([r.body for r in responses], ["ok", "ok"])
+
+        stats = client.get_stats()
+        self.assertEqual(stats['backend'], 'simple')
+        self.assertEqual(stats['completed'], 2)
+        self.assertEqual(stats['errors'], 0)
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertEqual(stats['max_in_flight'], 2)
+        # the second request had to wait for the first
+        self.assertGreaterEqual(stats['max_queue_time'], DELAY*0.8)
+        client.close()
+
+    def test_no_queueing(self):
+        client = AgentHTTPClient(10, 5, 5, use_curl=False, io_loop=self.io_loop)
+        self.fetch_all(client, 2)
+        self.assertLess(client.get_stats()['max_queue_time'], DELAY*0.5)
+        client.close()
+
+    def test_timeout(self):
+        client = AgentHTTPClient(1, 5, DELAY/4, use_curl=False, io_loop=self.io_loop)
+        responses = self.fetch_all(client, 1)
+        self.assertEqual(responses[0].code, 599)
+        self.assertEqual(client.get_stats()['errors'], 1)
+        client.close()
+
+    def test_retry_after(self):
+        request = tornado.httpclient.HTTPRequest("http://127.0.0.1/")
+        def response(headers):
+            return tornado.httpclient.HTTPResponse(request, 503, headers=tornado.httputil.HTTPHeaders(headers))
+        self.assertEqual(agent_http_client.retry_after(response({'Retry-After': '3'}), 1.0), 3.0)
+        self.assertEqual(agent_http_client.retry_after(response({}), 1.0), 1.0)
+        # HTTP dates aren't sent by agents
+        self.assertEqual(agent_http_client.retry_after(response({'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}), 1.0), 1.0)
+
+
+class CompressedResponse_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = tornado.ioloop.IOLoop()
+        self.io_loop.make_current()
+        sock, self.port = tornado.testing.bind_unused_port()
+        app = tornado.web.Application([(r"/threaded", ThreadedStreamHandler), (r".*", StreamHandler)], transforms=[common.CompressContentEncoding])
+        self.server = tornado.httpserver.HTTPServer(app, io_loop=self.io_loop)
+        self.server.add_sockets([sock])
+        self.client = tornado.httpclient.AsyncHTTPClient(io_loop=self.io_loop, force_instance=True)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        self.io_loop.clear_current()
+        self.io_loop.close(all_fds=True)
+
+    def fetch(self, accept_encoding, path="/"):
+        request = tornado.httpclient.HTTPRequest("http://127.0.0.1:%d%s"%(self.port, path), decompress_response=False, headers={'Accept-Encoding': accept_encoding})
+        return self.io_loop.run_sync(lambda: self.client.fetch(request), timeout=30)
+
+    def assertResults(self, body):
+        results = json.loads(body)['results']
+        self.assertEqual(results['quote'], 'q')
+        self.assertEqual(results['ima_measurement_list'], ''.join(LINES))
+
+    def test_encodings(self):
+        response = self.fetch('gzip')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertResults(zlib.decompress(response.body, 16+zlib.MAX_WBITS))
+        self.assertLess(len(response.body), len(''.join(LINES))/10)
+
+        response = self.fetch('gzip;q=0, deflate')
+        self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+        self.assertResults(zlib.decompress(response.body))
+
+        response = self.fetch('identity')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertResults(response.body)
+
+    def test_read_off_the_loop(self):
+        del READERS[:]
+        self.assertResults(self.fetch('identity', "/threaded").body)
+        self.assertEqual(len(READERS), len(LINES)/100)
+        self.assertNotIn(threading.current_thread(), READERS)
+
+    def test_agent_client(self):
+        client = AgentHTTPClient(1, 5, 5, use_curl=False, io_loop=self.io_loop)
+        responses = []
+        def on_response(response):
+            responses.append(response)
+            self.io_loop.stop()
+        client.fetch("http://127.0.0.1:%d/"%self.port, on_response)
+        self.io_loop.call_later(30, self.io_loop.stop)
+        self.io_loop.start()
+        self.assertResults(responses[0].body)
+        client.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+import unittest
+import sys
+import os
+import sqlite3
+
+# Useful constants for the test
+KEYLIME_DIR=os.getcwdu()+"/../keylime/"
+
+# Custom imports
+sys.path.insert(0, KEYLIME_DIR)
+import keylime_sqlite
+import agent_registry
+
+DB_FILENAME = 'testdata_registry.sqlite'
+
+COLS_DB = {
+    'agent_id': 'TEXT PRIMARY KEY',
+    'operational_state': 'INT',
+    'public_key': 'TEXT',
+    'ima_whitelist': 'TEXT',
+    }
+
+TERMINATED = 8
+TENANT_FAILED = 10
+
+def remove_db():
+    for name in [DB_FILENAME,DB_FILENAME+'-wal',DB_FILENAME+'-shm']:
+        if os.path.exists(name):
+            os.remove(name)
+
+def read_row(agent_id):
+    with sqlite3.connect(DB_FILENAME) as conn:
+        return conn.execute("SELECT operational_state,public_key,ima_whitelist FROM main WHERE agent_id=?",(agent_id,)).fetchone()
+
+
+class AgentRegistry_Test(unittest.TestCase):
+
+    def setUp(self):
+        remove_db()
+        self.db = keylime_sqlite.KeylimeDB(DB_FILENAME,COLS_DB,['ima_whitelist'],{'pending_event':None})
+        self.registry = agent_registry.AgentRegistry(self.db,1.0,100)
+
+    def tearDown(self):
+        self.registry.stop()
+        self.db.close()
+        remove_db()
+
+    def test_write_behind(self):
+        agent = self.registry.add('a1',{'operational_state':0,'public_key':'','ima_whitelist':{'a':['1']}})
+        self.assertIs(self.registry.get('a1'),agent)
+
+        # nothing persisted changed
+        self.registry.touch(agent)
+        self.assertEqual(self.registry.flush(),0)
+
+        agent['operational_state'] = 3
+        agent['public_key'] = 'key'
+        self.registry.touch(agent)
+        self.assertEqual(read_row('a1')[0],0)
+        self.assertEqual(self.registry.flush(),1)
+        self.assertEqual(read_row('a1'),(3,'key','{"a": ["1"]}'))
+
+        # json columns are written when they are replaced
+        agent['ima_whitelist'] = {'b':['2']}
+        self.registry.touch(agent)
+        self.assertEqual(self.registry.changes('a1'),{'ima_whitelist':{'b':['2']}})
+        self.registry.flush()
+        self.assertEqual(read_row('a1')[2],'{"b": ["2"]}')
+
+        # and when they are changed in place
+        agent['ima_whitelist']['b'].append('3')
+        self.registry.touch(agent)
+        self.assertEqual(self.registry.flush(),1)
+        self.assertEqual(read_row('a1')[2],'{"b": ["2", "3"]}')
+
+        # unless they are compared by identity
+        self.registry.identity_cols = ['ima_whitelist']
+        agent['ima_whitelist'] = {'c':['5']}
+        self.registry.touch(agent)
+        self.assertEqual(self.registry.flush(),1)
+        agent['ima_whitelist']['c'].append('6')
+        self.registry.touch(agent)
+        self.assertEqual(self.registry.changes('a1'),{})
+
+    def test_failed_flush(self):
+        agent = self.registry.add('a1',{'operational_state':0,'public_key':'','ima_whitelist':{}})
+        agent['operational_state'] = 3
+        self.registry.touch(agent)
+
+        def fail():
+            raise Exception("disk I/O error")
+        self.db.flush = fail
+        self.assertEqual(self.registry.flush(),0)
+        del self.db.flush
+        self.assertEqual(read_row('a1')[0],0)
+
+        # still to be written
+        self.assertEqual(self.registry.changes('a1'),{'operational_state':3})
+        self.assertEqual(self.registry.flush(),1)
+        self.assertEqual(read_row('a1')[0],3)
+
+    def test_flush_size(self):
+        self.registry.flush_size = 2
+        a1 = self.registry.add('a1',{'operational_state':0,'public_key':'','ima_whitelist':{}})
+        a2 = self.registry.add('a2',{'operational_state':0,'public_key':'','ima_whitelist':{}})
+        a1['operational_state'] = 3
+        a2['operational_state'] = 3
+        self.registry.touch(a1)
+        self.assertEqual(read_row('a1')[0],0)
+        self.registry.touch(a2)
+        self.assertEqual(read_row('a1')[0],3)
+        self.assertEqual(read_row('a2')[0],3)
+
+    def test_user_state(self):
+        self.registry.stop()
+        self.db.close()
+        remove_db()
+        states = [TERMINATED,TENANT_FAILED]
+        self.db = keylime_sqlite.KeylimeDB(DB_FILENAME,dict(COLS_DB,ima_policy_serial='INT'),['ima_whitelist'],{'pending_event':None})
+        self.registry = agent_registry.AgentRegistry(self.db,1.0,100,states)
+
+        agent = self.registry.add('a1',{'operational_state':3,'public_key':'','ima_whitelist':{},'ima_policy_serial':0})
+        self.assertEqual(self.registry.get_user_state('a1',states),None)
+
+        self.registry.set_user_state('a1',TENANT_FAILED,'ima_policy_serial')
+        self.assertEqual(read_row('a1')[0],TENANT_FAILED)
+        self.assertEqual(self.registry.get_user_state('a1',states),TENANT_FAILED)
+        self.assertFalse(self.registry.refresh(agent,'ima_policy_serial',[]))
+
+        # a poll that was already in flight must not undo it
+        agent['operational_state'] = 3
+        self.registry.touch(agent)
+        self.registry.flush()
+        self.assertEqual(read_row('a1')[0],TENANT_FAILED)
+
+        self.registry.clear_user_state('a1',0,'ima_policy_serial')
+        self.assertEqual(self.registry.get_user_state('a1',states),None)
+
+        # a state set by another verifier process is picked up by refresh
+        other = agent_registry.AgentRegistry(self.db,1.0,100,states)
+        try:
+            other.set_user_state('a1',TERMINATED,'ima_policy_serial')
+        finally:
+            other.stop()
+        self.assertEqual(self.registry.get_user_state('a1',states),None)
+        self.assertTrue(self.registry.refresh(agent,'ima_policy_serial',[]))
+        self.assertEqual(self.registry.get_user_state('a1',states),TERMINATED)
+        self.assertEqual(agent['operational_state'],TERMINATED)
+
+        self.registry.remove('a1')
+        self.assertEqual(self.registry.get('a1'),None)
+        self.assertEqual(self.db.get_agent_ids(),[])
+
+    def test_update(self):
+        self.registry.stop()
+        self.db.close()
+        remove_db()
+        cols_db = dict(COLS_DB,ima_policy_serial='INT',tag='TEXT')
+        self.db = keylime_sqlite.KeylimeDB(DB_FILENAME,cols_db,['ima_whitelist'],{'pending_event':None},index_cols=['tag'])
+        self.registry = agent_registry.AgentRegistry(self.db,1.0,100)
+
+        a1 = self.registry.add('a1',{'operational_state':3,'public_key':'','ima_whitelist':{},'ima_policy_serial':0,'tag':'web'})
+        self.registry.add('a2',{'operational_state':3,'public_key':'','ima_whitelist':{},'ima_policy_serial':0,'tag':'web'})
+        self.registry.add('a3',{'operational_state':3,'public_key':'','ima_whitelist':{},'ima_policy_serial':0,'tag':'db'})
+        self.assertFalse(self.registry.refresh(a1,'ima_policy_serial',['ima_whitelist']))
+
+        # another verifier process polls a1 from the same database
+        other = agent_registry.AgentRegistry(self.db,1.0,100)
+        try:
+            a1_other = other.get('a1')
+            other.touch(a1_other)
+
+            self.assertEqual(self.registry.update({'ima_whitelist':{'b':['2']}},'tag','web','ima_policy_serial'),2)
+            self.assertEqual(a1['ima_whitelist'],{'b':['2']})
+            self.assertEqual(a1['ima_policy_serial'],1)
+            self.assertEqual(read_row('a3')[2],'{}')
+
+            # picked up by the next poll in the other process, and not written back
+            self.assertTrue(other.refresh(a1_other,'ima_policy_serial',['ima_whitelist']))
+            self.assertEqual(a1_other['ima_whitelist'],{'b':['2']})
+            self.assertFalse(other.refresh(a1_other,'ima_policy_serial',['ima_whitelist']))
+            other.touch(a1_other)
+            self.assertEqual(other.changes('a1'),{})
+        finally:
+            other.stop()
+
+    def test_untracked_agents(self):
+        self.db.add_agent('a1',{'operational_state':0,'public_key':'','ima_whitelist':{}})
+        # agents polled by another process are read fresh every time
+        self.assertIsNot(self.registry.get('a1'),self.registry.get('a1'))
+        self.registry.touch(self.registry.get('a1'))
+        self.assertIs(self.registry.get('a1'),self.registry.get('a1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
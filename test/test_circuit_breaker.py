@@ -0,0 +1,83 @@
+import unittest
+import os
+import sys
+
+# Useful constants for the test
+KEYLIME_DIR=os.getcwdu()+"/../keylime/"
+
+# Custom imports
+sys.path.insert(0, KEYLIME_DIR)
+import circuit_breaker
+from circuit_breaker import CircuitBreaker, AgentBreakers
+
+
+class CircuitBreaker_Test(unittest.TestCase):
+
+    def test_backoff(self):
+        for attempt in range(10):
+            delay = circuit_breaker.backoff(1, attempt, 60)
+            self.assertTrue(1 <= delay <= min(60, 2**attempt))
+        self.assertEqual(circuit_breaker.backoff(1, 0, 60), 1)
+        self.assertTrue(circuit_breaker.backoff(1, 1000, 60) <= 60)
+
+    def test_open_half_open_close(self):
+        breaker = CircuitBreaker(3, 10, 40)
+        breaker.failure('a', now=0)
+        breaker.failure('a', now=0)
+        self.assertEqual(breaker.wait_time('a', now=0), 0)
+        breaker.failure('a', now=0)
+        self.assertEqual(breaker.state('a'), circuit_breaker.OPEN)
+        self.assertEqual(breaker.wait_time('a', now=4), 6)
+
+        # one probe after the cooldown
+        self.assertEqual(breaker.wait_time('a', now=10), 0)
+        breaker.begin('a', now=10)
+        self.assertEqual(breaker.state('a'), circuit_breaker.HALF_OPEN)
+        self.assertEqual(breaker.wait_time('a', now=11), 9)
+
+        # a failed probe doubles the cooldown
+        breaker.failure('a', now=12)
+        self.assertEqual(breaker.state('a'), circuit_breaker.OPEN)
+        self.assertEqual(breaker.wait_time('a', now=12), 20)
+        breaker.begin('a', now=32)
+        breaker.failure('a', now=32)
+        breaker.begin('a', now=72)
+        breaker.failure('a', now=72)
+        self.assertEqual(breaker.wait_time('a', now=72), 40)
+
+        breaker.begin('a', now=112)
+        breaker.success('a')
+        self.assertEqual(breaker.state('a'), circuit_breaker.CLOSED)
+        self.assertEqual(breaker.wait_time('a', now=112), 0)
+
+    def test_lost_probe(self):
+        breaker = CircuitBreaker(1, 10, 40)
+        breaker.failure('a', now=0)
+        breaker.begin('a', now=10)
+        self.assertTrue(breaker.wait_time('a', now=15) > 0)
+        self.assertEqual(breaker.wait_time('a', now=21), 0)
+
+    def test_subnet_of(self):
+        self.assertEqual(circuit_breaker.subnet_of('10.1.2.3', 24), '10.1.2.0/24')
+        self.assertEqual(circuit_breaker.subnet_of('10.1.2.3', 16), '10.1.0.0/16')
+        self.assertEqual(circuit_breaker.subnet_of('agent.example.com', 24), 'agent.example.com')
+        self.assertEqual(circuit_breaker.subnet_of('fe80::1', 24), 'fe80::1')
+
+    def test_subnet_breaker(self):
+        breakers = AgentBreakers(3, 4, 24, 10, 40)
+        for i in range(4):
+            self.assertEqual(breakers.try_begin('10.0.0.%d'%i, 9002, now=0), 0)
+            breakers.failure('10.0.0.%d'%i, 9002, now=0)
+        # a different agent in the same subnet is held back, other subnets are not
+        self.assertEqual(breakers.try_begin('10.0.0.99', 9002, now=1), 9)
+        self.assertEqual(breakers.try_begin('10.0.1.1', 9002, now=1), 0)
+
+        # one agent probes the subnet, the rest wait for it
+        self.assertEqual(breakers.try_begin('10.0.0.99', 9002, now=10), 0)
+        self.assertTrue(breakers.try_begin('10.0.0.98', 9002, now=10) > 0)
+        breakers.success('10.0.0.99', 9002)
+        self.assertEqual(breakers.try_begin('10.0.0.98', 9002, now=11), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+import os
+import sys
+import tempfile
+
+# Useful constants for the test
+KEYLIME_DIR=os.getcwdu()+"/../keylime/"
+
+# Custom imports
+sys.path.insert(0, KEYLIME_DIR)
+import cmd_exec
+from cmd_exec import MemFile
+
+
+class MemFile_Test(unittest.TestCase):
+
+    def test_tool_io(self):
+        data = ''.join([chr(i) for i in range(256)])*10
+        before = set(os.listdir(tempfile.gettempdir()))
+        with MemFile(data) as infile, MemFile() as outfile:
+            self.assertTrue(infile.name.startswith("/dev/fd/"))
+            # a tool reads one and writes the other by name
+            retDict = cmd_exec.run("cat %s > %s"%(infile.name, outfile.name), lock=False, outputpaths=outfile.name)
+            self.assertEqual(retDict['fileouts'][outfile.name], data)
+            self.assertEqual(outfile.read(), data)
+            # overwritten, not appended to
+            cmd_exec.run("printf abc > %s"%outfile.name, lock=False)
+            self.assertEqual(outfile.read(), "abc")
+        self.assertEqual(set(os.listdir(tempfile.gettempdir())), before)
+
+    def test_close(self):
+        f = MemFile("x")
+        fd = f.fd
+        f.close()
+        f.close()
+        with self.assertRaises(OSError):
+            os.fstat(fd)
+
+    def test_without_memfd(self):
+        memfd_create = cmd_exec._memfd_create
+        cmd_exec._memfd_create = None
+        try:
+            with MemFile("data") as infile:
+                self.assertEqual(cmd_exec.run("cat %s"%infile.name, lock=False)['retout'], ["data"])
+        finally:
+            cmd_exec._memfd_create = memfd_create
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,360 @@
+import unittest
+import os
+import sys
+import struct
+import tempfile
+import StringIO
+
+# Useful constants for the test
+KEYLIME_DIR=os.getcwdu()+"/../keylime/"
+ML_PATH=os.getcwdu()+"/../scripts/ima/ascii_runtime_measurements"
+ML_IMA_PATH=os.getcwdu()+"/../scripts/ima/ascii_runtime_measurements_ima"
+# the same lists laid out as the kernel writes binary_runtime_measurements
+BIN_ML_PATH=os.getcwdu()+"/../scripts/ima/binary_runtime_measurements"
+BIN_ML_IMA_PATH=os.getcwdu()+"/../scripts/ima/binary_runtime_measurements_ima"
+
+# Custom imports
+sys.path.insert(0, KEYLIME_DIR)
+import common
+import ima
+import tpm_abstract
+
+
+class PCRCheckTPM(tpm_abstract.AbstractTPM):
+    pass
+# only check_pcrs is used
+PCRCheckTPM.__abstractmethods__ = frozenset()
+
+
+def to_binary(line, sig=None):
+    """The binary measurement list entry for an ascii one."""
+    pcr, template_hash, name, filedata, path = line.split(None, 4)
+    path = path.rstrip('\n')
+    if name == 'ima':
+        data = filedata.decode('hex') + struct.pack("<I", len(path)) + path
+    else:
+        fields = [filedata.split(':')[0] + ':\0' + filedata.split(':')[1].decode('hex'), path + '\0']
+        if sig is not None:
+            name = 'ima-sig'
+            fields.append(sig)
+        data = ''.join([struct.pack("<I", len(f)) + f for f in fields])
+        if sig is not None:
+            template_hash = ima.hashlib.sha1(data).hexdigest()
+        data = struct.pack("<I", len(data)) + data
+    return struct.pack("<I20sI", int(pcr), template_hash.decode('hex'), len(name)) + name + data
+
+
+class IMA_Test(unittest.TestCase):
+
+    def setUp(self):
+        with open(ML_PATH,'r') as f:
+            self.ml = f.read()
+        self.lines = self.ml.splitlines(True)
+        self.pcr = ima.process_measurement_list(self.lines)
+        self.assertIsNotNone(self.pcr)
+
+    def test_piecewise(self):
+        half = ima.process_measurement_list(self.lines[:400])
+        self.assertEqual(ima.process_measurement_list(self.lines[400:], start_hash=half.decode('hex')), self.pcr)
+
+    def test_read_measurement_list(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, ''.join(self.lines[:400]))
+            self.assertEqual(ima.read_measurement_list(path, 0), (''.join(self.lines[:400]), 0))
+            self.assertEqual(ima.read_measurement_list(path, 400), ('', 400))
+
+            # continuing from the previous read
+            os.write(fd, ''.join(self.lines[400:]))
+            self.assertEqual(ima.read_measurement_list(path, 400), (''.join(self.lines[400:]), 400))
+            # or from anywhere else
+            self.assertEqual(ima.read_measurement_list(path, 10), (''.join(self.lines[10:]), 10))
+            # asking for more than there is returns the whole list
+            self.assertEqual(ima.read_measurement_list(path, len(self.lines)+1), (self.ml, 0))
+        finally:
+            os.close(fd)
+            os.remove(path)
+
+    def test_open_measurement_list(self):
+        entries = [to_binary(line) for line in self.lines]
+        for binary, ml in [(False, self.ml), (True, ''.join(entries))]:
+            fd, path = tempfile.mkstemp()
+            try:
+                os.write(fd, ml)
+                for chunk_size in [1, 100, 5000, 1<<20]:
+                    for nth_entry in [0, 1, 399, len(entries), len(entries)+1]:
+                        expected = ima.read_measurement_list(path, nth_entry, binary)
+                        # never the same request twice in a row, so nothing is cached
+                        ima.read_measurement_list(path, 1, binary)
+                        chunks, nth = ima.open_measurement_list(path, nth_entry, binary, chunk_size)
+                        chunks = list(chunks)
+                        self.assertEqual((''.join(chunks), nth), expected)
+                        # in whole entries
+                        for chunk in chunks:
+                            self.assertEqual(''.join(ima.split_entries(chunk, binary)), chunk)
+            finally:
+                os.close(fd)
+                os.remove(path)
+
+    def test_encode_binary_chunks(self):
+        entries = [to_binary(line) for line in self.lines]
+        for size in [1, 7, 100]:
+            chunks = [''.join(entries[i:i+size]) for i in range(0, len(entries), size)]
+            encoded = list(ima.encode_binary_chunks(iter(chunks)))
+            self.assertEqual(ima.decode_binary_list(''.join(encoded)), ''.join(entries))
+        self.assertEqual(ima.decode_binary_list(''.join(ima.encode_binary_chunks(iter([])))), '')
+
+    def test_count_entries(self):
+        for ml in [self.ml, self.ml[:-1], self.ml[:-10], '', '\n\n']:
+            entries = ima.split_entries(ml)
+            self.assertEqual(ima.count_entries(ml), (len(entries), entries[-1] if entries else ''))
+            self.assertEqual(list(ima.iter_lines(ml)), ml.split('\n'))
+        entries = [to_binary(line) for line in self.lines]
+        self.assertEqual(ima.count_entries(''.join(entries), True), (len(entries), entries[-1]))
+        self.assertEqual(ima.count_entries(''.join(entries)[:-1], True), (len(entries)-1, entries[-2]))
+
+    def state_after(self, n, partial):
+        state = ima.new_state()
+        state['entry'] = n
+        state['hash'] = ima.process_measurement_list(self.lines[:n])
+        state['offset'] = len(''.join(self.lines[:n]))
+        state['last'] = self.lines[n-1]
+        state['partial'] = partial
+        return state
+
+    def check(self, ml, state):
+        tpm = PCRCheckTPM(need_hw_tpm=False)
+        pcrs = ["PCR %d %s"%(common.IMA_PCR, self.pcr)]
+        return tpm.check_pcrs({}, pcrs, None, False, ml, None, state)
+
+    def assertVerified(self, state):
+        self.assertEqual(state['entry'], len(self.lines))
+        self.assertEqual(state['hash'], self.pcr)
+        self.assertEqual(state['offset'], len(self.ml))
+        self.assertEqual(state['last'], self.lines[-1])
+
+    def test_starts_with(self):
+        state = self.state_after(400, False)
+        self.assertTrue(ima.starts_with(self.ml, state['offset'], state['last']))
+        self.assertFalse(ima.starts_with(''.join(self.lines[1:]), state['offset'], state['last']))
+        self.assertFalse(ima.starts_with(self.ml[:100], state['offset'], state['last']))
+
+    def test_binary(self):
+        for path in [ML_PATH, ML_IMA_PATH]:
+            with open(path, 'r') as f:
+                lines = f.readlines()
+            ml = ''.join([to_binary(line) for line in lines])
+            self.assertEqual(len(ima.split_entries(ml, True)), len(lines))
+            pcr = ima.process_measurement_list(lines)
+            self.assertIsNotNone(pcr)
+            self.assertEqual(ima.process_measurement_list_bin(ml), pcr)
+            self.assertEqual(ima.decode_binary_list(ima.encode_binary_list(ml)), ml)
+
+        # a truncated list or a bad template hash are errors
+        ml = ''.join([to_binary(line) for line in self.lines])
+        self.assertIsNone(ima.process_measurement_list_bin(ml[:-1]))
+        entry = to_binary(self.lines[1])
+        self.assertIsNone(ima.process_measurement_list_bin(entry[:4] + 'x' + entry[5:]))
+
+        # signatures are part of the template data
+        entry = to_binary(self.lines[1], sig='\x03\x02' + 'x'*64)
+        self.assertIsNotNone(ima.process_measurement_list_bin(entry))
+
+    def test_split_measurement_list(self):
+        ml = ''.join(self.lines)
+        self.assertIsNone(ima.split_measurement_list(ml, 7))
+        min_size = ima.config.get('cloud_verifier', 'ima_parallel_min_size')
+        ima.config.set('cloud_verifier', 'ima_parallel_min_size', '0')
+        try:
+            self.assertIsNone(ima.split_measurement_list(ml, 0))
+            for binary in [False, True]:
+                ml = ''.join([to_binary(line) for line in self.lines]) if binary else ''.join(self.lines)
+                pieces = ima.split_measurement_list(ml, 7, binary)
+                self.assertEqual(''.join(pieces), ml)
+                results = [ima.check_piece(piece, binary, None) for piece in pieces]
+                self.assertEqual(ima.combine_pieces(results), self.pcr)
+                
+                # unknown files, a wrong file hash, an excluded path
+                wl = ["%s %s"%(line.split()[3].split(':')[-1], line.split(None, 4)[4].strip()) for line in self.lines[10:]]
+                lists = ima.process_whitelists(wl, ["/usr/lib/.*"])
+                lists['whitelist'][wl[10].split()[1]] = ['00'*20]
+                expected = ima.FailureSummary(3)
+                if binary:
+                    self.assertIsNone(ima.process_measurement_list_bin(ml, lists, failures=expected))
+                else:
+                    self.assertIsNone(ima.process_measurement_list(self.lines, lists, failures=expected))
+                compiled = ima.compile_whitelists(lists)
+                failures = ima.FailureSummary(3)
+                self.assertIsNone(ima.combine_pieces([ima.check_piece(piece, binary, compiled, 3) for piece in pieces], failures=failures))
+                self.assertEqual(failures.to_dict(), expected.to_dict())
+            
+            # a truncated binary list
+            ml = ''.join([to_binary(line) for line in self.lines])
+            pieces = ima.split_measurement_list(ml[:-1], 7, True)
+            self.assertIsNone(ima.combine_pieces([ima.check_piece(piece, True, None) for piece in pieces]))
+            # from a verified prefix
+            half = ima.process_measurement_list(self.lines[:400]).decode('hex')
+            pieces = ima.split_measurement_list(''.join(self.lines[400:]), 7)
+            self.assertEqual(ima.combine_pieces([ima.check_piece(piece, False, None) for piece in pieces], half), self.pcr)
+        finally:
+            ima.config.set('cloud_verifier', 'ima_parallel_min_size', min_size)
+    
+    def test_failure_summary(self):
+        lists = ima.process_whitelists(["%s %s"%(line.split()[3].split(':')[-1], line.split(None, 4)[4].strip()) for line in self.lines[10:]], [])
+        path = self.lines[20].split(None, 4)[4].strip()
+        lists['whitelist'][path] = ['00'*20]
+        failures = ima.FailureSummary(4)
+        self.assertIsNone(ima.process_measurement_list(self.lines, lists, failures=failures))
+        self.assertTrue(failures.failed())
+
+        # the files only measured before the whitelisted ones, and the ones measured with
+        # a hash that is not whitelisted, including the changed one
+        not_found, bad = [], []
+        for line in self.lines[1:]:
+            filedata, p = line.split(None, 4)[3:]
+            p, digest = p.strip(), filedata.split(':')[-1]
+            if p not in lists['whitelist']:
+                not_found.append([p, ""])
+            elif digest not in lists['whitelist'][p]:
+                bad.append([p, digest])
+        self.assertIn([path, self.lines[20].split()[3].split(':')[-1]], bad)
+
+        # only the first few are kept
+        summary = failures.to_dict()
+        self.assertEqual(summary['template_hash'], 0)
+        self.assertEqual(summary['not_found'], len(not_found))
+        self.assertEqual(summary['not_found_samples'], not_found[:4])
+        self.assertEqual(summary['hash'], len(bad))
+        self.assertEqual(summary['hash_samples'], bad[:4])
+        self.assertEqual(summary['good'], len(self.lines) - len(not_found) - len(bad))
+
+        failures.merge(failures)
+        self.assertEqual(failures.counts[ima.HASH_FAILURE], 2*len(bad))
+        self.assertEqual(len(failures.samples[ima.HASH_FAILURE]), min(2*len(bad), 4))
+        self.assertEqual(len(failures.samples[ima.NOT_FOUND_FAILURE]), 4)
+
+    def test_binary_fixture(self):
+        for path, ascii_path, pcr, count in [(BIN_ML_PATH, ML_PATH, '82231c67a69da98dc5b3aa10f6343d33109225fc', 826),
+                                             (BIN_ML_IMA_PATH, ML_IMA_PATH, '93aacc9ec455c429c1a2d291650e40e7655565d8', 867)]:
+            with open(path, 'rb') as f:
+                ml = f.read()
+            self.assertEqual(ima.count_entries(ml, True)[0], count)
+            # the template hashes recorded by the kernel are checked along the way
+            parsed = StringIO.StringIO()
+            self.assertEqual(ima.process_measurement_list_bin(ml, m2w=parsed), pcr)
+            parsed = parsed.getvalue().splitlines()
+            self.assertEqual(parsed[:3], ['00'*20 + ' boot_aggregate',
+                                          '19f13b42c2745066347e76454788c0fe083643f3 /init',
+                                          'c90333979f56f38bbd41b81806015b0de502f3cc /bin/sh'])
+            self.assertEqual(parsed[-1], 'ff3094b907d15cee91b8eecb0559011d2d1c175a /bin/cp')
+            with open(ascii_path, 'r') as f:
+                lines = f.read().splitlines()
+            self.assertEqual(parsed, ["%s %s"%(line.split(None, 4)[3].split(':')[-1], line.split(None, 4)[4]) for line in lines])
+            self.assertEqual(ima.process_measurement_list(lines), pcr)
+        
+        # a violation, its template hash is zero and the PCR is extended with all ones
+        with open(BIN_ML_IMA_PATH, 'rb') as f:
+            violation = ima.split_entries(f.read(), True)[847]
+        self.assertEqual(violation[4:24], '\0'*20)
+        parsed = StringIO.StringIO()
+        self.assertEqual(ima.process_measurement_list_bin(violation, m2w=parsed), ima.hashlib.sha1(ima.START_HASH + '\xff'*20).hexdigest())
+        self.assertEqual(parsed.getvalue(), '00'*20 + ' /tmp/sh-thd-868147006\n')
+
+    def test_read_binary_measurement_list(self):
+        entries = [to_binary(line) for line in self.lines]
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, ''.join(entries))
+            self.assertEqual(ima.read_measurement_list(path, 400, True), (''.join(entries[400:]), 400))
+            self.assertEqual(ima.read_measurement_list(path, len(entries), True), ('', len(entries)))
+            self.assertEqual(ima.read_measurement_list(path, len(entries)+1, True), (''.join(entries), 0))
+        finally:
+            os.close(fd)
+            os.remove(path)
+
+    @unittest.skipIf(common.STUB_TPM, "IMA is not checked with a stub TPM")
+    def test_incremental_check(self):
+        state = ima.new_state()
+        self.assertTrue(self.check(self.ml, state))
+        self.assertVerified(state)
+
+        state = self.state_after(400, True)
+        self.assertTrue(self.check(''.join(self.lines[400:]), state))
+        self.assertVerified(state)
+        self.assertFalse(state['resync'])
+
+        # a tail that doesn't continue the verified prefix, e.g. after a reboot
+        state = self.state_after(400, True)
+        self.assertFalse(self.check(''.join(self.lines[401:]), state))
+        self.assertTrue(state['resync'])
+
+    @unittest.skipIf(common.STUB_TPM, "IMA is not checked with a stub TPM")
+    def test_verified_prefix(self):
+        # a full list that starts with the verified entries is checked from there on
+        state = self.state_after(400, False)
+        self.assertTrue(self.check(self.ml, state))
+        self.assertVerified(state)
+
+        # the memo is wrong but the list looks like it continues it, check all of it
+        state = self.state_after(400, False)
+        state['hash'] = ima.process_measurement_list(self.lines[:399])
+        self.assertTrue(self.check(self.ml, state))
+        self.assertVerified(state)
+
+        # the list doesn't start with the verified entries
+        state = self.state_after(400, False)
+        state['offset'] += 1
+        self.assertTrue(self.check(self.ml, state))
+        self.assertVerified(state)
+
+    @unittest.skipIf(common.STUB_TPM, "IMA is not checked with a stub TPM")
+    def test_check_in_pieces(self):
+        min_size = ima.config.get('cloud_verifier', 'ima_parallel_min_size')
+        ima.config.set('cloud_verifier', 'ima_parallel_min_size', '0')
+        try:
+            for n in [0, 400]:
+                state = self.state_after(n, False) if n > 0 else ima.new_state()
+                state['chunks'] = 7
+                self.assertFalse(self.check(self.ml, state))
+                pieces = state.pop('pieces')
+                self.assertEqual(pieces['offset'], len(''.join(self.lines[:n])))
+                self.assertEqual(''.join(pieces['pieces']), ''.join(self.lines[n:]))
+                
+                state['checked'] = {'offset': pieces['offset'], 'pieces': [ima.check_piece(piece, False, None) for piece in pieces['pieces']]}
+                self.assertTrue(self.check(self.ml, state))
+                self.assertVerified(state)
+            
+            # nothing is compared against the IMA PCR before the pieces are checked
+            tpm = PCRCheckTPM(need_hw_tpm=False)
+            state = ima.new_state()
+            state['chunks'] = 7
+            self.assertFalse(tpm.check_pcrs({}, ["PCR %d %s"%(common.IMA_PCR, '00'*20)], None, False, self.ml, None, state))
+            self.assertIn('pieces', state)
+            self.assertNotIn('failures', state)
+            # and the list isn't split if the other PCRs are bad
+            state = ima.new_state()
+            state['chunks'] = 7
+            pcrs = ["PCR %d %s"%(common.IMA_PCR, self.pcr), "PCR 0 %s"%('11'*20)]
+            self.assertFalse(tpm.check_pcrs({'0': ['00'*20]}, pcrs, None, False, self.ml, None, state))
+            self.assertNotIn('pieces', state)
+        finally:
+            ima.config.set('cloud_verifier', 'ima_parallel_min_size', min_size)
+
+    @unittest.skipIf(common.STUB_TPM, "IMA is not checked with a stub TPM")
+    def test_binary_check(self):
+        entries = [to_binary(line) for line in self.lines]
+        state = ima.new_state()
+        state['binary'] = True
+        self.assertTrue(self.check(''.join(entries), state))
+        self.assertEqual(state['entry'], len(entries))
+        self.assertEqual(state['hash'], self.pcr)
+        self.assertEqual(state['last'], entries[-1])
+
+        state = self.state_after(400, True)
+        state['binary'] = True
+        self.assertTrue(self.check(''.join(entries[400:]), state))
+        self.assertEqual(state['hash'], self.pcr)
+
+
+if __name__ == '__main__':
+    unittest.main()
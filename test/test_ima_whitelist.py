@@ -0,0 +1,143 @@
+import unittest
+import os
+import sys
+import pickle
+import re
+import tempfile
+
+# Useful constants for the test
+KEYLIME_DIR=os.getcwdu()+"/../keylime/"
+ML_PATH=os.getcwdu()+"/../scripts/ima/ascii_runtime_measurements"
+
+# Custom imports
+sys.path.insert(0, KEYLIME_DIR)
+import ima
+import ima_whitelist
+from ima_whitelist import CompiledWhitelist, ExcludeMatcher
+
+
+def whitelist_lines(ml_lines):
+    """Whitelist lines accepting everything in a measurement list."""
+    wl = []
+    for line in ml_lines:
+        tokens = line.split(None, 4)
+        wl.append("%s %s"%(tokens[3].split(':')[-1], tokens[4].strip()))
+    return wl
+
+
+class CompiledWhitelist_Test(unittest.TestCase):
+
+    def setUp(self):
+        with open(ML_PATH, 'r') as f:
+            self.ml_lines = f.readlines()
+        self.wl_lines = whitelist_lines(self.ml_lines) + ["%s /bin/sh"%('ab'*32), "%s /bin/sh"%('cd'*20)]
+        self.lists = ima.process_whitelists(self.wl_lines, [])
+
+    def test_lookup(self):
+        compiled = CompiledWhitelist.from_lines(iter(self.wl_lines))
+        whitelist = self.lists['whitelist']
+        self.assertEqual(len(compiled), len(whitelist))
+        for path, digests in whitelist.items():
+            self.assertEqual(sorted(compiled.get(path)), sorted(set(digests)))
+            self.assertIn(path, compiled)
+        self.assertEqual(len(compiled.get_digests('/bin/sh')[1]), 32)
+        self.assertIsNone(compiled.get('/not/there'))
+        self.assertNotIn('/not/there', compiled)
+        self.assertEqual(compiled.get(u'/bin/sh'), compiled.get('/bin/sh'))
+
+        # the same whitelist compiles to the same bytes however it comes in
+        self.assertEqual(CompiledWhitelist.from_dict(whitelist).buf, compiled.buf)
+        self.assertEqual(CompiledWhitelist.from_dict(compiled.to_dict()).buf, compiled.buf)
+
+    def test_empty(self):
+        compiled = CompiledWhitelist.from_dict({})
+        self.assertEqual(len(compiled), 0)
+        self.assertIsNone(compiled.get('boot_aggregate'))
+
+    def test_save_load(self):
+        compiled = CompiledWhitelist.from_dict(self.lists['whitelist'])
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            compiled.save(path)
+            for use_mmap in [True, False]:
+                loaded = CompiledWhitelist.load(path, use_mmap)
+                self.assertEqual(loaded.get_stats()['mmap'], use_mmap)
+                self.assertEqual(loaded.to_dict(), compiled.to_dict())
+                self.assertEqual(pickle.loads(pickle.dumps(loaded, 2)).buf, compiled.buf)
+        finally:
+            os.remove(path)
+
+    def test_process_measurement_list(self):
+        compiled = ima.compile_whitelists(self.lists)
+        pcr = ima.process_measurement_list(self.ml_lines, self.lists)
+        self.assertIsNotNone(pcr)
+        self.assertEqual(ima.process_measurement_list(self.ml_lines, compiled), pcr)
+
+        # one file missing, one with a different hash
+        lists = ima.process_whitelists(self.wl_lines[2:], [])
+        lists['whitelist']['/init'] = ['00'*20]
+        self.assertIsNone(ima.process_measurement_list(self.ml_lines, ima.compile_whitelists(lists)))
+
+    def test_stats(self):
+        stats = CompiledWhitelist.from_dict(self.lists['whitelist']).get_stats()
+        self.assertEqual(stats['paths'], len(self.lists['whitelist']))
+        self.assertEqual(stats['digests'], sum([len(set(d)) for d in self.lists['whitelist'].values()]))
+        self.assertLess(stats['bytes_per_entry'], 100)
+
+
+class ExcludeMatcher_Test(unittest.TestCase):
+
+    PATTERNS = [
+        "/var/log/wtmp",
+        "/sys/fs/.*",
+        "/tmp/.*",
+        "/tmp/x/.*",
+        "/home/.*/\\.cache/.*",
+        "/usr/.*\\.pyc$",
+        "/usr/lib/python2.7/.*/test/.*",
+        "/opt/[a-f0-9]+\\.log",
+        "/etc/(passwd|shadow)$",
+        "/dev/.*|/proc/.*",
+        ".*\\.swp$",
+        "boot_aggregate",
+    ]
+    PATHS = [
+        "/var/log/wtmp", "/var/log/wtmp.1", "/var/log/wtm", "/sys/fs/cgroup", "/sys/f",
+        "/tmp/a", "/tmp", "/home/u/.cache/f", "/home/u/xcache/f", "/home/.cache",
+        "/usr/lib/a.pyc", "/usr/lib/a.pyc.bak", "/usr/.pyc", "/usr/lib/python2.7/x/test/y",
+        "/opt/ab12.log", "/opt/xyz.log", "/etc/passwd", "/etc/passwd-", "/etc/shadow",
+        "/dev/null", "/proc/1/exe", "/root/.a.swp", "boot_aggregate", "/bin/sh", "",
+    ]
+
+    def assertMatchesRegex(self, patterns, paths):
+        combined = re.compile("(?:" + ")|(?:".join(patterns) + ")")
+        matcher = ExcludeMatcher(patterns)
+        for path in paths:
+            self.assertEqual(matcher.match(path), combined.match(path) is not None, path)
+        return matcher
+
+    def test_match(self):
+        # past the size that is just one regex
+        padding = ["/srv/dir%d/.*"%i for i in range(ima_whitelist.SMALL_EXCLUDE_LIST)]
+        matcher = self.assertMatchesRegex(self.PATTERNS + padding, self.PATHS + ["/srv/dir3/a", "/srv/dir"])
+        self.assertIsNone(matcher.small)
+        self.assertIsNotNone(self.assertMatchesRegex(self.PATTERNS[:4], self.PATHS).small)
+        self.assertFalse(ExcludeMatcher([]).match("/bin/sh"))
+
+    def test_many_patterns(self):
+        # more groups than python allows in one regex when capturing
+        patterns = ["/usr/dir%d/[a-z]+\\.so%d"%(i, i) for i in range(300)] + ["/usr/.*/x%d\\.tmp$"%i for i in range(300)]
+        paths = ["/usr/dir%d/abc.so%d"%(i, i) for i in range(0, 300, 7)] + ["/usr/dir1/abc.so2", "/usr/a/x5.tmp", "/usr/a/x5.tmpx"]
+        self.assertMatchesRegex(patterns, paths)
+
+    def test_pickle(self):
+        matcher = ExcludeMatcher(self.PATTERNS * 2)
+        loaded = pickle.loads(pickle.dumps(matcher, 2))
+        self.assertEqual(loaded.patterns, matcher.patterns)
+        for path in self.PATHS:
+            self.assertEqual(loaded.match(path), matcher.match(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
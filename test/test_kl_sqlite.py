@@ -1,6 +1,7 @@
 import unittest
 import sys
 import os
+import threading
 
 # Useful constants for the test
 KEYLIME_DIR=os.getcwdu()+"/../keylime/"
@@ -9,6 +10,11 @@ KEYLIME_DIR=os.getcwdu()+"/../keylime/"
 sys.path.insert(0, KEYLIME_DIR)
 from keylime_sqlite import *
 
+def remove_db(db_filename):
+    for name in [db_filename,db_filename+'-wal',db_filename+'-shm']:
+        if os.path.exists(name):
+            os.remove(name)
+
 class Sqlite_Test(unittest.TestCase):
  
     def test_sql(self):
@@ -22,9 +28,7 @@ class Sqlite_Test(unittest.TestCase):
             
         # testing
         db_filename = 'testdata.sqlite'
-        
-        if os.path.exists(db_filename):
-            os.remove(db_filename)
+        remove_db(db_filename)
             
         # in the form key, SQL type
         cols_db = {
@@ -114,6 +118,13 @@ class Sqlite_Test(unittest.TestCase):
         
         # test remove nothing
         self.assertEqual(db.remove_agent('209483'), False)
+        
+        # a failed check undoes the insert
+        def gone():
+            raise Exception("gone")
+        with self.assertRaises(Exception):
+            db.add_agent('209483',json_body,gone)
+        self.assertEqual(db.get_agent_ids(),[])
 
         # test get multiple ids
         db.add_agent('209483',json_body)
@@ -138,6 +149,29 @@ class Sqlite_Test(unittest.TestCase):
             
         # test count
         self.assertEqual(db.count_agents(), 2)
+        self.assertEqual(db.count_agents('operational_state', 2), 2)
+        self.assertEqual(db.count_agents('operational_state', 3), 0)
+        
+        # test update by column
+        self.assertEqual(db.update_agents({'v':'UPDATED','metadata':{'m':'1'}}, 'agent_id', '2094aqrea3', 'port'), 1)
+        self.assertEqual(db.get_agent('2094aqrea3')['v'], 'UPDATED')
+        self.assertEqual(db.get_agent('2094aqrea3')['metadata'], {'m':'1'})
+        self.assertEqual(db.get_agent(209483)['v'], 'OVERWRITTENVVVV')
+        self.assertEqual(db.update_agents({'v':'x'}, 'operational_state', 3), 0)
+        self.assertEqual(db.get_agent_ids('v', 'UPDATED'), ['2094aqrea3'])
+        with self.assertRaises(Exception):
+            db.update_agents({'vv':'x'}, 'agent_id', '209483')
+        
+        # a failed check undoes the update
+        with self.assertRaises(Exception):
+            db.update_agents({'v':'x'}, 'agent_id', '2094aqrea3', None, gone)
+        self.assertEqual(db.get_agent('2094aqrea3')['v'], 'UPDATED')
+        
+        # test removing something only while no agent refers to it
+        removed = []
+        self.assertEqual(db.remove_unreferenced('v', 'UPDATED', lambda: removed.append(1)), 1)
+        self.assertEqual(db.remove_unreferenced('v', 'other', lambda: removed.append(2)), 0)
+        self.assertEqual(removed, [2])
         
         # test print
         db.print_db()
@@ -148,5 +182,100 @@ class Sqlite_Test(unittest.TestCase):
         self.assertEqual(db.get_agent(209483)['vtpm_policy'], '{"abv":"2"}')
         self.assertEqual(db.get_agent('2094aqrea3')['vtpm_policy'], '{"abv":"2"}')
 
+    def test_migrate(self):
+        db_filename = 'testdata_migrate.sqlite'
+        remove_db(db_filename)
+
+        # a version 0 database, no primary key so agent_id could be duplicated
+        with sqlite3.connect(db_filename) as conn:
+            cur = conn.cursor()
+            cur.execute("CREATE TABLE main(agent_id TEXT PRIMARY_KEY, operational_state INT, v TEXT)")
+            cur.execute("INSERT INTO main VALUES('a1',3,'old')")
+            cur.execute("INSERT INTO main VALUES('a2',3,'v2')")
+            cur.execute("INSERT INTO main VALUES('a1',4,'new')")
+            conn.commit()
+
+        cols_db = {
+            'agent_id': 'TEXT PRIMARY KEY',
+            'operational_state': 'INT',
+            'v': 'TEXT',
+            'metadata': 'TEXT',
+            }
+        db = KeylimeDB(db_filename,cols_db,['metadata'],{},index_cols=['operational_state'])
+
+        self.assertEqual(sorted(db.get_agent_ids()),['a1','a2'])
+        got = db.get_agent('a1')
+        self.assertEqual(got['v'],'new')
+        self.assertEqual(got['operational_state'],4)
+        self.assertEqual(got['metadata'],None)
+
+        # the primary key is enforced now
+        self.assertEqual(db.add_agent('a1',{'operational_state':0,'v':'x','metadata':{}}),None)
+
+        with sqlite3.connect(db_filename) as conn:
+            cur = conn.cursor()
+            cur.execute("PRAGMA user_version")
+            self.assertEqual(cur.fetchone()[0],SCHEMA_VERSION)
+            cur.execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='main'")
+            self.assertIn('main_operational_state',[row[0] for row in cur.fetchall()])
+
+        db.close()
+
+        # opening it again is a no-op
+        db = KeylimeDB(db_filename,cols_db,['metadata'],{},index_cols=['operational_state'])
+        self.assertEqual(db.count_agents(),2)
+        db.close()
+        remove_db(db_filename)
+
+    def test_queued_writes(self):
+        db_filename = 'testdata_queue.sqlite'
+        remove_db(db_filename)
+
+        cols_db = {
+            'agent_id': 'TEXT PRIMARY KEY',
+            'operational_state': 'INT',
+            'metadata': 'TEXT',
+            }
+        db = KeylimeDB(db_filename,cols_db,['metadata'],{'nonce':''})
+        agent = db.add_agent('a1',{'operational_state':0,'metadata':{}})
+
+        with sqlite3.connect(db_filename) as conn:
+            self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0],'wal')
+
+        agent['operational_state'] = 3
+        self.assertTrue(db.queue_overwrite('a1',agent))
+        agent['metadata'] = {'cert_serial':'2'}
+        self.assertFalse(db.queue_overwrite('a1',agent))
+
+        # readers see the queued write before it reaches the disk
+        self.assertEqual(db.get_agent('a1')['operational_state'],3)
+        with sqlite3.connect(db_filename) as conn:
+            self.assertEqual(conn.execute("SELECT operational_state FROM main").fetchone()[0],0)
+
+        self.assertEqual(db.flush(),1)
+        self.assertEqual(db.flush(),0)
+        with sqlite3.connect(db_filename) as conn:
+            self.assertEqual(conn.execute("SELECT operational_state,metadata FROM main").fetchone(),(3,'{"cert_serial": "2"}'))
+
+        # direct writes go after anything queued
+        db.queue_overwrite('a1',agent)
+        db.update_agent('a1','operational_state',5)
+        self.assertEqual(db.get_agent('a1')['operational_state'],5)
+
+        # a removed agent does not come back on flush
+        db.queue_overwrite('a1',agent)
+        db.remove_agent('a1')
+        db.flush()
+        self.assertEqual(db.get_agent('a1'),None)
+
+        # each thread gets its own connection
+        conns = []
+        t = threading.Thread(target=lambda: conns.append(db.connection()))
+        t.start()
+        t.join()
+        self.assertNotEqual(conns[0],db.connection())
+        db.close()
+        remove_db(db_filename)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,96 @@
+import unittest
+import os
+import sys
+import time
+
+# Useful constants for the test
+KEYLIME_DIR=os.getcwdu()+"/../keylime/"
+
+# Custom imports
+sys.path.insert(0, KEYLIME_DIR)
+import tornado.ioloop
+from poll_scheduler import PollScheduler
+
+
+class PollScheduler_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = tornado.ioloop.IOLoop()
+        self.fired = []
+
+    def tearDown(self):
+        self.scheduler.stop()
+        self.io_loop.close()
+
+    def make(self, max_in_flight=100, jitter=0.1):
+        self.scheduler = PollScheduler(0.1, max_in_flight, jitter, io_loop=self.io_loop)
+        return self.scheduler
+
+    def poll(self, key):
+        return lambda: self.fired.append(key)
+
+    def test_timer_wheel(self):
+        scheduler = self.make()
+        now = time.time()
+        # these land on every level of the wheel
+        delays = {'a': 0, 'b': 0.55, 'c': 7.05, 'd': 500.05, 'e': 30000.05}
+        for key, delay in delays.items():
+            scheduler.schedule(key, delay, self.poll(key))
+
+        for key in sorted(delays, key=delays.get):
+            scheduler.advance(now + delays[key] - 0.2)
+            self.assertNotIn(key, self.fired)
+            scheduler.advance(now + delays[key] + 0.1)
+            self.assertEqual(self.fired[-1], key)
+            scheduler.complete(key)
+        self.assertEqual(self.fired, ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(scheduler.get_schedule()['scheduled'], 0)
+
+    def test_budget(self):
+        scheduler = self.make(max_in_flight=2)
+        for key in ['a', 'b', 'c', 'd']:
+            scheduler.schedule(key, 0, self.poll(key))
+        scheduler.advance(time.time() + 0.2)
+        self.assertEqual(self.fired, ['a', 'b'])
+
+        schedule = scheduler.get_schedule()
+        self.assertEqual(schedule['in_flight'], 2)
+        self.assertEqual(schedule['backlog'], 2)
+
+        scheduler.complete('a')
+        self.assertEqual(self.fired, ['a', 'b', 'c'])
+        # a cancelled poll gives up its place in the backlog
+        scheduler.cancel('d')
+        scheduler.complete('b')
+        self.assertEqual(self.fired, ['a', 'b', 'c'])
+        self.assertEqual(scheduler.get_schedule()['in_flight'], 1)
+
+    def test_reschedule_and_cancel(self):
+        scheduler = self.make()
+        scheduler.schedule('a', 1, self.poll('a1'))
+        scheduler.schedule('a', 2, self.poll('a2'))
+        scheduler.schedule('b', 1, self.poll('b'))
+        scheduler.cancel('b')
+        scheduler.advance(time.time() + 3)
+        self.assertEqual(self.fired, ['a2'])
+
+    def test_spread(self):
+        scheduler = self.make(jitter=0.1)
+        for i in range(200):
+            scheduler.schedule_poll(i, 10, self.poll(i))
+        dues = [e['due_in'] for e in scheduler.get_schedule(limit=200)['next_due']]
+        self.assertEqual(len(dues), 200)
+        self.assertTrue(min(dues) >= 0 and max(dues) <= 10)
+        # spread over the interval, not bunched up
+        self.assertTrue(len([d for d in dues if d < 5]) > 50)
+        self.assertTrue(len([d for d in dues if d >= 5]) > 50)
+
+        # after the first poll they are an interval apart, give or take the jitter
+        scheduler.schedule_poll(0, 10, self.poll(0))
+        due = scheduler.get_schedule(limit=200)['next_due']
+        due_in = [e['due_in'] for e in due if e['agent_id'] == 0][0]
+        self.assertTrue(8.9 <= due_in <= 11)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import unittest
+import os
+import sys
+
+# Useful constants for the test
+KEYLIME_DIR=os.getcwdu()+"/../keylime/"
+
+# Custom imports
+sys.path.insert(0, KEYLIME_DIR)
+import tornado.ioloop
+from tornado.concurrent import Future
+import quote_batch
+from quote_batch import QuoteBatcher
+
+
+class Merkle_Test(unittest.TestCase):
+
+    def test_proofs(self):
+        for count in range(1, 12):
+            nonces = ["nonce%d"%i for i in range(count)]
+            root, proofs = quote_batch.merkle_tree(nonces)
+            self.assertEqual(len(root), 32)
+            for nonce, proof in zip(nonces, proofs):
+                self.assertTrue(len(proof) <= count.bit_length())
+                self.assertEqual(quote_batch.root_from_proof(nonce, quote_batch.encode_proof(proof)), root)
+                self.assertNotEqual(quote_batch.root_from_proof(nonce + "x", quote_batch.encode_proof(proof)), root)
+            # every nonce is part of the root
+            self.assertNotEqual(quote_batch.merkle_tree(nonces[:-1] + ["other"])[0], root)
+
+    def test_wrong_proof(self):
+        nonces = ["a", "b", "c", "d", "e"]
+        root, proofs = quote_batch.merkle_tree(nonces)
+        # another nonce's proof or a changed order don't lead to the root
+        self.assertNotEqual(quote_batch.root_from_proof("a", quote_batch.encode_proof(proofs[1])), root)
+        swapped = [(not left, sibling) for left, sibling in proofs[0]]
+        self.assertNotEqual(quote_batch.root_from_proof("a", quote_batch.encode_proof(swapped)), root)
+        # an inner node isn't a nonce
+        self.assertNotEqual(quote_batch.merkle_tree([quote_batch.node_hash(quote_batch.leaf_hash("a"), quote_batch.leaf_hash("b")), "c"])[0],
+                            quote_batch.merkle_tree(["a", "b", "c"])[0])
+
+    def test_malformed_proof(self):
+        for encoded in ["x"+"00"*32, "l"+"00"*31, "l"+"zz"*32, ",".join(["l"+"00"*32]*(quote_batch.MAX_PROOF_LENGTH+1))]:
+            with self.assertRaises(Exception):
+                quote_batch.root_from_proof("a", encoded)
+
+
+class QuoteBatcher_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = tornado.ioloop.IOLoop()
+        self.batches = []
+
+    def tearDown(self):
+        self.io_loop.close()
+
+    def run_batch(self, key, nonce, args):
+        self.batches.append((key, nonce, args))
+        done = Future()
+        self.io_loop.add_callback(done.set_result, ["%s %s"%(nonce.encode('hex'), arg) for arg in args])
+        return done
+
+    def results(self, futures):
+        return self.io_loop.run_sync(lambda: futures, timeout=30)
+
+    def test_batch(self):
+        batcher = QuoteBatcher(0.05, 16, self.run_batch, self.io_loop)
+        futures = [batcher.request('integrity', "nonce%d"%i, i) for i in range(5)]
+        futures.append(batcher.request('identity', "nonce9", 9))
+        results = self.results(futures)
+
+        # one quote for each key
+        self.assertEqual(len(self.batches), 2)
+        key, root, args = self.batches[0]
+        self.assertEqual((key, args), ('integrity', range(5)))
+        for i, (result, proof) in enumerate(results[:5]):
+            self.assertEqual(result, "%s %d"%(root.encode('hex'), i))
+            self.assertEqual(quote_batch.root_from_proof("nonce%d"%i, proof), root)
+        # alone in its batch, quoted over its own nonce
+        self.assertEqual(self.batches[1][1], "nonce9")
+        self.assertIsNone(results[5][1])
+
+        stats = batcher.get_stats()
+        self.assertEqual(stats['batches'], 2)
+        self.assertEqual(stats['max_batch_size'], 5)
+
+    def test_max_batch(self):
+        batcher = QuoteBatcher(60, 3, self.run_batch, self.io_loop)
+        results = self.results([batcher.request('integrity', "nonce%d"%i, i) for i in range(3)])
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual(len([proof for _, proof in results if proof is not None]), 3)
+
+    def test_no_window(self):
+        batcher = QuoteBatcher(0, 16, self.run_batch, self.io_loop)
+        results = self.results([batcher.request('integrity', "nonce%d"%i, i) for i in range(3)])
+        self.assertEqual([nonce for _, nonce, _ in self.batches], ["nonce0", "nonce1", "nonce2"])
+        self.assertEqual([proof for _, proof in results], [None]*3)
+
+    def test_failure(self):
+        def refuse(key, nonce, args):
+            raise Exception("busy")
+        batcher = QuoteBatcher(0.01, 16, refuse, self.io_loop)
+        futures = [batcher.request('integrity', "nonce%d"%i, i) for i in range(2)]
+        for future in futures:
+            with self.assertRaisesRegexp(Exception, "busy"):
+                self.results(future)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import sys
+import os
+
+from tornado import httpclient
+from tornado.concurrent import Future
+
+# Useful constants for the test
+KEYLIME_DIR=os.getcwdu()+"/../keylime/"
+
+# Custom imports
+sys.path.insert(0, KEYLIME_DIR)
+import registrar_client
+
+
+class KeyCache_Test(unittest.TestCase):
+
+    def test_max_uses(self):
+        cache = registrar_client.KeyCache(600,max_uses=2)
+        self.assertEqual(cache.get('a1'),None)
+        cache.put('a1',{'aik':'key'})
+        self.assertEqual(cache.get('a1'),{'aik':'key'})
+        self.assertEqual(cache.get('a1'),{'aik':'key'})
+        self.assertEqual(cache.get('a1'),None)
+
+    def test_ttl(self):
+        cache = registrar_client.KeyCache(600)
+        cache.put('a1',{'aik':'key'})
+        cache.entries['a1'][1] -= 601
+        self.assertEqual(cache.get('a1'),None)
+
+        cache.put('a1',{'aik':'key'})
+        cache.invalidate('a1')
+        self.assertEqual(cache.get('a1'),None)
+
+    def test_get_async(self):
+        cache = registrar_client.KeyCache(600)
+        fetches = []
+        def fetch(agent_id):
+            fetches.append(Future())
+            return fetches[-1]
+
+        # concurrent misses share a fetch
+        f1 = cache.get_async('a1',fetch)
+        f2 = cache.get_async('a1',fetch)
+        self.assertIs(f1,f2)
+        self.assertEqual(len(fetches),1)
+
+        fetches[0].set_result({'aik':'key'})
+        self.assertEqual(f1.result(),{'aik':'key'})
+
+        # then it is served from the cache
+        f3 = cache.get_async('a1',fetch)
+        self.assertTrue(f3.done())
+        self.assertEqual(f3.result(),{'aik':'key'})
+        self.assertEqual(len(fetches),1)
+
+        # failed lookups are not cached
+        f4 = cache.get_async('a2',fetch)
+        fetches[1].set_result(None)
+        self.assertEqual(f4.result(),None)
+        cache.get_async('a2',fetch)
+        self.assertEqual(len(fetches),3)
+
+    def test_async_client(self):
+        client = registrar_client.get_async_client(3)
+        try:
+            self.assertIs(registrar_client.get_async_client(3),client)
+            self.assertIsNot(client,httpclient.AsyncHTTPClient())
+            self.assertEqual(client.max_clients,3)
+        finally:
+            client.close()
+            registrar_client.async_client = None
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+import os
+import sys
+import base64
+import json
+
+# Useful constants for the test
+KEYLIME_DIR=os.getcwdu()+"/../keylime/"
+TPM1_DATA_DIR=os.getcwdu()+"/../test-data/tpm1.2/"
+
+# Custom imports
+sys.path.insert(0, KEYLIME_DIR)
+import tpm1_quote
+
+
+def read_canned(name):
+    with open(TPM1_DATA_DIR+name, 'rb') as f:
+        return json.loads('{' + f.read().rstrip(',\r\n') + '}')
+
+def get_fileout(entry):
+    return base64.b64decode(entry['fileout']).decode('zlib')
+
+
+class TPM1Quote_Test(unittest.TestCase):
+
+    def test_check_quote(self):
+        canned = read_canned("emulator-inputs.txt")
+        aik = "".join(canned['identity']['retout'])
+        quote = get_fileout(canned['tpmquote'])
+        nonce = str(canned['tpmquote']['nonce'])
+
+        pcrs = tpm1_quote.check_quote(nonce, aik, quote)
+        self.assertEqual(len(pcrs), 3)
+        self.assertEqual(pcrs[0], "PCR 15 %s\n"%('00'*20))
+        self.assertTrue(pcrs[1].startswith("PCR 16 "))
+        self.assertEqual(pcrs[2], "PCR 22 %s\n"%('ff'*20))
+
+    def test_bad_nonce(self):
+        canned = read_canned("emulator-inputs.txt")
+        aik = "".join(canned['identity']['retout'])
+        quote = get_fileout(canned['tpmquote'])
+        self.assertIsNone(tpm1_quote.check_quote("x"*20, aik, quote))
+
+    def test_bad_pcr(self):
+        canned = read_canned("emulator-inputs.txt")
+        aik = "".join(canned['identity']['retout'])
+        quote = get_fileout(canned['tpmquote'])
+        quote = quote[:-1] + chr(ord(quote[-1]) ^ 1)
+        self.assertIsNone(tpm1_quote.check_quote(str(canned['tpmquote']['nonce']), aik, quote))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+import os
+import sys
+import base64
+import json
+
+# Useful constants for the test
+KEYLIME_DIR=os.getcwdu()+"/../keylime/"
+TPM2_DATA_DIR=os.getcwdu()+"/../test-data/tpm2/"
+
+# Custom imports
+sys.path.insert(0, KEYLIME_DIR)
+import tpm2_quote
+
+
+def read_file(name):
+    with open(TPM2_DATA_DIR+"files/"+name, 'rb') as f:
+        return f.read()
+
+def read_canned():
+    with open(TPM2_DATA_DIR+"emulator-inputs.txt", 'rb') as f:
+        return json.loads('{' + f.read().rstrip(',\r\n') + '}')
+
+
+class TPM2Quote_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.quote = read_file("quote.out")
+        self.sig = read_file("quotesig.out")
+        self.pcrs = read_file("quotepcr.out")
+        self.aik = read_file("akpub.pem")
+        self.nonce = tpm2_quote.parse_attest(self.quote)['extra_data']
+
+    def test_parse_attest(self):
+        attest = tpm2_quote.parse_attest(self.quote)
+        self.assertEqual(len(attest['extra_data']), 20)
+        self.assertEqual(attest['selections'], [(0x000B, [15, 16, 22])])
+        self.assertEqual(len(attest['pcr_digest']), 32)
+
+    def test_check_quote(self):
+        pcrs = tpm2_quote.check_quote(self.nonce, self.aik, self.quote, self.sig, self.pcrs, 'sha256')
+        self.assertEqual(sorted(pcrs['sha256'].keys()), [15, 16, 22])
+        self.assertEqual(pcrs['sha256'][15], '00'*32)
+        self.assertEqual(pcrs['sha256'][22], 'ff'*32)
+
+    def test_bad_nonce(self):
+        self.assertIsNone(tpm2_quote.check_quote('x'*20, self.aik, self.quote, self.sig, self.pcrs, 'sha256'))
+
+    def test_bad_signature(self):
+        sig = self.sig[:-1] + chr(ord(self.sig[-1]) ^ 1)
+        self.assertIsNone(tpm2_quote.check_quote(self.nonce, self.aik, self.quote, sig, self.pcrs, 'sha256'))
+
+    def test_bad_pcr_value(self):
+        # flip a bit in the first PCR value
+        offset = tpm2_quote.TPML_PCR_SELECTION_SIZE + 4 + 4 + 2
+        pcrs = self.pcrs[:offset] + chr(ord(self.pcrs[offset]) ^ 1) + self.pcrs[offset+1:]
+        self.assertIsNone(tpm2_quote.check_quote(self.nonce, self.aik, self.quote, self.sig, pcrs, 'sha256'))
+
+    def test_canned_quote(self):
+        canned = read_canned()
+        quote = canned['tpm2_deluxequote']
+        fileouts = quote['fileout']
+        aik = base64.b64decode(canned['tpm2_createak']['fileout'].values()[0]).decode('zlib')
+        pcrs = tpm2_quote.check_quote(str(quote['nonce']), aik,
+                                      base64.b64decode(fileouts['file://quoteMessage']).decode('zlib'),
+                                      base64.b64decode(fileouts['file://quoteSignature']).decode('zlib'),
+                                      base64.b64decode(fileouts['file://quotePCR']).decode('zlib'),
+                                      'sha256')
+        self.assertEqual(pcrs, {'sha256': {15: '00'*32, 22: 'ff'*32}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+import os
+import sys
+import threading
+
+# Useful constants for the test
+KEYLIME_DIR=os.getcwdu()+"/../keylime/"
+
+# Custom imports
+sys.path.insert(0, KEYLIME_DIR)
+import tornado.ioloop
+import tpm_executor
+from tpm_executor import TPMExecutor, INTEGRITY, IDENTITY, KEYS
+
+
+def square(x):
+    return x*x
+
+def explode(x):
+    raise Exception("boom %d"%x)
+
+
+class TPMExecutor_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = tornado.ioloop.IOLoop()
+        self.executors = []
+
+    def tearDown(self):
+        for executor in self.executors:
+            executor.shutdown()
+        self.io_loop.close()
+
+    def executor(self, num_workers, max_queue):
+        executor = TPMExecutor(num_workers, max_queue, self.io_loop)
+        self.executors.append(executor)
+        return executor
+
+    def result(self, future):
+        return self.io_loop.run_sync(lambda: future, timeout=30)
+
+    def test_submit(self):
+        executor = self.executor(2, [10, 10, None])
+        futures = [executor.submit(INTEGRITY, square, i) for i in range(5)]
+        self.assertEqual([self.result(f) for f in futures], [0,1,4,9,16])
+        with self.assertRaisesRegexp(Exception, "boom 3"):
+            self.result(executor.submit(KEYS, explode, 3))
+
+        stats = executor.get_stats()
+        self.assertEqual(stats['classes']['integrity']['completed'], 5)
+        self.assertEqual(stats['classes']['keys']['failed'], 1)
+        self.assertEqual(stats['queue_depth'], 0)
+
+    def test_queue_full(self):
+        executor = self.executor(1, [2, 1, None])
+        release = threading.Event()
+        futures = [executor.try_submit(INTEGRITY, release.wait, 30) for _ in range(2)]
+        with self.assertRaises(tpm_executor.QueueFull):
+            executor.try_submit(INTEGRITY, square, 2)
+        # the other classes have their own limits
+        futures.append(executor.try_submit(IDENTITY, square, 3))
+        with self.assertRaises(tpm_executor.QueueFull):
+            executor.try_submit(IDENTITY, square, 3)
+        self.assertEqual(executor.get_stats()['classes']['integrity']['rejected'], 1)
+
+        # submit() always takes the job
+        futures.append(executor.submit(INTEGRITY, square, 2))
+        self.assertEqual(executor.queue_depth(INTEGRITY), 3)
+        release.set()
+        self.assertEqual(self.result(futures[-1]), 4)
+        self.assertEqual(self.result(futures[-2]), 9)
+        self.assertEqual(executor.queue_depth(), 0)
+        self.assertEqual(self.result(executor.try_submit(INTEGRITY, square, 3)), 9)
+        self.assertEqual(executor.get_stats()['classes']['integrity']['max_queue_depth'], 3)
+
+    def test_priority(self):
+        executor = self.executor(1, [None, None, None])
+        release = threading.Event()
+        order = []
+        blocker = executor.submit(KEYS, release.wait, 30)
+        futures = [executor.submit(job_class, order.append, name) for job_class, name in
+                   [(KEYS, 'k1'), (IDENTITY, 'id1'), (INTEGRITY, 'in1'), (IDENTITY, 'id2'), (INTEGRITY, 'in2')]]
+        # one job running, the rest of them ahead of another identity quote
+        self.assertEqual(executor.queue_depth(), 6)
+        release.set()
+        for f in [blocker] + futures:
+            self.result(f)
+        self.assertEqual(order, ['in1', 'in2', 'id1', 'id2', 'k1'])
+
+        stats = executor.get_stats()['classes']
+        self.assertGreater(stats['keys']['max_wait'], stats['integrity']['max_wait'])
+        self.assertGreater(executor.get_stats()['avg_exec_time'], 0.0)
+        self.assertEqual(executor.wait_estimate(IDENTITY), 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+import os
+import sys
+import tempfile
+import time
+
+# Useful constants for the test
+KEYLIME_DIR=os.getcwdu()+"/../keylime/"
+
+# Custom imports
+sys.path.insert(0, KEYLIME_DIR)
+import tornado.ioloop
+from verification_executor import VerificationExecutor
+
+
+def square(x):
+    return x*x
+
+def explode(x):
+    raise Exception("boom %d"%x)
+
+def die(x):
+    os._exit(1)
+
+def die_once(path):
+    if not os.path.exists(path):
+        open(path,'w').close()
+        os._exit(1)
+    return "retried"
+
+
+class VerificationExecutor_Test(unittest.TestCase):
+
+    def run_jobs(self, num_workers, func, args):
+        io_loop = tornado.ioloop.IOLoop()
+        executor = VerificationExecutor(num_workers, io_loop)
+        futures = [executor.submit(func, a) for a in args]
+        results = []
+        try:
+            for f in futures:
+                results.append(io_loop.run_sync(lambda: f, timeout=30))
+        finally:
+            executor.shutdown()
+            io_loop.close()
+        return executor, results
+
+    def test_inline(self):
+        executor, results = self.run_jobs(0, square, range(5))
+        self.assertEqual(results, [0,1,4,9,16])
+        self.assertEqual(executor.get_stats()['completed'], 5)
+        self.assertEqual(executor.get_stats()['queue_depth'], 0)
+
+    def test_pool(self):
+        executor, results = self.run_jobs(2, square, range(10))
+        self.assertEqual(results, [x*x for x in range(10)])
+        stats = executor.get_stats()
+        self.assertEqual(stats['submitted'], 10)
+        self.assertEqual(stats['completed'], 10)
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertTrue(stats['max_queue_depth'] >= 1)
+
+    def test_failure(self):
+        with self.assertRaises(Exception):
+            self.run_jobs(1, explode, [1])
+
+    def test_worker_died(self):
+        io_loop = tornado.ioloop.IOLoop()
+        executor = VerificationExecutor(1, io_loop, watchdog_interval=0.1)
+        try:
+            lost = executor.submit(die, 1)
+            with self.assertRaisesRegexp(Exception, "worker died"):
+                io_loop.run_sync(lambda: lost, timeout=30)
+            # it was run again before giving up
+            self.assertEqual(executor.get_stats()['retried'], 1)
+            self.assertEqual(executor.get_stats()['failed'], 1)
+            self.assertEqual(executor.get_stats()['queue_depth'], 0)
+            # the replacement worker takes new jobs
+            self.assertEqual(io_loop.run_sync(lambda: executor.submit(square, 3), timeout=30), 9)
+        finally:
+            executor.shutdown()
+            io_loop.close()
+
+    def test_lost_job_retried(self):
+        io_loop = tornado.ioloop.IOLoop()
+        executor = VerificationExecutor(2, io_loop, watchdog_interval=0.1)
+        path = os.path.join(tempfile.mkdtemp(), "died")
+        try:
+            others = [executor.submit(square, x) for x in range(4)]
+            lost = executor.submit(die_once, path)
+            self.assertEqual(io_loop.run_sync(lambda: lost, timeout=30), "retried")
+            # only the lost job is run again, the others aren't affected
+            self.assertEqual([io_loop.run_sync(lambda: f, timeout=30) for f in others], [0,1,4,9])
+            self.assertEqual(executor.get_stats()['retried'], 1)
+            self.assertEqual(executor.get_stats()['failed'], 0)
+        finally:
+            executor.shutdown()
+            io_loop.close()
+            os.remove(path)
+            os.rmdir(os.path.dirname(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+
+# Useful constants for the test
+KEYLIME_DIR=os.getcwdu()+"/../keylime/"
+
+# Custom imports
+sys.path.insert(0, KEYLIME_DIR)
+import ima
+from whitelist_store import WhitelistStore
+
+
+def make_lists(n):
+    return ima.process_whitelists(["%s /bin/f%d"%(('%02x'%i)*20, i) for i in range(n)], ["/tmp/.*"])
+
+
+class WhitelistStore_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = WhitelistStore(self.dir, 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_add(self):
+        lists = make_lists(10)
+        digest = self.store.add(lists)
+        self.assertEqual(digest, ima.whitelist_version(lists))
+        self.assertTrue(self.store.exists(digest))
+        self.assertEqual(self.store.add(lists, digest), digest)
+        self.assertEqual(self.store.digests(), [digest])
+        self.assertEqual(ima.whitelist_version(ima.json.loads(self.store.read(digest))), digest)
+        # 10 files and boot_aggregate
+        self.assertEqual(self.store.count_paths(digest), 11)
+
+        with self.assertRaisesRegexp(Exception, 'whitelist digest is'):
+            self.store.add(make_lists(3), digest)
+        with self.assertRaises(Exception):
+            self.store.add({'whitelist': []})
+        self.assertFalse(self.store.exists('../../etc/passwd'))
+        self.assertIsNone(self.store.read('00'*20))
+
+        # another process sees it too
+        other = WhitelistStore(self.dir, 2)
+        compiled = other.acquire(digest)
+        self.assertEqual(compiled['whitelist'].get('/bin/f3'), ['03'*20])
+        self.assertTrue(compiled['exclude'].match('/tmp/x'))
+        self.assertFalse(compiled['exclude'].match('/bin/f3'))
+
+        self.assertTrue(self.store.remove(digest))
+        self.assertFalse(self.store.exists(digest))
+        self.assertFalse(self.store.remove(digest))
+        self.assertEqual(os.listdir(self.dir), ['inline'])
+
+    def test_refcount(self):
+        digests = [self.store.add(make_lists(n)) for n in range(1, 5)]
+        first = self.store.acquire(digests[0])
+        self.assertIs(self.store.acquire(digests[0]), first)
+        self.assertIsNone(self.store.acquire('00'*20))
+
+        # unused whitelists are kept until there are more than 2 of them
+        self.store.release(digests[0])
+        self.store.release(digests[0])
+        for digest in digests[1:]:
+            self.store.acquire(digest)
+            self.store.release(digest)
+        self.assertEqual(self.store.get_stats(), {'compiled': 2, 'in_use': 0, 'unused': 2, 'refs': 0})
+        self.assertNotIn(digests[0], self.store.entries)
+        self.assertIn(digests[3], self.store.entries)
+
+        # whitelists that are used are never evicted
+        used = [self.store.acquire(digest) for digest in digests]
+        self.assertEqual(self.store.get_stats()['in_use'], 4)
+        self.assertIs(self.store.acquire(digests[3]), used[3])
+
+    def test_inline(self):
+        lists = make_lists(5)
+        digest = ima.whitelist_version(lists)
+        compiled = self.store.acquire(digest, lists)
+        self.assertFalse(self.store.exists(digest))
+        self.assertEqual(len(compiled['whitelist']), 6)
+        # shared with agents that reference the same whitelist
+        self.store.add(lists)
+        self.assertIs(self.store.acquire(digest), compiled)
+
+    def test_inline_stored(self):
+        lists = make_lists(5)
+        digest = self.store.add(lists, inline=True)
+        self.assertTrue(self.store.exists(digest, inline=True))
+        # not an uploaded whitelist
+        self.assertFalse(self.store.exists(digest))
+        self.assertEqual(self.store.digests(), [])
+        self.assertIsNone(self.store.read(digest))
+        # workers get it by digest all the same
+        other = WhitelistStore(self.dir, 2)
+        self.assertEqual(other.acquire(digest)['whitelist'].get('/bin/f3'), ['03'*20])
+        self.assertFalse(self.store.remove(digest))
+        self.assertTrue(self.store.remove(digest, inline=True))
+        self.assertEqual(os.listdir(os.path.join(self.dir, 'inline')), [])
+
+
+if __name__ == '__main__':
+    unittest.main()